@@ -1,8 +1,12 @@
 __author__ = 'eric'
 
 from utils import pretty_json, validate_yaml
+from multiprocessing.pool import ThreadPool
+from time import time
+import heapq
 import sys
 import pymongo
+from sketches import LatencyHistogram, TimeSeries
 try:
     from collections import OrderedDict
 except ImportError:
@@ -24,12 +28,23 @@ UNSUPPORTED_QUERY_OPERATORS = ['$mod', '$exists', '$size',
 
 SUPPORTED_COMMANDS = ['count', 'findAndModify']
 
+# The quantiles of query time reported for each query, as stats fields
+REPORT_LATENCY_QUANTILES = [(0.5, 'p50TimeMillis'),
+                            (0.95, 'p95TimeMillis'),
+                            (0.99, 'p99TimeMillis')]
+
 COMPOSITE_QUERY_OPERATORS = ['$or', '$nor', '$and']
 RANGE_TYPE = 'RANGE'
 EQUIV_TYPE = 'EQUIV'
 UNSUPPORTED_TYPE = 'UNSUPPORTED'
 SORT_TYPE = 'SORT'
 BACKGROUND_FLAG = 'true'
+# After a failed index fetch, the wait before retrying doubles from the first
+# value up to the second
+INDEX_CACHE_RETRY_SECONDS = 30.0
+INDEX_CACHE_MAX_RETRY_SECONDS = 600.0
+# The most query shape analyses kept; the least recently used are evicted
+DEFAULT_ANALYSIS_CACHE_ENTRIES = 10000
 
 
 ################################################################################
@@ -38,23 +53,81 @@ BACKGROUND_FLAG = 'true'
 #   to databases to populate cache.
 ################################################################################
 class QueryAnalyzer:
-    def __init__(self, check_indexes):
+    def __init__(self, check_indexes, index_cache_ttl=None,
+                 max_analyses=DEFAULT_ANALYSIS_CACHE_ENTRIES):
         self._internal_map = {}
+        self._analysis_cache = OrderedDict()
+        self._max_analyses = max_analyses
+        self._analysis_cache_stats = OrderedDict([('hits', 0),
+                                                  ('misses', 0),
+                                                  ('hitRate', 0.0),
+                                                  ('evictions', 0),
+                                                  ('entries', 0),
+                                                  ('maxEntries', max_analyses)])
         self._check_indexes = check_indexes
         self._index_cache_connection = None
+        self._index_cache_ttl = index_cache_ttl
+        self._profile = None
 
     ############################################################################
     def generate_query_report(self, db_uri, parsed_query, db_name, collection_name):
         """Generates a comprehensive report on the raw query"""
-        index_analysis = None
-        recommendation = None
         namespace = parsed_query['ns']
-        indexStatus = "unknown"
 
         index_cache_entry = self._ensure_index_cache(db_uri,
                                                      db_name,
                                                      collection_name)
+        if 'error' in index_cache_entry:
+            # the collection's indexes are unknown, so the query is skipped
+            return None
+
+        # The analysis depends only on the query shape and the collection's
+        # indexes, so it is reused until the cached indexes change
+        analysis_cache = self._analysis_cache
+        stats = self._analysis_cache_stats
+        analysis_key = (namespace, parsed_query['queryMask'])
+        analysis = analysis_cache.pop(analysis_key, None)
+        if ((analysis is None) or
+                (analysis['indexes'] is not index_cache_entry['indexes'])):
+            stats['misses'] += 1
+            if self._profile is not None:
+                self._profile.count('analysisCacheMisses')
+                start = time()
+            analysis = self._generate_analysis(parsed_query,
+                                               db_name,
+                                               collection_name,
+                                               index_cache_entry['indexes'])
+            if self._profile is not None:
+                self._profile.add_time('analysis', time() - start)
+        else:
+            stats['hits'] += 1
+            if self._profile is not None:
+                self._profile.count('analysisCacheHits')
+        stats['hitRate'] = float(stats['hits']) / (stats['hits'] + stats['misses'])
+        analysis_cache[analysis_key] = analysis
+        while len(analysis_cache) > self._max_analyses:
+            analysis_cache.popitem(last=False)
+            stats['evictions'] += 1
+        stats['entries'] = len(analysis_cache)
 
+        # QUERY REPORT
+        return OrderedDict({
+            'queryMask': parsed_query['queryMask'],
+            'indexStatus': analysis['indexStatus'],
+            'parsed': parsed_query,
+            'namespace': namespace,
+            'queryAnalysis': analysis['queryAnalysis'],
+            'indexAnalysis': analysis['indexAnalysis'],
+            'recommendation': analysis['recommendation']
+        })
+
+    ############################################################################
+    def _generate_analysis(self, parsed_query, db_name, collection_name, indexes):
+        """Generates the query analysis, index analysis and recommendation
+            for a query shape against a collection's indexes"""
+        index_analysis = None
+        recommendation = None
+        indexStatus = "unknown"
 
         query_analysis = self._generate_query_analysis(parsed_query,
                                                        db_name,
@@ -62,7 +135,7 @@ class QueryAnalyzer:
         if ((query_analysis['analyzedFields'] != []) and
              query_analysis['supported']):
             index_analysis = self._generate_index_analysis(query_analysis,
-                                                           index_cache_entry['indexes'])
+                                                           indexes)
             indexStatus = index_analysis['indexStatus']
             if index_analysis['indexStatus'] != 'full':
                 recommendation = self._generate_recommendation(query_analysis,
@@ -75,41 +148,136 @@ class QueryAnalyzer:
                     recommendation = None
                     query_analysis['supported'] = False
 
-
-        # QUERY REPORT
-        return OrderedDict({
-            'queryMask': parsed_query['queryMask'],
-            'indexStatus': indexStatus,
-            'parsed': parsed_query,
-            'namespace': namespace,
-            'queryAnalysis': query_analysis,
-            'indexAnalysis': index_analysis,
-            'recommendation': recommendation
-        })
+        return {'indexes': indexes,
+                'indexStatus': indexStatus,
+                'queryAnalysis': query_analysis,
+                'indexAnalysis': index_analysis,
+                'recommendation': recommendation}
 
     ############################################################################
     def _ensure_index_cache(self, db_uri, db_name, collection_name):
-        """Adds a collections index entries to the cache if not present"""
-        if not self._check_indexes or db_uri is None:
+        """Returns a collection's index cache entry, fetching its indexes if
+            they are not cached, or if the entry has expired: a failed fetch
+            expires after a backoff, and fetched indexes after the index
+            cache TTL, if one is set. Without a db_uri, only indexes added
+            to the cache, e.g. from an index snapshot, are known"""
+        if not self._check_indexes:
             return {'indexes': None}
-        if db_name not in self.get_cache():
-            self._internal_map[db_name] = {}
-        if collection_name not in self._internal_map[db_name]:
-            indexes = []
-            try:
-                if self._index_cache_connection is None:
-                    self._index_cache_connection = pymongo.MongoClient(db_uri,
-                                                                       document_class=OrderedDict,
-                                                                       read_preference=pymongo.ReadPreference.PRIMARY_PREFERRED)
-
-                db = self._index_cache_connection[db_name]
-                indexes = db[collection_name].index_information()
-            except:
-                warning = 'Warning: unable to connect to ' + db_uri + "\n"
+        entry = self._internal_map.get(db_name, {}).get(collection_name)
+        if db_uri is None:
+            return {'indexes': None} if entry is None else entry
+        if ((entry is None) or
+                ((entry.get('expireTime') is not None) and (time() >= entry['expireTime']))):
+            if self._profile is not None:
+                self._profile.count('indexCacheMisses')
+                start = time()
+            entry = self._fetch_index_cache_entry(db_uri,
+                                                  db_name,
+                                                  collection_name,
+                                                  entry)
+            if self._profile is not None:
+                self._profile.add_time('indexFetch', time() - start)
+            self._internal_map.setdefault(db_name, {})[collection_name] = entry
+        elif self._profile is not None:
+            self._profile.count('indexCacheHits')
+        return entry
+
+    ############################################################################
+    def _fetch_index_cache_entry(self, db_uri, db_name, collection_name, previous):
+        """Fetches a collection's indexes, returning a new index cache entry.
+            A failure is cached too, so that the collection is not retried
+            on every query. previous is the expired entry, if any"""
+        try:
+            connection = self._get_index_cache_connection(db_uri)
+            indexes = connection[db_name][collection_name].index_information()
+        except Exception, e:
+            if (previous is not None) and ('error' not in previous):
+                # keep the indexes we have, and retry later
+                failures = 1
+                entry = dict(previous)
             else:
-                internal_map_entry = {'indexes': indexes}
-                self.get_cache()[db_name][collection_name] = internal_map_entry
-        return self.get_cache()[db_name][collection_name]
+                failures = 1 if previous is None else previous['failures'] + 1
+                entry = {'indexes': None, 'error': str(e)}
+                if failures == 1:
+                    sys.stderr.write('Warning: unable to read indexes of ' +
+                                     db_name + '.' + collection_name + ': ' +
+                                     str(e) + "\n")
+            entry['failures'] = failures
+            entry['expireTime'] = time() + min(INDEX_CACHE_RETRY_SECONDS * 2 ** (failures - 1),
+                                               INDEX_CACHE_MAX_RETRY_SECONDS)
+            return entry
+
+        # unchanged indexes keep their identity, so analyses are reused
+        if (previous is not None) and (previous['indexes'] == indexes):
+            indexes = previous['indexes']
+        if self._index_cache_ttl is None:
+            expire_time = None
+        else:
+            expire_time = time() + self._index_cache_ttl
+        return {'indexes': indexes, 'expireTime': expire_time}
+
+    ############################################################################
+    def _get_index_cache_connection(self, db_uri):
+        if self._index_cache_connection is None:
+            self._index_cache_connection = pymongo.MongoClient(db_uri,
+                                                               document_class=OrderedDict,
+                                                               read_preference=pymongo.ReadPreference.PRIMARY_PREFERRED)
+        return self._index_cache_connection
+
+    ############################################################################
+    def prefetch_index_cache(self, db_uri, namespace_tuples, concurrency):
+        """Fetches the indexes of uncached (db, collection) tuples, up to
+            concurrency collections at once"""
+        if not self._check_indexes or db_uri is None:
+            return
+        namespace_tuples = [namespace_tuple for namespace_tuple in namespace_tuples
+                            if namespace_tuple[1] not in self._internal_map.get(namespace_tuple[0], {})]
+        if namespace_tuples == []:
+            return
+        try:
+            # connect once, before the threads share the connection
+            self._get_index_cache_connection(db_uri)
+        except Exception:
+            return
+        if self._profile is not None:
+            start = time()
+        pool = ThreadPool(max(1, concurrency))
+        try:
+            entries = pool.map(lambda namespace_tuple: self._fetch_index_cache_entry(db_uri,
+                                                                                   namespace_tuple[0],
+                                                                                   namespace_tuple[1],
+                                                                                   None),
+                               namespace_tuples)
+        finally:
+            pool.close()
+            pool.join()
+        for namespace_tuple, entry in zip(namespace_tuples, entries):
+            self._internal_map.setdefault(namespace_tuple[0], {})[namespace_tuple[1]] = entry
+        if self._profile is not None:
+            self._profile.add_time('indexPrefetch', time() - start)
+            self._profile.count('indexesPrefetched', len(namespace_tuples))
+
+    ############################################################################
+    def get_cached_indexes(self):
+        """Returns the fetched indexes in the cache, by db and collection"""
+        cached_indexes = {}
+        for db_name, collections in self._internal_map.items():
+            for collection_name, entry in collections.items():
+                if 'error' not in entry:
+                    cached_indexes.setdefault(db_name, {})[collection_name] = entry['indexes']
+        return cached_indexes
+
+    ############################################################################
+    def set_index_cache_ttl(self, index_cache_ttl):
+        """Sets how long fetched indexes are used before being refetched.
+            None, the default, uses them for the whole run"""
+        self._index_cache_ttl = index_cache_ttl
+
+    ############################################################################
+    def set_profile(self, profile):
+        """Records index fetch and analysis times, and cache hits and misses,
+            in a RunProfile, or stops recording them if profile is None"""
+        self._profile = profile
 
     ############################################################################
     def _generate_query_analysis(self, parsed_query, db_name, collection_name):
@@ -311,17 +479,75 @@ class QueryAnalyzer:
     def get_cache(self):
         return self._internal_map
 
+    ############################################################################
+    def add_index_cache_entry(self, db_name, collection_name, indexes):
+        """Caches indexes fetched elsewhere, unless already cached"""
+        if not self._check_indexes:
+            return
+        collections = self._internal_map.setdefault(db_name, {})
+        if collection_name not in collections:
+            collections[collection_name] = {'indexes': indexes,
+                                            'expireTime': None}
+
+    ############################################################################
+    def get_analysis_cache_stats(self):
+        return self._analysis_cache_stats
+
+    ############################################################################
+    def merge_analysis_cache_stats(self, stats):
+        """Adds the counters of another analyzer's analysis cache stats to
+            this analyzer's, keeping the larger entries gauge"""
+        own_stats = self._analysis_cache_stats
+        for key in ['hits', 'misses', 'evictions']:
+            own_stats[key] += stats[key]
+        own_stats['entries'] = max(own_stats['entries'], stats['entries'])
+        lookups = own_stats['hits'] + own_stats['misses']
+        if lookups > 0:
+            own_stats['hitRate'] = float(own_stats['hits']) / lookups
+
     ############################################################################
     def clear_cache(self):
         self._internal_map = {}
+        self._analysis_cache = OrderedDict()
+        self._analysis_cache_stats['entries'] = 0
 
 ################################################################################
 # ReportAggregation
-#   Stores a merged set of query reports with running statistics
+#   Stores a merged set of query reports with running statistics, and a
+#   LatencyHistogram of each report's query times for its quantiles. With a
+#   series_interval, also a TimeSeries of each report's queries in buckets
+#   of that many seconds, of which up to series_max_buckets are kept.
+#
+#   With max_reports, at most that many reports are kept, by weighted
+#   Space-Saving: a new report replaces the report with the least estimated
+#   total time, and inherits that estimate as the most time its query may
+#   have taken uncounted before. A report's estimate is its total time plus
+#   that error, and estimates only grow, so a min-heap of them is corrected
+#   lazily as it is read. Any query whose total time exceeds the least
+#   estimate is kept. Replaced reports are summed per namespace.
 ################################################################################
 class ReportAggregation:
-    def __init__(self):
-        self._reports = []
+    def __init__(self, series_interval=None, series_max_buckets=None,
+                 max_reports=None):
+        self._reports = OrderedDict()
+        self._histograms = {}
+        self._series_interval = series_interval
+        self._series_max_buckets = series_max_buckets
+        self._series = {}
+        self._changed = None
+        self._top = None
+        self._max_reports = max_reports
+        self._errors = {}
+        self._estimate_heap = []
+        self._evicted = OrderedDict()
+        self._evicted_count = 0
+
+    ############################################################################
+    def track_changes(self):
+        """Records the reports that change from now on, for
+            get_changed_reports"""
+        self._changed = OrderedDict()
+        self._top = []
 
     ############################################################################
     def add_query_occurrence(self, report):
@@ -329,16 +555,16 @@ class ReportAggregation:
 
         initial_millis = int(report['parsed']['stats']['millis'])
         mask = report['queryMask']
+        key = (report['namespace'], mask)
 
         existing_report = self._get_existing_report(mask, report)
-
         if existing_report is not None:
             self._merge_report(existing_report, report)
         else:
             time = None
             if 'ts' in report['parsed']:
                 time = report['parsed']['ts']
-            self._reports.append(OrderedDict([
+            existing_report = OrderedDict([
                 ('namespace', report['namespace']),
                 ('lastSeenDate', time),
                 ('queryMask', mask),
@@ -347,23 +573,221 @@ class ReportAggregation:
                 ('recommendation', report['recommendation']),
                 ('stats', OrderedDict([('count', 1),
                                        ('totalTimeMillis', initial_millis),
-                                       ('avgTimeMillis', initial_millis)]))]))
+                                       ('avgTimeMillis', initial_millis)]))])
+            error = 0
+            if self._max_reports is not None and len(self._reports) >= self._max_reports:
+                error = self._evict_report()
+            self._add_report(key, existing_report, LatencyHistogram(), error)
+        if self._changed is not None:
+            self._changed[key] = existing_report
+
+        self._histograms[key].add(initial_millis)
+        if self._series_interval is not None and report['parsed'].get('ts') is not None:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = TimeSeries(self._series_interval,
+                                                        self._series_max_buckets)
+            series.add(report['parsed']['ts'], initial_millis)
+
+    ############################################################################
+    def get_reports(self, limit=None):
+        """Returns a minimized version of the aggregation. If limit is
+            provided, only the top limit reports by total time are returned"""
+        if limit is not None:
+            reports = heapq.nlargest(limit,
+                                     self._reports.values(),
+                                     key=lambda x: x['stats']['totalTimeMillis'])
+        else:
+            reports = sorted(self._reports.values(),
+                             key=lambda x: x['stats']['totalTimeMillis'],
+                             reverse=True)
+        self._update_report_stats(reports)
+        return reports
+
+    ############################################################################
+    def get_changed_reports(self, limit):
+        """Returns (rank, report) pairs for the reports among the top limit by
+            total time that changed, or entered the top, since the last call,
+            in rank order. Requires track_changes. The top reports are
+            maintained from the changed reports alone: total times only grow,
+            so an unchanged report cannot overtake one in the top. When a top
+            report has been replaced, its place may go to an unchanged report,
+            so the top is found among all reports instead"""
+        changed = self._changed
+        self._changed = OrderedDict()
+        previous_keys = set()
+        top_replaced = False
+        for report in self._top:
+            key = (report['namespace'], report['queryMask'])
+            if self._reports.get(key) is report:
+                previous_keys.add(key)
+            else:
+                top_replaced = True
+        if top_replaced:
+            candidates = self._reports.values()
+        else:
+            candidates = [report for report in self._top
+                          if (report['namespace'], report['queryMask']) not in changed]
+            # reports replaced since they changed are gone
+            candidates.extend(report for key, report in changed.items()
+                              if self._reports.get(key) is report)
+        self._top = heapq.nlargest(limit,
+                                   candidates,
+                                   key=lambda x: x['stats']['totalTimeMillis'])
+        changed_reports = []
+        for rank, report in enumerate(self._top):
+            key = (report['namespace'], report['queryMask'])
+            if key in changed or key not in previous_keys:
+                changed_reports.append((rank + 1, report))
+        self._update_report_stats([report for rank, report in changed_reports])
+        return changed_reports
+
+    ############################################################################
+    def merge(self, other):
+        """Merges another ReportAggregation into this one. Reports new to this
+            aggregation are appended in the other aggregation's order, so
+            merging partial aggregations of consecutive parts of a log in
+            order reproduces the aggregation of the whole log. When reports
+            are limited, a query missing from one aggregation may have taken
+            up to that aggregation's least estimate there, which is added to
+            its error"""
+        own_least_estimate = self._get_least_estimate()
+        other_least_estimate = other._get_least_estimate()
+        if self._max_reports is not None and other_least_estimate > 0:
+            for key in self._reports:
+                if key not in other._reports:
+                    self._errors[key] += other_least_estimate
+
+        for key, report in other._reports.items():
+            existing_report = self._reports.get(key)
+            if existing_report is None:
+                self._add_report(key, report, other._histograms[key],
+                                 other._errors.get(key, 0) + own_least_estimate)
+            else:
+                self._merge_aggregated_report(existing_report, report)
+                self._histograms[key].merge(other._histograms[key])
+                if key in self._errors:
+                    self._errors[key] += other._errors.get(key, 0)
+                report = existing_report
+            if key in other._series:
+                if key in self._series:
+                    self._series[key].merge(other._series[key])
+                else:
+                    self._series[key] = other._series[key]
+            if self._changed is not None:
+                self._changed[key] = report
+
+        for namespace, evicted in other._evicted.items():
+            self._add_evicted(namespace, evicted)
+        self._evicted_count += other._evicted_count
+        if self._max_reports is not None:
+            while len(self._reports) > self._max_reports:
+                self._evict_report()
+
+    ############################################################################
+    def get_options(self):
+        """Returns the (series_interval, series_max_buckets, max_reports) the
+            aggregation was created with"""
+        return self._series_interval, self._series_max_buckets, self._max_reports
+
+    ############################################################################
+    def get_stats(self):
+        """Returns how far a limited aggregation may be off, or None if
+            reports are not limited"""
+        if self._max_reports is None:
+            return None
+        return OrderedDict([('maxReports', self._max_reports),
+                            ('reports', len(self._reports)),
+                            ('reportsReplaced', self._evicted_count),
+                            ('maxUncountedTimeMillis', self._get_least_estimate()),
+                            ('replacedReports', self._evicted.values())])
 
     ############################################################################
-    def get_reports(self):
-        """Returns a minimized version of the aggregation"""
-        return sorted(self._reports,
-                      key=lambda x: x['stats']['totalTimeMillis'],
-                      reverse=True)
+    def _add_report(self, key, report, histogram, error):
+        self._reports[key] = report
+        self._histograms[key] = histogram
+        if self._max_reports is not None:
+            self._errors[key] = error
+            heapq.heappush(self._estimate_heap,
+                           (report['stats']['totalTimeMillis'] + error, key))
+
+    ############################################################################
+    def _get_estimate(self, key):
+        """Returns the estimated total time of a kept report, or None"""
+        report = self._reports.get(key)
+        if report is None:
+            return None
+        return report['stats']['totalTimeMillis'] + self._errors[key]
+
+    ############################################################################
+    def _get_least_estimate(self):
+        """Returns the least estimated total time of the kept reports if as
+            many reports as allowed are kept, or 0: the most time a query
+            that is not kept may have taken"""
+        if self._max_reports is None or len(self._reports) < self._max_reports:
+            return 0
+        heap = self._estimate_heap
+        while heap:
+            estimate, key = heap[0]
+            current = self._get_estimate(key)
+            if current is None:
+                heapq.heappop(heap)
+            elif current > estimate:
+                heapq.heapreplace(heap, (current, key))
+            else:
+                return estimate
+        return 0
+
+    ############################################################################
+    def _evict_report(self):
+        """Removes the report with the least estimated total time, adding it
+            to its namespace's replaced reports, and returns its estimate"""
+        estimate = self._get_least_estimate()
+        key = heapq.heappop(self._estimate_heap)[1]
+        report = self._reports.pop(key)
+        del self._histograms[key]
+        del self._errors[key]
+        self._series.pop(key, None)
+        self._add_evicted(report['namespace'],
+                          OrderedDict([('namespace', report['namespace']),
+                                       ('reports', 1),
+                                       ('count', report['stats']['count']),
+                                       ('totalTimeMillis', report['stats']['totalTimeMillis'])]))
+        self._evicted_count += 1
+        return estimate
+
+    ############################################################################
+    def _add_evicted(self, namespace, evicted):
+        """Adds replaced reports' counts to their namespace's"""
+        existing = self._evicted.get(namespace)
+        if existing is None:
+            self._evicted[namespace] = OrderedDict(evicted)
+        else:
+            for field in ['reports', 'count', 'totalTimeMillis']:
+                existing[field] += evicted[field]
+
+    ############################################################################
+    def _update_report_stats(self, reports):
+        """Sets the query time quantiles and maximum of reports' stats from
+            their histograms, their error when reports are limited, and
+            reports' series, if kept"""
+        quantiles = [quantile for quantile, field in REPORT_LATENCY_QUANTILES]
+        for report in reports:
+            key = (report['namespace'], report['queryMask'])
+            histogram = self._histograms[key]
+            values = histogram.get_quantiles(quantiles)
+            for (quantile, field), value in zip(REPORT_LATENCY_QUANTILES, values):
+                report['stats'][field] = value
+            report['stats']['maxTimeMillis'] = histogram.get_max()
+            if self._max_reports is not None:
+                report['stats']['maxUncountedTimeMillis'] = self._errors[key]
+            if key in self._series:
+                report['series'] = self._series[key].get_series()
 
     ############################################################################
     def _get_existing_report(self, mask, report):
         """Returns the aggregated report that matches report"""
-        for existing_report in self._reports:
-            if existing_report['namespace'] == report['namespace']:
-                if mask == existing_report['queryMask']:
-                    return existing_report
-        return None
+        return self._reports.get((report['namespace'], mask))
 
     ############################################################################
     def _merge_report(self, target, new):
@@ -381,3 +805,16 @@ class ReportAggregation:
         target['stats']['totalTimeMillis'] += query_millis
         target['stats']['count'] += 1
         target['stats']['avgTimeMillis'] = target['stats']['totalTimeMillis'] / target['stats']['count']
+
+    ############################################################################
+    def _merge_aggregated_report(self, target, other):
+        """Merges an aggregated report into the target report"""
+        time = other['lastSeenDate']
+        if (target.get('lastSeenDate', None) and
+                time and
+                    target['lastSeenDate'] < time):
+            target['lastSeenDate'] = time
+
+        target['stats']['totalTimeMillis'] += other['stats']['totalTimeMillis']
+        target['stats']['count'] += other['stats']['count']
+        target['stats']['avgTimeMillis'] = target['stats']['totalTimeMillis'] / target['stats']['count']
@@ -22,12 +22,23 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 ################################################################################
 
+import cPickle
+import os
 import pymongo
+import re
 import sys
 import time
-from utils import pretty_json
-from analyzer import QueryAnalyzer, ReportAggregation
-from parsers import LogParser, ProfileParser, get_line_time
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from utils import ReportWriter, RunProfile
+from analyzer import QueryAnalyzer, ReportAggregation, DEFAULT_ANALYSIS_CACHE_ENTRIES
+from parsers import LogParser, ProfileParser, DEFAULT_QUERY_SHAPE_CACHE_MB
+from readers import FileLineReader, MmapLineReader, CompressedLineReader
+from readers import LogFileTailer
+from snapshot import read_index_snapshot, write_index_snapshot
+from namespaces import NamespaceFilter, glob_matches, is_glob, is_regex_namespace
+from readers import expand_logfile_paths, get_compression, merge_reader_stats
 from datetime import datetime
 from datetime import timedelta
 import traceback
@@ -46,8 +57,30 @@ IGNORE_COLLECTIONS = [u'system.namespaces',
                       u'system.users',
                       u'system.indexes']
 WATCH_INTERVAL_SECONDS = 3.0
+# While reopened system.profile cursors find no new entries, the wait
+# before reopening doubles from the first value up to the second
+WATCH_PROFILE_RETRY_SECONDS = 0.5
+WATCH_PROFILE_MAX_RETRY_SECONDS = 30.0
 WATCH_DISPLAY_REFRESH_SECONDS = 30.0
+WATCH_DISPLAY_TOP_N = 25
 DEFAULT_PROFILE_LEVEL = pymongo.SLOW_ONLY
+# The profile entries ProfileParser can analyze, and the fields it reads
+PROFILE_QUERY_OPS = ['query', 'update']
+PROFILE_COMMANDS = ['count', 'findAndModify']
+PROFILE_PROJECTION = {'_id': False,
+                      'op': True,
+                      'ns': True,
+                      'ts': True,
+                      'millis': True,
+                      'query': True,
+                      'updateobj.orderby': True,
+                      'command.count': True,
+                      'command.findAndModify': True,
+                      'command.query': True}
+DEFAULT_PROFILE_BATCH_SIZE = 0
+DEFAULT_CONCURRENCY = 4
+WATCH_INDEX_CACHE_TTL_SECONDS = 300.0
+STATE_VERSION = 7
 
 
 ################################################################################
@@ -58,20 +91,57 @@ DEFAULT_PROFILE_LEVEL = pymongo.SLOW_ONLY
 class Dex:
 
     ############################################################################
-    def __init__(self, db_uri, verbose, namespaces_list, slowms, check_indexes, timeout):
+    def __init__(self, db_uri, verbose, namespaces_list, slowms, check_indexes, timeout,
+                 use_yaml=False, query_cache_mb=DEFAULT_QUERY_SHAPE_CACHE_MB,
+                 jobs=1, use_mmap=True,
+                 profile_batch_size=DEFAULT_PROFILE_BATCH_SIZE,
+                 concurrency=DEFAULT_CONCURRENCY, index_snapshot=None,
+                 state_path=None, output_format='json', compact=False,
+                 collect_timings=False, series_interval=None,
+                 series_max_buckets=None, max_patterns=None):
         self._check_indexes = check_indexes
-        self._query_analyzer = QueryAnalyzer(check_indexes)
+        max_analyses = DEFAULT_ANALYSIS_CACHE_ENTRIES
+        if max_patterns is not None:
+            # the analyses of patterns beyond those kept are rarely reused
+            max_analyses = min(max_analyses, max_patterns)
+        self._query_analyzer = QueryAnalyzer(check_indexes, max_analyses=max_analyses)
         self._db_uri = db_uri
         self._slowms = slowms
         self._verbose = verbose
-        self._requested_namespaces = self._validate_namespaces(namespaces_list)
+        self._requested_namespaces, self._requested_regexes = self._validate_namespaces(namespaces_list)
+        self._namespace_filter = NamespaceFilter(self._requested_namespaces,
+                                                 self._requested_regexes,
+                                                 IGNORE_DBS,
+                                                 IGNORE_COLLECTIONS)
         self._recommendation_cache = []
-        self._report = ReportAggregation()
+        self._series_interval = series_interval
+        self._series_max_buckets = series_max_buckets
+        self._max_patterns = max_patterns
+        self._report = ReportAggregation(series_interval, series_max_buckets,
+                                         max_patterns)
         self._start_time = None
         self._timeout_time = None
         self._timeout = timeout
         self._run_stats = self._get_initial_run_stats()
+        self._run_stats['analysisCache'] = self._query_analyzer.get_analysis_cache_stats()
         self._first_line = True
+        self._use_yaml = use_yaml
+        self._query_cache_mb = query_cache_mb
+        self._jobs = jobs
+        self._use_mmap = use_mmap
+        self._log_parser = None
+        self._profile_batch_size = profile_batch_size
+        self._concurrency = max(1, concurrency)
+        self._state_path = state_path
+        self._output_format = output_format
+        self._compact = compact
+        self._profile = None
+        if collect_timings:
+            self._profile = RunProfile()
+            self._run_stats['profile'] = self._profile.get_stats()
+            self._query_analyzer.set_profile(self._profile)
+        if index_snapshot is not None:
+            self._load_index_snapshot(index_snapshot)
 
     ############################################################################
     def generate_query_report(self, db_uri, query, db_name, collection_name):
@@ -84,8 +154,13 @@ class Dex:
     ############################################################################
     def _process_query(self, input, parser):
         self._run_stats['linesRead'] += 1
+        profile = self._profile
 
-        line_time = get_line_time(input)
+        if profile is not None:
+            start = time.time()
+        line_time = parser.get_line_time(input)
+        if profile is not None:
+            profile.add_time('lineTime', time.time() - start)
 
         if line_time is not None:
             if ((self._run_stats['timeRange']['start'] is None) or
@@ -95,7 +170,15 @@ class Dex:
                 (self._run_stats['timeRange']['end'] < line_time)):
                 self._run_stats['timeRange']['end'] = line_time
 
-        parsed = parser.parse(input)
+        if ((self._slowms > 0 or self._namespace_filter.has_requests()) and
+                self._line_filtered(input, parser)):
+            return
+
+        if profile is not None:
+            start = time.time()
+        parsed = parser.parse(input, line_time)
+        if profile is not None:
+            profile.add_time('parse', time.time() - start)
 
         if parsed is not None:
             if parsed['supported']:
@@ -106,7 +189,9 @@ class Dex:
                     db_name = namespace_tuple[0]
                     collection_name = namespace_tuple[1]
                     query_report = None
-                    if parsed['stats']['millis'] >= self._slowms:
+                    if int(parsed['stats']['millis']) >= self._slowms:
+                        if profile is not None:
+                            start = time.time()
                         try:
                             query_report = self.generate_query_report(self._db_uri,
                                                                       parsed,
@@ -115,10 +200,17 @@ class Dex:
                         except Exception as e:
                             #print traceback.print_exc()
                             return 1
+                        finally:
+                            if profile is not None:
+                                profile.add_time('analyze', time.time() - start)
                     if query_report is not None:
                         if query_report['recommendation'] is not None:
                             self._run_stats['linesWithRecommendations'] += 1
+                        if profile is not None:
+                            start = time.time()
                         self._report.add_query_occurrence(query_report)
+                        if profile is not None:
+                            profile.add_time('aggregate', time.time() - start)
             else:
                 self._run_stats['unparsableLineInfo']['unparsableLines'] += 1
                 self._run_stats['unparsableLineInfo']['unparsableLinesWithTime'] += 1
@@ -128,10 +220,27 @@ class Dex:
             self._run_stats['unparsableLineInfo']['unparsableLines'] += 1
             self._run_stats['unparsableLineInfo']['unparsableLinesWithoutTime'] += 1
 
+    ############################################################################
+    def _line_filtered(self, input, parser):
+        """Checks whether a line's millis or namespace, found without parsing
+            its query, show that it would not be analyzed, and if so counts
+            it in runStats.filteredLineInfo"""
+        namespace, millis = parser.get_filter_fields(input)
+        filtered_info = self._run_stats['filteredLineInfo']
+        if millis is not None and millis < self._slowms:
+            filtered_info['belowSlowms'] += 1
+        elif namespace is not None and not self._namespace_may_be_requested(namespace):
+            filtered_info['otherNamespaces'] += 1
+        else:
+            return False
+        filtered_info['filteredLines'] += 1
+        return True
+
     ############################################################################
     def analyze_profile(self):
         """Analyzes queries from a given log file"""
         profile_parser = ProfileParser()
+        profile_parser.set_profile(self._profile)
         databases = self._get_requested_databases()
         connection = pymongo.MongoClient(self._db_uri,
                                          document_class=OrderedDict,
@@ -151,12 +260,10 @@ class Dex:
                 if ignore_db in databases:
                     databases.remove(ignore_db)
 
-        for database in databases:
-
-            db = connection[database]
-
-            profile_entries = db['system.profile'].find()
+        self._prefetch_index_cache(connection, databases)
 
+        for database, profile_entries in self._scan_profiles(connection,
+                                                             databases):
             for profile_entry in profile_entries:
                 self._process_query(profile_entry,
                                     profile_parser)
@@ -165,10 +272,190 @@ class Dex:
 
         return 0
 
+    ############################################################################
+    def _scan_profiles(self, connection, databases):
+        """Yields (database, profile entries) for each database, in the order
+            given. Up to concurrency databases are read at once by a thread
+            pool, and at most one more is held unconsumed"""
+        pool = ThreadPool(self._concurrency)
+        pending = deque()
+        try:
+            for database in databases:
+                pending.append(pool.apply_async(self._read_profile,
+                                                (connection, database)))
+                if len(pending) > self._concurrency:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    ############################################################################
+    def _read_profile(self, connection, database):
+        """Reads the analyzable profile entries of a database. Runs in a
+            _scan_profiles thread"""
+        return database, list(self._find_profile_entries(connection[database]))
+
+    ############################################################################
+    def _prefetch_index_cache(self, connection=None, databases=None):
+        """Fetches the indexes of every requested collection into the index
+            cache up front, up to concurrency collections at once, so that
+            analysis does not wait on one collection at a time"""
+        if not self._check_indexes or self._db_uri is None:
+            return
+        try:
+            if connection is None:
+                connection = pymongo.MongoClient(self._db_uri,
+                                                 document_class=OrderedDict,
+                                                 read_preference=pymongo.ReadPreference.PRIMARY_PREFERRED)
+            namespace_tuples = self._list_requested_collections(connection,
+                                                                databases)
+        except pymongo.errors.PyMongoError:
+            # collections are then fetched as they are queried
+            return
+        self._query_analyzer.prefetch_index_cache(self._db_uri,
+                                                  namespace_tuples,
+                                                  self._concurrency)
+
+    ############################################################################
+    def snapshot_indexes(self, snapshot_path=None):
+        """Writes the indexes and document counts of every requested
+            collection to an index snapshot, for use with --indexes"""
+        connection = pymongo.MongoClient(self._db_uri,
+                                         document_class=OrderedDict,
+                                         read_preference=pymongo.ReadPreference.PRIMARY_PREFERRED)
+        try:
+            namespace_tuples = self._list_requested_collections(connection)
+        except pymongo.errors.PyMongoError:
+            message = "Error: Could not list databases on server. Please " \
+                      +         "check the auth components of your URI or provide " \
+                      +         "a namespace filter with -n.\n"
+            sys.stderr.write(message)
+            return 1
+
+        pool = ThreadPool(self._concurrency)
+        try:
+            collection_snapshots = pool.map(lambda namespace_tuple: self._snapshot_collection(connection,
+                                                                                             namespace_tuple),
+                                            namespace_tuples)
+        finally:
+            pool.close()
+            pool.join()
+
+        databases = OrderedDict()
+        for namespace_tuple, collection_snapshot in sorted(zip(namespace_tuples,
+                                                               collection_snapshots)):
+            if collection_snapshot is not None:
+                databases.setdefault(namespace_tuple[0], OrderedDict())[namespace_tuple[1]] = collection_snapshot
+        write_index_snapshot(databases, snapshot_path)
+
+        return 0
+
+    ############################################################################
+    def _snapshot_collection(self, connection, namespace_tuple):
+        """Returns the snapshot of one collection, or None if it cannot be
+            read. Runs in a snapshot_indexes thread"""
+        collection = connection[namespace_tuple[0]][namespace_tuple[1]]
+        try:
+            return OrderedDict([('count', collection.count()),
+                                ('indexes', collection.index_information())])
+        except pymongo.errors.PyMongoError, e:
+            sys.stderr.write('Warning: unable to read indexes of ' +
+                             namespace_tuple[0] + '.' + namespace_tuple[1] +
+                             ': ' + str(e) + "\n")
+            return None
+
+    ############################################################################
+    def _load_index_snapshot(self, snapshot_path):
+        """Loads the indexes of an index snapshot into the index cache"""
+        for db_name, collections in read_index_snapshot(snapshot_path).items():
+            for collection_name, collection_snapshot in collections.items():
+                self._query_analyzer.add_index_cache_entry(db_name,
+                                                           collection_name,
+                                                           collection_snapshot['indexes'])
+
+    ############################################################################
+    def _list_requested_collections(self, connection, databases=None):
+        """Returns (db, collection) tuples for every requested collection on
+            the server, listing up to concurrency databases at once. Raises
+            PyMongoError if the databases cannot be listed"""
+        if not databases:
+            databases = self._get_requested_databases()
+        if databases == []:
+            databases = [database for database in connection.database_names()
+                         if database not in IGNORE_DBS]
+
+        pool = ThreadPool(self._concurrency)
+        try:
+            collection_lists = pool.map(lambda database: self._list_database_collections(connection,
+                                                                                        database),
+                                        databases)
+        finally:
+            pool.close()
+            pool.join()
+
+        namespace_tuples = []
+        for database, collections in zip(databases, collection_lists):
+            for collection in collections:
+                namespace_tuples.append((database, collection))
+        return namespace_tuples
+
+    ############################################################################
+    def _list_database_collections(self, connection, database):
+        """Returns the requested collections of a database"""
+        collections = self._get_requested_collections(database)
+        if collections is None:
+            try:
+                collections = connection[database].collection_names()
+            except pymongo.errors.PyMongoError:
+                return []
+        return [collection for collection in collections
+                if collection not in IGNORE_COLLECTIONS]
+
+    ############################################################################
+    def _find_profile_entries(self, db, query=None, tailable=False):
+        """Returns a cursor over the analyzable system.profile entries of a
+            database, filtered and projected on the server. A tailable cursor
+            also awaits data, blocking briefly on the server for new entries"""
+        profile_query = self._get_profile_query(db.name)
+        if query is not None:
+            profile_query.update(query)
+        cursor = db['system.profile'].find(profile_query, PROFILE_PROJECTION,
+                                           tailable=tailable,
+                                           await_data=tailable)
+        if self._profile_batch_size > 0:
+            cursor = cursor.batch_size(self._profile_batch_size)
+        return cursor
+
+    ############################################################################
+    def _get_profile_query(self, database):
+        """Returns a system.profile query for the entries of a database that
+            ProfileParser can analyze, within the requested namespaces and at
+            or above slowms"""
+        collections = self._get_requested_collections(database)
+        if collections is None:
+            query_clause = {'op': {'$in': PROFILE_QUERY_OPS}}
+            collection_filter = {'$exists': True}
+        else:
+            query_clause = {'op': {'$in': PROFILE_QUERY_OPS},
+                            'ns': {'$in': [database + '.' + collection
+                                           for collection in collections]}}
+            collection_filter = {'$in': collections}
+        clauses = [query_clause]
+        for command in PROFILE_COMMANDS:
+            clauses.append({'op': 'command',
+                            'command.' + command: collection_filter})
+        profile_query = OrderedDict([('$or', clauses)])
+        if self._slowms > 0:
+            profile_query['millis'] = {'$gte': self._slowms}
+        return profile_query
+
     ############################################################################
     def watch_profile(self):
         """Analyzes queries from a given log file"""
         profile_parser = ProfileParser()
+        profile_parser.set_profile(self._profile)
         databases = self._get_requested_databases()
         connection = pymongo.MongoClient(self._db_uri,
                                          document_class=OrderedDict,
@@ -197,6 +484,10 @@ class Dex:
         database = databases[0]
         db = connection[database]
 
+        self._query_analyzer.set_index_cache_ttl(WATCH_INDEX_CACHE_TTL_SECONDS)
+        self._prefetch_index_cache(connection, databases)
+        self._report.track_changes()
+
         initial_profile_level = db.profiling_level()
 
         if initial_profile_level is pymongo.OFF:
@@ -208,11 +499,11 @@ class Dex:
 
         output_time = time.time() + WATCH_DISPLAY_REFRESH_SECONDS
         try:
-            for profile_entry in self._tail_profile(db, WATCH_INTERVAL_SECONDS):
+            for profile_entry in self._tail_profile(db, WATCH_PROFILE_RETRY_SECONDS):
                 self._process_query(profile_entry,
                                     profile_parser)
                 if time.time() >= output_time:
-                    self._output_aggregated_report(sys.stderr)
+                    self._output_changed_reports(sys.stderr)
                     output_time = time.time() + WATCH_DISPLAY_REFRESH_SECONDS
         except KeyboardInterrupt:
             sys.stderr.write("Interrupt received\n")
@@ -229,19 +520,414 @@ class Dex:
 
     ############################################################################
     def analyze_logfile(self, logfile_path):
-        self._run_stats['logSource'] = logfile_path
-        """Analyzes queries from a given log file"""
-        with open(logfile_path) as obj:
-            self.analyze_logfile_object(obj)
+        """Analyzes queries from one or more log files. logfile_path may be a
+            path, a glob pattern or a list of either. Compressed files are
+            decompressed as they are read"""
+        logfile_paths = expand_logfile_paths(logfile_path)
+        if self._state_path is None:
+            logfile_ranges = [(path, 0, None) for path in logfile_paths]
+        else:
+            logfile_ranges, positions = self._get_unread_ranges(logfile_paths,
+                                                                self._load_state())
+
+        if isinstance(logfile_path, basestring):
+            self._run_stats['logSource'] = logfile_path
+        else:
+            self._run_stats['logSource'] = ', '.join(logfile_path)
+        self._prefetch_index_cache()
+
+        if self._jobs > 1:
+            self._analyze_logfile_parallel(logfile_ranges)
+        else:
+            for path, start, end in logfile_ranges:
+                self.analyze_logfile_range(path, start, end)
+                if self._run_stats.get('timedOut', False):
+                    break
+
+        if self._state_path is not None:
+            if self._run_stats.get('timedOut', False):
+                sys.stderr.write("Warning: the run timed out, so the state file " +
+                                 self._state_path + " was not updated\n")
+            else:
+                self._save_state(positions)
 
         self._output_aggregated_report(sys.stdout)
 
         return 0
 
+    ############################################################################
+    def analyze_logfile_range(self, logfile_path, start, end):
+        """Analyzes queries from the lines of a log file that begin in the
+            byte range [start, end). An end of None reads to end of file.
+            Compressed files are always read whole. The lines' run stats are
+            also recorded as an entry of runStats.sources"""
+        run_stats = self._run_stats
+        self._run_stats = self._get_initial_run_stats()
+        try:
+            with open(logfile_path, 'rb') as obj:
+                reader = self._make_line_reader(obj, start, end)
+                self.analyze_logfile_object(reader)
+                self._add_reader_stats(reader)
+            source_run_stats = self._run_stats
+        finally:
+            self._run_stats = run_stats
+
+        self._run_stats['parserStats'] = source_run_stats.pop('parserStats')
+        self._merge_run_stats(source_run_stats)
+        self._merge_source_stats(OrderedDict([
+            ('source', logfile_path),
+            ('linesWithRecommendations', source_run_stats['linesWithRecommendations']),
+            ('linesAnalyzed', source_run_stats['linesAnalyzed']),
+            ('linesRead', source_run_stats['linesRead']),
+            ('unparsableLines', source_run_stats['unparsableLineInfo']['unparsableLines']),
+            ('filteredLines', source_run_stats['filteredLineInfo']['filteredLines']),
+            ('timeRange', source_run_stats['timeRange']),
+            ('readerStats', source_run_stats['readerStats'])]))
+
+        return 0
+
+    ############################################################################
+    def _load_state(self):
+        """Restores the run stats and report aggregation of the state file,
+            if it exists, and returns the read positions of its log files"""
+        if not os.path.exists(self._state_path):
+            return {}
+        with open(self._state_path, 'rb') as state_file:
+            state = cPickle.load(state_file)
+        if state.get('stateVersion') != STATE_VERSION:
+            sys.stderr.write("Warning: ignoring state file " + self._state_path +
+                             " written by another version of Dex\n")
+            return {}
+        if (state['report'].get_options() !=
+                (self._series_interval, self._series_max_buckets, self._max_patterns)):
+            sys.stderr.write("Warning: ignoring state file " + self._state_path +
+                             " written with other --series, --maxbuckets or "
+                             "--maxpatterns options\n")
+            return {}
+
+        run_stats = state['runStats']
+        run_stats['dexTime'] = datetime.utcnow()
+        run_stats.pop('timedOut', None)
+        run_stats.pop('timeoutInMinutes', None)
+        if 'parserStats' in run_stats:
+            # the query shape cache starts empty each run
+            run_stats['parserStats'].pop('queryShapeCache', None)
+            self._log_parser = self._make_log_parser()
+            self._log_parser.merge_stats(run_stats['parserStats'])
+            run_stats['parserStats'] = self._log_parser.get_stats()
+        # the analysis cache starts empty each run, and timings are of this
+        # run only
+        run_stats['analysisCache'] = self._query_analyzer.get_analysis_cache_stats()
+        run_stats.pop('profile', None)
+        if self._profile is not None:
+            run_stats['profile'] = self._profile.get_stats()
+        self._run_stats = run_stats
+        self._report = state['report']
+        return state['positions']
+
+    ############################################################################
+    def _save_state(self, positions):
+        """Writes the run stats, report aggregation and read positions to the
+            state file, replacing it atomically"""
+        state = {'stateVersion': STATE_VERSION,
+                 'positions': positions,
+                 'runStats': self._run_stats,
+                 'report': self._report}
+        temp_path = self._state_path + '.tmp'
+        with open(temp_path, 'wb') as state_file:
+            cPickle.dump(state, state_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self._state_path)
+
+    ############################################################################
+    def _get_unread_ranges(self, logfile_paths, positions):
+        """Returns the (path, start, end) ranges of the log files not yet read
+            according to the state's positions, and the positions once they
+            are read. Positions are keyed by (device, inode), so a log renamed
+            by rotation resumes where it was left. A log rotated away from
+            the given paths is looked for among the files of its directory
+            whose names start with its name, and its remaining lines are read
+            first, being the oldest"""
+        new_positions = {}
+        logfile_ranges = []
+        for logfile_path in logfile_paths:
+            stat = os.stat(logfile_path)
+            key = (stat.st_dev, stat.st_ino)
+            if key in new_positions:
+                continue
+            logfile_range, new_positions[key] = self._get_unread_range(
+                logfile_path, stat, positions.get(key), len(positions) > 0)
+            if logfile_range is not None:
+                logfile_ranges.append(logfile_range)
+
+        rotated_ranges = []
+        for key, previous in positions.items():
+            if key in new_positions:
+                continue
+            logfile_path = self._find_rotated_logfile(previous['path'], key)
+            if logfile_path is None:
+                sys.stderr.write("Warning: " + previous['path'] + " was rotated "
+                                 "and could not be found, so lines logged to it "
+                                 "since the last run are not read\n")
+                continue
+            logfile_range, new_positions[key] = self._get_unread_range(
+                logfile_path, os.stat(logfile_path), previous, True)
+            if logfile_range is not None:
+                rotated_ranges.append(logfile_range)
+        return rotated_ranges + logfile_ranges, new_positions
+
+    ############################################################################
+    def _get_unread_range(self, logfile_path, stat, previous, has_state):
+        """Returns the (path, start, end) range of a log file not yet read
+            given its previous position, or None if there is nothing new,
+            along with the file's position once the range is read. A file
+            smaller than its position was truncated and is read from its
+            start. Compressed files are read whole, and only once. The range
+            ends after the last complete line, so that a line still being
+            written is read next time"""
+        with open(logfile_path, 'rb') as obj:
+            compressed = get_compression(obj) is not None
+        position = {'path': os.path.abspath(logfile_path), 'offset': stat.st_size}
+
+        if compressed:
+            if previous is not None:
+                return None, position
+            if has_state:
+                sys.stderr.write("Warning: reading " + logfile_path + " whole; if it "
+                                 "is a log compressed after an earlier run read it, "
+                                 "those lines are counted twice\n")
+            return (logfile_path, 0, None), position
+
+        start = 0
+        if (previous is not None) and (previous['offset'] <= stat.st_size):
+            start = previous['offset']
+        position['offset'] = self._get_complete_lines_end(logfile_path,
+                                                          start,
+                                                          stat.st_size)
+        if position['offset'] <= start:
+            return None, position
+        return (logfile_path, start, position['offset']), position
+
+    ############################################################################
+    def _find_rotated_logfile(self, logfile_path, key):
+        """Returns the path of the file with the (device, inode) key in the
+            log file's directory, whose name starts with the log file's name,
+            or None"""
+        directory, name = os.path.split(logfile_path)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return None
+        for rotated_name in names:
+            if rotated_name.startswith(name):
+                rotated_path = os.path.join(directory, rotated_name)
+                try:
+                    stat = os.stat(rotated_path)
+                except OSError:
+                    continue
+                if (stat.st_dev, stat.st_ino) == key:
+                    return rotated_path
+        return None
+
+    ############################################################################
+    def _get_complete_lines_end(self, logfile_path, start, end):
+        """Returns the offset just past the last newline in [start, end), or
+            start if there is none"""
+        with open(logfile_path, 'rb') as obj:
+            position = end
+            while position > start:
+                chunk_start = max(start, position - 64 * 1024)
+                obj.seek(chunk_start)
+                newline = obj.read(position - chunk_start).rfind('\n')
+                if newline != -1:
+                    return chunk_start + newline + 1
+                position = chunk_start
+        return start
+
+    ############################################################################
+    def _make_log_parser(self):
+        log_parser = LogParser(self._use_yaml, self._query_cache_mb)
+        log_parser.set_profile(self._profile)
+        return log_parser
+
+    ############################################################################
+    def _make_line_reader(self, file_object, start, end):
+        """Returns a line reader suited to the file and the Dex's options"""
+        compression = get_compression(file_object)
+        if compression is not None:
+            return CompressedLineReader(file_object, compression)
+        elif self._use_mmap:
+            return MmapLineReader(file_object, start, end)
+        else:
+            return FileLineReader(file_object, start, end)
+
+    ############################################################################
+    def _merge_source_stats(self, source_stats):
+        """Adds the stats of one source, or of a byte range of one source, to
+            runStats.sources"""
+        sources = self._run_stats.setdefault('sources', [])
+        for existing in sources:
+            if existing['source'] == source_stats['source']:
+                for key in ['linesWithRecommendations', 'linesAnalyzed',
+                            'linesRead', 'unparsableLines', 'filteredLines']:
+                    existing[key] += source_stats[key]
+                self._update_time_range(source_stats['timeRange']['start'],
+                                        source_stats['timeRange']['end'],
+                                        existing['timeRange'])
+                merge_reader_stats(existing['readerStats'],
+                                   source_stats['readerStats'])
+                return
+        sources.append(source_stats)
+
+    ############################################################################
+    def _add_reader_stats(self, reader):
+        """Records a reader's stats, and counts the lines it skipped as read
+            and unparsable, as they would have been had they been parsed"""
+        reader_stats = reader.get_stats()
+        self._run_stats['readerStats'] = reader_stats
+        if self._profile is not None:
+            self._profile.add_time('read', reader_stats['readSeconds'],
+                                   reader_stats['linesRead'])
+        skipped = reader_stats['linesSkipped']
+        self._run_stats['linesRead'] += skipped
+        self._run_stats['unparsableLineInfo']['unparsableLines'] += skipped
+        self._run_stats['unparsableLineInfo']['unparsableLinesWithoutTime'] += skipped
+        self._update_time_range(*reader.get_skipped_time_range())
+
+    ############################################################################
+    def _update_time_range(self, start, end, time_range=None):
+        """Widens a timeRange, by default the run's, to include start and end"""
+        if time_range is None:
+            time_range = self._run_stats['timeRange']
+        if ((start is not None) and
+                ((time_range['start'] is None) or (time_range['start'] > start))):
+            time_range['start'] = start
+        if ((end is not None) and
+                ((time_range['end'] is None) or (time_range['end'] < end))):
+            time_range['end'] = end
+
+    ############################################################################
+    def _analyze_logfile_parallel(self, logfile_ranges):
+        """Splits (path, start, end) log file ranges into newline-aligned
+            byte ranges, analyzes each in a worker process and merges the
+            results in file order. Compressed files cannot be split, so each
+            is one range"""
+        tasks = []
+        options = self._get_worker_options()
+        cached_indexes = self._query_analyzer.get_cached_indexes()
+        for logfile_path, start, end in logfile_ranges:
+            for range_start, range_end in self._get_logfile_ranges(logfile_path,
+                                                                   self._jobs,
+                                                                   start,
+                                                                   end):
+                tasks.append((options, cached_indexes, logfile_path,
+                              range_start, range_end))
+        pool = Pool(min(self._jobs, max(len(tasks), 1)))
+        try:
+            partials = pool.map(_analyze_logfile_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        if self._log_parser is None:
+            self._log_parser = self._make_log_parser()
+        log_parser = self._log_parser
+        self._run_stats['parserStats'] = log_parser.get_stats()
+        for run_stats, report in partials:
+            self._merge_run_stats(run_stats)
+            log_parser.merge_stats(run_stats['parserStats'])
+            self._query_analyzer.merge_analysis_cache_stats(run_stats['analysisCache'])
+            if self._profile is not None:
+                self._profile.merge_stats(run_stats['profile'])
+            self._report.merge(report)
+
+    ############################################################################
+    def _get_logfile_ranges(self, logfile_path, count, start=0, end=None):
+        """Returns up to count (start, end) byte ranges covering [start, end)
+            of the file, or the whole file, each starting at the beginning of
+            a line. A compressed file is returned as a single range"""
+        size = os.path.getsize(logfile_path) if end is None else end
+        offsets = [start]
+        with open(logfile_path, 'rb') as obj:
+            if get_compression(obj) is not None:
+                return [(0, None)]
+            for i in range(1, count):
+                position = start + (size - start) * i / count
+                if position <= offsets[-1]:
+                    continue
+                # the line containing position - 1 belongs to the range before
+                obj.seek(position - 1)
+                obj.readline()
+                position = obj.tell()
+                if position >= size:
+                    break
+                if position > offsets[-1]:
+                    offsets.append(position)
+        return zip(offsets, offsets[1:] + [size])
+
+    ############################################################################
+    def _get_worker_options(self):
+        """Returns the arguments that reproduce this Dex in a worker process"""
+        return {'db_uri': self._db_uri,
+                'verbose': self._verbose,
+                'namespaces_list': [db + '.' + collection for db, collection
+                                    in self._requested_namespaces] +
+                                   ['/' + regex + '/' for regex
+                                    in self._requested_regexes],
+                'slowms': self._slowms,
+                'check_indexes': self._check_indexes,
+                'timeout': self._timeout,
+                'use_yaml': self._use_yaml,
+                'query_cache_mb': self._query_cache_mb,
+                'use_mmap': self._use_mmap,
+                'concurrency': self._concurrency,
+                'collect_timings': self._profile is not None,
+                'series_interval': self._series_interval,
+                'series_max_buckets': self._series_max_buckets,
+                'max_patterns': self._max_patterns}
+
+    ############################################################################
+    def _merge_run_stats(self, run_stats):
+        """Merges the run stats of a worker into this Dex's run stats"""
+        for key in ['linesWithRecommendations', 'linesAnalyzed', 'linesRead']:
+            self._run_stats[key] += run_stats[key]
+
+        self._update_time_range(run_stats['timeRange']['start'],
+                                run_stats['timeRange']['end'])
+
+        unparsable = self._run_stats['unparsableLineInfo']
+        for key in ['unparsableLines',
+                    'unparsableLinesWithoutTime',
+                    'unparsableLinesWithTime',
+                    'unparsedTimeMillis']:
+            unparsable[key] += run_stats['unparsableLineInfo'][key]
+        if unparsable['unparsableLinesWithTime'] > 0:
+            unparsable['unparsedAvgTimeMillis'] = unparsable['unparsedTimeMillis'] / unparsable['unparsableLinesWithTime']
+
+        filtered = self._run_stats['filteredLineInfo']
+        for key in ['filteredLines', 'belowSlowms', 'otherNamespaces']:
+            filtered[key] += run_stats['filteredLineInfo'][key]
+
+        if 'readerStats' in run_stats:
+            if 'readerStats' not in self._run_stats:
+                self._run_stats['readerStats'] = OrderedDict(run_stats['readerStats'])
+            else:
+                merge_reader_stats(self._run_stats['readerStats'],
+                                   run_stats['readerStats'])
+
+        for source_stats in run_stats.get('sources', []):
+            self._merge_source_stats(source_stats)
+
+        if run_stats.get('timedOut', False):
+            self._run_stats['timedOut'] = True
+            self._run_stats['timeoutInMinutes'] = run_stats['timeoutInMinutes']
+
     ############################################################################
     def analyze_logfile_object(self, file_object):
         """Analyzes queries from a given log file"""
-        log_parser = LogParser()
+        if self._log_parser is None:
+            self._log_parser = self._make_log_parser()
+        log_parser = self._log_parser
+        self._run_stats['parserStats'] = log_parser.get_stats()
 
         if self._start_time is None:
             self._start_time = datetime.now()
@@ -264,24 +950,25 @@ class Dex:
     def watch_logfile(self, logfile_path):
         """Analyzes queries from the tail of a given log file"""
         self._run_stats['logSource'] = logfile_path
-        log_parser = LogParser()
+        log_parser = self._make_log_parser()
+        self._run_stats['parserStats'] = log_parser.get_stats()
+        self._query_analyzer.set_index_cache_ttl(WATCH_INDEX_CACHE_TTL_SECONDS)
+        self._prefetch_index_cache()
+        self._report.track_changes()
 
         # For each new line in the logfile ...
         output_time = time.time() + WATCH_DISPLAY_REFRESH_SECONDS
+        tailer = LogFileTailer(logfile_path, WATCH_INTERVAL_SECONDS)
         try:
-            firstLine = True
-            for line in self._tail_file(open(logfile_path),
-                                        WATCH_INTERVAL_SECONDS):
-                if firstLine:
-                    self._run_stats['timeRange']['start'] = get_line_time(line)
+            for line in tailer:
                 self._process_query(line, log_parser)
-                self._run_stats['timeRange']['end'] = get_line_time(line)
                 if time.time() >= output_time:
-                    self._output_aggregated_report(sys.stderr)
+                    self._output_changed_reports(sys.stderr)
                     output_time = time.time() + WATCH_DISPLAY_REFRESH_SECONDS
         except KeyboardInterrupt:
             sys.stderr.write("Interrupt received\n")
         finally:
+            tailer.close()
             self._output_aggregated_report(sys.stdout)
 
         return 0
@@ -300,48 +987,90 @@ class Dex:
                                                                 ('unparsableLinesWithoutTime', 0),
                                                                 ('unparsableLinesWithTime', 0),
                                                                 ('unparsedTimeMillis', 0),
-                                                                ('unparsedAvgTimeMillis', 0)]))])
+                                                                ('unparsedAvgTimeMillis', 0)])),
+                            ('filteredLineInfo', OrderedDict([('filteredLines', 0),
+                                                              ('belowSlowms', 0),
+                                                              ('otherNamespaces', 0)]))])
 
     ############################################################################
     def _make_aggregated_report(self):
+        self._update_report_run_stats()
         output = OrderedDict([('runStats', self._run_stats),
                               ('results', self._report.get_reports())])
         return output
 
     ############################################################################
-    def _output_aggregated_report(self, out):
-        out.write(pretty_json(self._make_aggregated_report()).replace('"', "'").replace("\\'", '"') + "\n")
+    def _update_report_run_stats(self):
+        """Records how far the report aggregation may be off, if the number
+            of query patterns it keeps is limited"""
+        report_stats = self._report.get_stats()
+        if report_stats is not None:
+            self._run_stats['reportStats'] = report_stats
 
     ############################################################################
-    def _tail_file(self, file, interval):
-        """Tails a file"""
-        file.seek(0,2)
-        while True:
-            where = file.tell()
-            line = file.readline()
-            if not line:
-                time.sleep(interval)
-                file.seek(where)
-            else:
-                yield line
+    def _output_aggregated_report(self, out):
+        """Writes runStats and the query reports to out, encoding one report
+            at a time rather than the whole aggregation at once"""
+        self._update_report_run_stats()
+        writer = ReportWriter(out, self._output_format, self._compact)
+        writer.write(self._run_stats, self._report.get_reports())
 
     ############################################################################
-    def _tail_profile(self, db, interval):
-        """Tails the system.profile collection"""
-        latest_doc = None
-        while latest_doc is None:
-            time.sleep(interval)
-            latest_doc = db['system.profile'].find_one()
+    def _output_changed_reports(self, out):
+        """Writes runStats and the reports among the top WATCH_DISPLAY_TOP_N
+            that changed since the last refresh, each with its rank"""
+        reports = [OrderedDict([('rank', rank)] + report.items())
+                   for rank, report
+                   in self._report.get_changed_reports(WATCH_DISPLAY_TOP_N)]
+        self._update_report_run_stats()
+        writer = ReportWriter(out, self._output_format, self._compact)
+        writer.write(self._run_stats, reports)
 
-        current_time = latest_doc['ts']
+    ############################################################################
+    def _tail_profile(self, db, interval, max_interval=WATCH_PROFILE_MAX_RETRY_SECONDS):
+        """Tails the system.profile collection with a tailable, await-data
+            cursor, yielding entries added after tailing starts. When the
+            cursor dies, e.g. when the capped collection wraps, it is reopened
+            at the last yielded ts. Entries at that ts have been yielded
+            already, and come first in natural order, so they are skipped.
+            A cursor on an empty collection, or one whose newest entry does
+            not match, dies at once; while reopened cursors yield nothing,
+            the wait between reopens doubles from interval to max_interval"""
+        latest_doc = db['system.profile'].find_one(sort=[('$natural', pymongo.DESCENDING)])
+        if latest_doc is None:
+            current_time = None
+            yielded_at_current_time = 0
+        else:
+            current_time = latest_doc['ts']
+            yielded_at_current_time = self._find_profile_entries(
+                db, {'ts': current_time}).count()
 
+        wait = interval
         while True:
-            time.sleep(interval)
-            cursor = db['system.profile'].find({'ts': {'$gte': current_time}}).sort('ts', pymongo.ASCENDING)
-            for doc in cursor:
-                current_time = doc['ts']
-                yield doc
-
+            if current_time is None:
+                cursor = self._find_profile_entries(db, tailable=True)
+            else:
+                cursor = self._find_profile_entries(db, {'ts': {'$gte': current_time}},
+                                                    tailable=True)
+            skip = yielded_at_current_time
+            yielded = False
+            while cursor.alive:
+                for doc in cursor:
+                    if skip > 0 and doc['ts'] == current_time:
+                        skip -= 1
+                        continue
+                    skip = 0
+                    if doc['ts'] == current_time:
+                        yielded_at_current_time += 1
+                    else:
+                        current_time = doc['ts']
+                        yielded_at_current_time = 1
+                    yielded = True
+                    yield doc
+            if yielded:
+                wait = interval
+            time.sleep(wait)
+            wait = min(wait * 2, max_interval)
 
     ############################################################################
     def _tuplefy_namespace(self, namespace):
@@ -358,23 +1087,40 @@ class Dex:
         return namespace_tuple
 
     ############################################################################
-    # Need to add rejection of true regex attempts.
     def _validate_namespaces(self, input_namespaces):
         """Converts a list of db namespaces to a list of namespace tuples,
-            supporting basic commandline wildcards"""
+            supporting commandline wildcards and glob patterns, and a list
+            of the regexes of namespaces given as /regex/"""
         output_namespaces = []
+        output_regexes = []
         if input_namespaces == []:
-            return output_namespaces
+            return output_namespaces, output_regexes
         elif '*' in input_namespaces:
             if len(input_namespaces) > 1:
                 warning = 'Warning: Multiple namespaces are '
                 warning += 'ignored when one namespace is "*"\n'
                 sys.stderr.write(warning)
-            return output_namespaces
+            return output_namespaces, output_regexes
         else:
             for namespace in input_namespaces:
                 if not isinstance(namespace, unicode):
                     namespace = unicode(namespace)
+                if is_regex_namespace(namespace):
+                    regex = namespace[1:-1]
+                    try:
+                        re.compile(regex)
+                    except re.error:
+                        warning = 'Warning: Invalid namespace regex ' + namespace
+                        warning += ' will be ignored\n'
+                        sys.stderr.write(warning)
+                        continue
+                    if regex not in output_regexes:
+                        output_regexes.append(regex)
+                    else:
+                        warning = 'Warning: Duplicate namespace ' + namespace
+                        warning += ' will be ignored\n'
+                        sys.stderr.write(warning)
+                    continue
                 namespace_tuple = self._tuplefy_namespace(namespace)
                 if namespace_tuple is None:
                     warning = 'Warning: Invalid namespace ' + namespace
@@ -387,7 +1133,7 @@ class Dex:
                         warning = 'Warning: Duplicate namespace ' + namespace
                         warning += ' will be ignored\n'
                         sys.stderr.write(warning)
-        return output_namespaces
+        return output_namespaces, output_regexes
 
     ############################################################################
     def _namespace_requested(self, namespace):
@@ -395,47 +1141,65 @@ class Dex:
             namespace"""
         if namespace is None:
             return False
-        namespace_tuple = self._tuplefy_namespace(namespace)
-        if namespace_tuple[0] in IGNORE_DBS:
-            return False
-        elif namespace_tuple[1] in IGNORE_COLLECTIONS:
-            return False
-        else:
-            return self._tuple_requested(namespace_tuple)
+        return self._namespace_filter.namespace_requested(namespace)
 
     ############################################################################
-    def _tuple_requested(self, namespace_tuple):
-        """Helper for _namespace_requested. Supports limited wildcards"""
-        if not isinstance(namespace_tuple[0], unicode):
-            encoded_db = unicode(namespace_tuple[0])
-        else:
-            encoded_db = namespace_tuple[0]
-        if not isinstance(namespace_tuple[1], unicode):
-            encoded_coll = unicode(namespace_tuple[1])
-        else:
-            encoded_coll = namespace_tuple[1]
+    def _namespace_may_be_requested(self, namespace):
+        """Like _namespace_requested, but for a namespace read before its
+            query is parsed. A command's namespace is its database's $cmd,
+            and the collection it is on is not known yet, so only its
+            database is checked"""
+        if not namespace.endswith('.$cmd'):
+            return self._namespace_filter.namespace_requested(namespace)
+        return self._namespace_filter.database_requested(namespace[:-len('.$cmd')])
 
-        if namespace_tuple is None:
-            return False
-        elif len(self._requested_namespaces) is 0:
-            return True
+    ############################################################################
+    def _get_requested_collections(self, database):
+        """Returns a list of the collections requested in a database, or None
+            if all of its collections are requested, or if a pattern decides
+            which are"""
+        if not self._requested_namespaces or self._requested_regexes:
+            return None
+        collections = []
         for requested_namespace in self._requested_namespaces:
-            if  ((((requested_namespace[0]) == u'*') or
-                 (encoded_db == requested_namespace[0])) and
-                (((requested_namespace[1]) == u'*') or
-                 (encoded_coll == requested_namespace[1]))):
-                return True
-        return False
+            if glob_matches(requested_namespace[0], database):
+                if ((requested_namespace[1] == u'*') or
+                        is_glob(requested_namespace[1])):
+                    return None
+                if requested_namespace[1] not in collections:
+                    collections.append(requested_namespace[1])
+        return collections
 
     ############################################################################
     def _get_requested_databases(self):
-        """Returns a list of databases requested, not including ignored dbs"""
+        """Returns a list of databases requested, not including ignored dbs,
+            or an empty list if any database may be requested"""
         requested_databases = []
+        if self._requested_regexes:
+            return []
         if ((self._requested_namespaces is not None) and
                 (self._requested_namespaces != [])):
             for requested_namespace in self._requested_namespaces:
-                if requested_namespace[0] is '*':
+                if ((requested_namespace[0] == u'*') or
+                        is_glob(requested_namespace[0])):
                     return []
                 elif requested_namespace[0] not in IGNORE_DBS:
                     requested_databases.append(requested_namespace[0])
         return requested_databases
+
+################################################################################
+# Parallel logfile analysis
+#   Pool workers must be module-level functions
+################################################################################
+def _analyze_logfile_range(args):
+    """Analyzes one byte range of a log file in a worker process, returning
+        the worker's run stats and report aggregation"""
+    options, cached_indexes, logfile_path, start, end = args
+    worker = Dex(**options)
+    for db_name, collections in cached_indexes.items():
+        for collection_name, indexes in collections.items():
+            worker._query_analyzer.add_index_cache_entry(db_name,
+                                                         collection_name,
+                                                         indexes)
+    worker.analyze_logfile_range(logfile_path, start, end)
+    return worker._run_stats, worker._report
@@ -0,0 +1,139 @@
+__author__ = 'eric'
+
+import re
+from fnmatch import fnmatchcase, translate
+
+################################################################################
+# NamespaceFilter
+#   Decides whether a namespace was requested with -n/--namespace. Requested
+#   namespaces are compiled once into sets of exact namespaces ('db.coll'),
+#   whole databases ('db.*') and collections in any database ('*.coll'), so
+#   that each is found with a single lookup however many are requested.
+#   Glob patterns ('db*.user?') are compiled per part, and regex patterns
+#   ('/^shard\d+\.users$/') are searched for in the whole namespace. Each
+#   decision is cached per namespace, so patterns are only tried the first
+#   time a namespace is seen.
+################################################################################
+GLOB_CHARACTERS = '*?['
+NAMESPACE_CACHE_SIZE = 10000
+
+
+def is_regex_namespace(namespace):
+    """Checks whether a requested namespace is a /regex/"""
+    return len(namespace) > 2 and namespace[0] == '/' and namespace[-1] == '/'
+
+
+def is_glob(name):
+    """Checks whether a part of a requested namespace is a glob pattern,
+        rather than a name or '*' for any name"""
+    return name != u'*' and any(character in name
+                                for character in GLOB_CHARACTERS)
+
+
+def glob_matches(pattern, name):
+    """Checks whether a name matches a part of a requested namespace"""
+    return pattern == u'*' or pattern == name or (is_glob(pattern) and
+                                                  fnmatchcase(name, pattern))
+
+
+class NamespaceFilter(object):
+    def __init__(self, namespace_tuples, regexes=None, ignore_dbs=None,
+                 ignore_collections=None):
+        """namespace_tuples are the (db, collection) tuples requested, each
+            part a name, '*' or a glob pattern, and regexes the patterns
+            requested as /regex/. Nothing in ignore_dbs or
+            ignore_collections is ever requested"""
+        self._ignore_dbs = frozenset(ignore_dbs or [])
+        self._ignore_collections = frozenset(ignore_collections or [])
+        self._requests_all = not namespace_tuples and not regexes
+        self._namespaces = set()
+        self._databases = set()
+        self._collections = set()
+        self._namespace_databases = set()
+        self._globs = []
+        self._regexes = [re.compile(regex) for regex in regexes or []]
+        for database, collection in namespace_tuples:
+            if is_glob(database) or is_glob(collection):
+                self._globs.append((self._compile_glob(database),
+                                    self._compile_glob(collection)))
+            elif database == u'*' and collection == u'*':
+                self._requests_all = True
+            elif collection == u'*':
+                self._databases.add(database)
+            elif database == u'*':
+                self._collections.add(collection)
+            else:
+                self._namespaces.add(database + '.' + collection)
+                self._namespace_databases.add(database)
+        self._cache = {}
+        self._database_cache = {}
+
+    def _compile_glob(self, name):
+        """Returns a regex matching a part of a requested namespace, or None
+            if any name matches it"""
+        if name == u'*':
+            return None
+        return re.compile(translate(name))
+
+    def has_requests(self):
+        """Checks whether some namespaces were requested, rather than all"""
+        return not self._requests_all
+
+    def namespace_requested(self, namespace):
+        requested = self._cache.get(namespace)
+        if requested is None:
+            requested = self._get_namespace_requested(namespace)
+            if len(self._cache) >= NAMESPACE_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[namespace] = requested
+        return requested
+
+    def database_requested(self, database):
+        """Checks whether any collection of a database may be requested"""
+        requested = self._database_cache.get(database)
+        if requested is None:
+            requested = self._get_database_requested(database)
+            if len(self._database_cache) >= NAMESPACE_CACHE_SIZE:
+                self._database_cache.clear()
+            self._database_cache[database] = requested
+        return requested
+
+    def _get_namespace_requested(self, namespace):
+        namespace_split = namespace.split('.', 1)
+        if len(namespace_split) == 1:
+            # a single element is a collection name, as in a requested
+            # namespace
+            database, collection = u'*', namespace_split[0]
+        else:
+            database, collection = namespace_split
+        if database in self._ignore_dbs:
+            return False
+        elif collection in self._ignore_collections:
+            return False
+        elif self._requests_all:
+            return True
+        elif ((namespace in self._namespaces) or
+                (database in self._databases) or
+                (collection in self._collections)):
+            return True
+        for database_rx, collection_rx in self._globs:
+            if (((database_rx is None) or database_rx.match(database)) and
+                    ((collection_rx is None) or collection_rx.match(collection))):
+                return True
+        for regex in self._regexes:
+            if regex.search(namespace):
+                return True
+        return False
+
+    def _get_database_requested(self, database):
+        if database in self._ignore_dbs:
+            return False
+        elif self._requests_all or self._collections or self._regexes:
+            return True
+        elif ((database in self._databases) or
+                (database in self._namespace_databases)):
+            return True
+        for database_rx, collection_rx in self._globs:
+            if (database_rx is None) or database_rx.match(database):
+                return True
+        return False
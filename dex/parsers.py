@@ -1,8 +1,9 @@
 __author__ = 'eric'
 
 import re
-from utils import pretty_json, small_json, yamlfy
-from time import strptime, mktime
+import sys
+from utils import pretty_json, small_json, yamlfy, parse_query_literal
+from time import time
 from datetime import datetime
 import traceback
 
@@ -45,17 +46,148 @@ def scrub_list(a):
     return sorted(v)
 
 
-ts_rx = re.compile('^(?P<ts>[a-zA-Z]{3} [a-zA-Z]{3} {1,2}\d+ \d{2}:\d{2}:\d{2}).*')
+operation_rx = re.compile('\[\S*\] (?P<operation>\S+) ')
+operation_namespace_rx = re.compile('\[\S*\] \S+ (?P<ns>\S+\.\S+) ')
+ctime_rx = re.compile('^(?P<ts>[a-zA-Z]{3} (?P<month>[a-zA-Z]{3}) {1,2}(?P<day>\d+) '
+                      '(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2}))')
+iso8601_rx = re.compile('^(?P<ts>(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})T'
+                        '(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2}))')
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+LINE_TIME_CACHE_SIZE = 1024
+_line_time_cache = {}
+
+
+def get_line_millis(line):
+    """Returns the text of the millis a log line ends with, as in "120ms",
+        or None"""
+    line_end = line.rstrip()
+    if not line_end.endswith('ms'):
+        return None
+    millis_text = line_end[line_end.rfind(' ') + 1:-2]
+    if not millis_text.isdigit():
+        return None
+    return millis_text
+
+
 def get_line_time(line):
-    ts = None
-    match = ts_rx.match(line)
-    if match:
-        year = datetime.utcnow().year
-        timestamp = mktime(strptime(match.group('ts') + ' ' + str(year), '%a %b %d %H:%M:%S %Y'))
-        ts = datetime.fromtimestamp(timestamp)
+    """Returns the time of a log line in ctime (2.x), iso8601-local or
+        iso8601-utc format, as the naive time written in the line. ctime
+        lines carry no offset, so iso8601 offsets are ignored rather than
+        converting only some lines' times; ctime lines carry no year either,
+        so the current year is assumed. Times are cached by their text to
+        the second, since consecutive lines usually share it"""
+    if line[:1].isdigit():
+        match = iso8601_rx.match(line)
+    else:
+        match = ctime_rx.match(line)
+    if match is None:
+        return None
+    key = match.group('ts')
+
+    try:
+        return _line_time_cache[key]
+    except KeyError:
+        pass
+
+    try:
+        if match.re is ctime_rx:
+            ts = datetime(datetime.utcnow().year,
+                          MONTHS[match.group('month').capitalize()],
+                          int(match.group('day')),
+                          int(match.group('hour')),
+                          int(match.group('minute')),
+                          int(match.group('second')))
+        else:
+            ts = datetime(int(match.group('year')),
+                          int(match.group('month')),
+                          int(match.group('day')),
+                          int(match.group('hour')),
+                          int(match.group('minute')),
+                          int(match.group('second')))
+    except (KeyError, ValueError):
+        return None
+
+    if len(_line_time_cache) >= LINE_TIME_CACHE_SIZE:
+        _line_time_cache.clear()
+    _line_time_cache[key] = ts
     return ts
 
 
+################################################################################
+# QueryShapeCache
+#   A bounded LRU cache mapping raw query text to its parsed query shape
+#   (standardized query, orderby and queryMask). Entry sizes are estimated
+#   from the raw text and the mask, so the memory cap is approximate.
+################################################################################
+DEFAULT_QUERY_SHAPE_CACHE_MB = 64
+QUERY_SHAPE_CACHE_ENTRY_OVERHEAD = 512
+
+
+class QueryShapeCache(object):
+    def __init__(self, max_mb=DEFAULT_QUERY_SHAPE_CACHE_MB):
+        self._max_bytes = int(max_mb * 1024 * 1024)
+        self._entries = OrderedDict()
+        self._stats = OrderedDict([('hits', 0),
+                                   ('misses', 0),
+                                   ('hitRate', 0.0),
+                                   ('evictions', 0),
+                                   ('entries', 0),
+                                   ('approxBytes', 0),
+                                   ('maxBytes', self._max_bytes)])
+
+    def get(self, key):
+        """Returns the cached shape for key, or None"""
+        stats = self._stats
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            stats['misses'] += 1
+        else:
+            self._entries[key] = entry
+            stats['hits'] += 1
+        stats['hitRate'] = float(stats['hits']) / (stats['hits'] + stats['misses'])
+        return entry[0] if entry is not None else None
+
+    def put(self, key, shape):
+        """Caches shape, evicting least recently used shapes over the cap"""
+        size = self._estimate_size(key, shape)
+        if size > self._max_bytes:
+            return
+        stats = self._stats
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            stats['approxBytes'] -= previous[1]
+        self._entries[key] = (shape, size)
+        stats['approxBytes'] += size
+        while stats['approxBytes'] > self._max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            stats['approxBytes'] -= evicted[1]
+            stats['evictions'] += 1
+        stats['entries'] = len(self._entries)
+
+    def get_stats(self):
+        return self._stats
+
+    def merge_stats(self, stats):
+        """Adds the counters of another cache's stats to this cache's. The
+        entries and approxBytes gauges describe one cache each, so the
+        largest of them is kept rather than their sum."""
+        for key in ['hits', 'misses', 'evictions']:
+            self._stats[key] += stats[key]
+        for key in ['entries', 'approxBytes']:
+            self._stats[key] = max(self._stats[key], stats[key])
+        lookups = self._stats['hits'] + self._stats['misses']
+        if lookups > 0:
+            self._stats['hitRate'] = float(self._stats['hits']) / lookups
+
+    def _estimate_size(self, key, shape):
+        mask = shape.get('queryMask') or ''
+        # the query and orderby structures are roughly proportional to the
+        # mask that serializes them
+        return (sys.getsizeof(key[1]) + 3 * sys.getsizeof(mask) +
+                QUERY_SHAPE_CACHE_ENTRY_OVERHEAD)
+
+
 ################################################################################
 # Parser
 #   Provides a parse function that passes input to a round of handlers.
@@ -63,20 +195,82 @@ def get_line_time(line):
 class Parser(object):
     def __init__(self, handlers):
         self._line_handlers = handlers
-
-    def parse(self, input):
-        """Passes input to each QueryLineHandler in use"""
-        query = None
-        for handler in self._line_handlers:
+        self._profile = None
+        self._stats = OrderedDict([('linesRejected', 0),
+                                   ('handlers', OrderedDict())])
+        for handler in handlers:
+            self._stats['handlers'][self._get_handler_name(handler)] = \
+                OrderedDict([('attempts', 0),
+                             ('hits', 0)])
+
+    def parse(self, input, line_time=None):
+        """Passes input, and its time if already known, to each
+            QueryLineHandler in use"""
+        handlers, position = self._get_handlers(input)
+        if handlers is None:
+            self._stats['linesRejected'] += 1
+            return None
+        profile = self._profile
+        for handler in handlers:
+            handler_name = self._get_handler_name(handler)
+            handler_stats = self._stats['handlers'][handler_name]
+            handler_stats['attempts'] += 1
+            if profile is not None:
+                start = time()
             try:
-                query = handler.handle(input)
+                if position is not None:
+                    query = handler.handle(input, line_time, position)
+                elif line_time is None:
+                    query = handler.handle(input)
+                else:
+                    query = handler.handle(input, line_time)
             except Exception as e:
                 query = None
-            finally:
-                if query is not None:
-                    return query
+            if profile is not None:
+                profile.add_time(handler_name, time() - start,
+                                 section='handlers')
+            if query is not None:
+                handler_stats['hits'] += 1
+                return query
+        return None
+
+    def get_stats(self):
+        """Returns the per-handler attempt and hit counters"""
+        return self._stats
+
+    def set_profile(self, profile):
+        """Records handler and query parsing times in a RunProfile, or stops
+            recording them if profile is None"""
+        self._profile = profile
+        for handler in self._line_handlers:
+            handler.profile = profile
+
+    def merge_stats(self, stats):
+        """Adds the counters of another parser's stats to this parser's"""
+        self._stats['linesRejected'] += stats['linesRejected']
+        for name, handler_stats in stats['handlers'].items():
+            for key in handler_stats:
+                self._stats['handlers'][name][key] += handler_stats[key]
+
+    def get_line_time(self, input):
         return None
 
+    def get_filter_fields(self, input):
+        """Returns the namespace and millis of input, found without parsing
+            its query so that input can be filtered out first, each None if
+            they cannot be found that way. A command's namespace is its
+            database's $cmd"""
+        return None, None
+
+    def _get_handlers(self, input):
+        """Returns the handlers that may parse input, or None if the input
+            should be rejected outright, and the position handlers may start
+            matching at, or None if it is not known"""
+        return self._line_handlers, None
+
+    def _get_handler_name(self, handler):
+        return getattr(handler, 'name', handler.__class__.__name__)
+
 
 ################################################################################
 # ProfileParser
@@ -90,13 +284,16 @@ class ProfileParser(Parser):
     def get_line_time(self, input):
         return input['ts'] if 'ts' in input else None
 
+    def get_filter_fields(self, input):
+        return input.get('ns'), input.get('millis')
+
     ############################################################################
     # Base ProfileEntryHandler class
     #   Knows how to yamlfy a logline query
     ############################################################################
     class ProfileEntryHandler:
         ########################################################################
-        def handle(self, input):
+        def handle(self, input, line_time=None):
             result = OrderedDict()
             query = None
             orderby = None
@@ -135,6 +332,8 @@ class ProfileParser(Parser):
 
                 result['queryMask'] = small_json(toMask)
                 result['stats'] = {'millis': input['millis']}
+                if line_time is not None:
+                    result['ts'] = line_time
                 return result
             else:
                 return None
@@ -145,33 +344,144 @@ class ProfileParser(Parser):
 #   Extracts queries from log lines using a list of QueryLineHandlers
 ################################################################################
 class LogParser(Parser):
-    def __init__(self):
-        """Declares the QueryLineHandlers to use"""
-        super(LogParser, self).__init__([CmdQueryHandler(),
-                                         UpdateQueryHandler(),
-                                         StandardQueryHandler(),
-                                         TimeLineHandler()])
+    def __init__(self, use_yaml=False,
+                 query_cache_mb=DEFAULT_QUERY_SHAPE_CACHE_MB):
+        """Declares the QueryLineHandlers to use. If use_yaml is True, logged
+            queries are parsed with the YAML loader rather than the query
+            literal parser. Parsed query shapes are memoized in a cache of
+            up to query_cache_mb megabytes; 0 disables the cache"""
+        cmd_handler = CmdQueryHandler()
+        update_handler = UpdateQueryHandler()
+        standard_handler = StandardQueryHandler()
+        time_handler = TimeLineHandler()
+        super(LogParser, self).__init__([cmd_handler,
+                                         update_handler,
+                                         standard_handler,
+                                         time_handler])
+        shape_cache = None
+        if query_cache_mb > 0:
+            shape_cache = QueryShapeCache(query_cache_mb)
+            self._stats['queryShapeCache'] = shape_cache.get_stats()
+        self._shape_cache = shape_cache
+        for handler in self._line_handlers:
+            handler.use_yaml = use_yaml
+            handler.shape_cache = shape_cache
+        # Handlers to try, in order, keyed on the operation keyword that
+        # follows the [connNNN] token
+        self._dispatch_table = {
+            'command': [cmd_handler, time_handler],
+            'update': [update_handler, standard_handler, time_handler]
+        }
+        self._query_handlers = [standard_handler, time_handler]
+        self._time_handlers = [time_handler]
+
+    def merge_stats(self, stats):
+        super(LogParser, self).merge_stats(stats)
+        if self._shape_cache is not None and 'queryShapeCache' in stats:
+            self._shape_cache.merge_stats(stats['queryShapeCache'])
+
+    def get_line_time(self, input):
+        return get_line_time(input)
+
+    def get_filter_fields(self, input):
+        """Returns the namespace following the operation, and the millis
+            the line ends with"""
+        millis = get_line_millis(input)
+        if millis is not None:
+            millis = int(millis)
+        match = operation_namespace_rx.search(input)
+        if match is None:
+            return None, millis
+        return match.group('ns'), millis
+
+    def _get_handlers(self, input):
+        """Looks at the line once and chooses the handlers that can parse it,
+            which start matching at its [connNNN] token"""
+        if 'ms' not in input:
+            return None, None
+        match = operation_rx.search(input)
+        if match is None:
+            position = None
+        else:
+            position = match.start()
+            handlers = self._dispatch_table.get(match.group('operation'))
+            if handlers is not None:
+                return handlers, position
+        if ' query: ' in input:
+            return self._query_handlers, position
+        return self._time_handlers, position
 
 
 ############################################################################
 # Base QueryLineHandler class
-#   Knows how to yamlfy a logline query
+#   Knows how to parse a logline query
 ############################################################################
 class QueryLineHandler:
+    use_yaml = False
+    shape_cache = None
+    profile = None
+
     ########################################################################
     def parse_query(self, extracted_query):
-        return yamlfy(extracted_query)
-
-    def handle(self, line):
-
-        result = self.do_handle(line)
+        if self.profile is not None:
+            start = time()
+            try:
+                return self._parse_query(extracted_query)
+            finally:
+                self.profile.add_time('yamlParse' if self.use_yaml else 'queryLiteralParse',
+                                      time() - start)
+        return self._parse_query(extracted_query)
+
+    def _parse_query(self, extracted_query):
+        if self.use_yaml:
+            return yamlfy(extracted_query)
+        return parse_query_literal(extracted_query)
+
+    def get_query_shape(self, extracted_query):
+        """Returns the shape of the extracted query, from the shape cache
+            when the same query text has been seen before"""
+        if self.shape_cache is None:
+            return self.parse_query_shape(extracted_query)
+        key = (self.name, extracted_query)
+        shape = self.shape_cache.get(key)
+        if shape is None:
+            shape = self.parse_query_shape(extracted_query)
+            if shape is not None:
+                self.shape_cache.put(key, shape)
+        return shape
+
+    def parse_query_shape(self, extracted_query):
+        """Parses and standardizes the extracted query into its query,
+            orderby and queryMask"""
+        parsed = self.parse_query(extracted_query)
+        if parsed is None:
+            return None
+        scrubbed = self.standardize_query(parsed)
+        shape = {'query': scrubbed['$query'],
+                 'queryMask': small_json(scrubbed)}
+        if '$orderby' in scrubbed:
+            shape['orderby'] = scrubbed['$orderby']
+        return shape
+
+    def handle(self, line, line_time=None, position=None):
+
+        result = self.do_handle(line, position)
         if result is not None:
-            result['ts'] = get_line_time(line)
+            if line_time is None:
+                line_time = get_line_time(line)
+            result['ts'] = line_time
             return result
 
-    def do_handle(self, line):
+    def do_handle(self, line, position=None):
         return None
 
+    def match_line(self, line, position):
+        """Matches the handler's pattern at position, where the line's
+            [connNNN] token starts, or searches the line for it"""
+        if position is None:
+            return self._rx.search(line)
+        return self._rx.match(line, position)
+
     def parse_line_stats(self, stat_string):
         line_stats = {}
         split = stat_string.split(" ")
@@ -224,24 +534,23 @@ class StandardQueryHandler(QueryLineHandler):
     ########################################################################
     def __init__(self):
         self.name = 'Standard Query Log Line Handler'
-        self._regex = '.*\[(?P<connection>\S*)\] '
+        self._regex = '\[(?P<connection>\S*)\] '
         self._regex += '(?P<operation>\S+) (?P<ns>\S+\.\S+) query: '
         self._regex += '(?P<query>\{.*\}) (?P<stats>(\S+ )*)'
         self._regex += '(?P<query_time>\d+)ms'
         self._rx = re.compile(self._regex)
 
     ########################################################################
-    def do_handle(self, input):
-        match = self._rx.match(input)
+    def do_handle(self, input, position=None):
+        match = self.match_line(input, position)
         if match is not None:
-            parsed = self.parse_query(match.group('query'))
-            if parsed is not None:
+            shape = self.get_query_shape(match.group('query'))
+            if shape is not None:
                 result = OrderedDict()
-                scrubbed = self.standardize_query(parsed)
-                result['query'] = scrubbed['$query']
-                if '$orderby' in scrubbed:
-                    result['orderby'] = scrubbed['$orderby']
-                result['queryMask'] = small_json(scrubbed)
+                result['query'] = shape['query']
+                if 'orderby' in shape:
+                    result['orderby'] = shape['orderby']
+                result['queryMask'] = shape['queryMask']
                 result['ns'] = match.group('ns')
                 result['stats'] = self.parse_line_stats(match.group('stats'))
                 result['stats']['millis'] = match.group('query_time')
@@ -258,63 +567,70 @@ class CmdQueryHandler(QueryLineHandler):
     ########################################################################
     def __init__(self):
         self.name = 'CMD Log Line Handler'
-        self._regex = '.*\[conn(?P<connection_id>\d+)\] '
+        self._regex = '\[conn(?P<connection_id>\d+)\] '
         self._regex += 'command (?P<db>\S+)\.\$cmd command: '
         self._regex += '(?P<query>\{.*\}) (?P<stats>(\S+ )*)'
         self._regex += '(?P<query_time>\d+)ms'
         self._rx = re.compile(self._regex)
 
     ########################################################################
-    def do_handle(self, input):
-        match = self._rx.match(input)
+    def do_handle(self, input, position=None):
+        match = self.match_line(input, position)
         if match is not None:
-            parsed = self.parse_query(match.group('query'))
-            if parsed is not None:
+            shape = self.get_query_shape(match.group('query'))
+            if shape is not None:
                 result = OrderedDict()
                 result['stats'] = self.parse_line_stats(match.group('stats'))
                 result['stats']['millis'] = match.group('query_time')
-
-                command = parsed.keys()[0]
-
-                toMask = OrderedDict()
-
-                result['command'] = command
-                result['supported'] = True
-                if command.lower() == 'count':
-                    result['ns'] = match.group('db') + '.'
-                    result['ns'] += parsed[command]
-                    query = self.standardize_query(parsed['query'])
-                    result['query'] = query['$query']
-                    toMask = query
-                elif command.lower() == 'findandmodify':
-                    if 'sort' in parsed:
-                        result['orderby'] = parsed['sort']
-                        toMask['$orderby'] = parsed['sort']
-                    result['ns'] = match.group('db') + '.'
-                    result['ns'] += parsed[command]
-                    query = self.standardize_query(parsed['query'])
-                    result['query'] = query['$query']
-                    if 'sort' in parsed:
-                        result['orderby'] = parsed['sort']
-                        toMask['$orderby'] = parsed['sort']
-                    toMask['$query'] = query
-                elif command.lower() == 'geonear':
-                    result['ns'] = match.group('db') + '.'
-                    result['ns'] += parsed[command]
-                    query = self.standardize_query(parsed['search'])
-                    result['query'] = query
-                    toMask = query
+                result['command'] = shape['command']
+                result['supported'] = shape['supported']
+                if shape['supported']:
+                    if 'orderby' in shape:
+                        result['orderby'] = shape['orderby']
+                    result['ns'] = match.group('db') + '.' + shape['collection']
+                    result['query'] = shape['query']
                 else:
-                    result['supported'] = False
                     result['ns'] = match.group('db') + '.$cmd'
-
-                result['command'] = command
-                toMask['$cmd'] = command
-                result['queryMask'] = small_json(toMask)
+                result['queryMask'] = shape['queryMask']
 
                 return result
         return None
 
+    ########################################################################
+    def parse_query_shape(self, extracted_query):
+        parsed = self.parse_query(extracted_query)
+        if parsed is None:
+            return None
+        command = parsed.keys()[0]
+
+        toMask = OrderedDict()
+        shape = {'command': command,
+                 'supported': True}
+        if command.lower() == 'count':
+            shape['collection'] = parsed[command]
+            query = self.standardize_query(parsed['query'])
+            shape['query'] = query['$query']
+            toMask = query
+        elif command.lower() == 'findandmodify':
+            if 'sort' in parsed:
+                shape['orderby'] = parsed['sort']
+                toMask['$orderby'] = parsed['sort']
+            shape['collection'] = parsed[command]
+            query = self.standardize_query(parsed['query'])
+            shape['query'] = query['$query']
+            toMask['$query'] = query
+        elif command.lower() == 'geonear':
+            shape['collection'] = parsed[command]
+            query = self.standardize_query(parsed['search'])
+            shape['query'] = query
+            toMask = query
+        else:
+            shape['supported'] = False
+
+        toMask['$cmd'] = command
+        shape['queryMask'] = small_json(toMask)
+        return shape
+
 
 ############################################################################
 # UpdateQueryHandler
@@ -324,25 +640,24 @@ class UpdateQueryHandler(QueryLineHandler):
     ########################################################################
     def __init__(self):
         self.name = 'Update Log Line Handler'
-        self._regex = '.*\[conn(?P<connection_id>\d+)\] '
+        self._regex = '\[conn(?P<connection_id>\d+)\] '
         self._regex += 'update (?P<ns>\S+\.\S+) query: '
         self._regex += '(?P<query>\{.*\}) update: (?P<update>\{.*\}) '
         self._regex += '(?P<stats>(\S+ )*)(?P<query_time>\d+)ms'
         self._rx = re.compile(self._regex)
 
     ########################################################################
-    def do_handle(self, input):
+    def do_handle(self, input, position=None):
 
-        match = self._rx.match(input)
+        match = self.match_line(input, position)
         if match is not None:
-            parsed = self.parse_query(match.group('query'))
-            if parsed is not None:
+            shape = self.get_query_shape(match.group('query'))
+            if shape is not None:
                 result = OrderedDict()
-                scrubbed = self.standardize_query(parsed)
-                result['query'] = scrubbed['$query']
-                if '$orderby' in scrubbed:
-                    result['orderby'] = scrubbed['$orderby']
-                result['queryMask'] = small_json(scrubbed)
+                result['query'] = shape['query']
+                if 'orderby' in shape:
+                    result['orderby'] = shape['orderby']
+                result['queryMask'] = shape['queryMask']
                 result['ns'] = match.group('ns')
                 result['stats'] = self.parse_line_stats(match.group('stats'))
                 result['stats']['millis'] = match.group('query_time')
@@ -357,16 +672,14 @@ class UpdateQueryHandler(QueryLineHandler):
 class TimeLineHandler(QueryLineHandler):
     ########################################################################
     def __init__(self):
-        self.name = 'Standard Query Log Line Handler'
-        self._regex = '.*(?P<query_time>\d+)ms'
-        self._rx = re.compile(self._regex)
+        self.name = 'Time Line Handler'
 
     ########################################################################
-    def do_handle(self, input):
-        match = self._rx.match(input)
-        if match is not None:
+    def do_handle(self, input, position=None):
+        millis = get_line_millis(input)
+        if millis is not None:
             return {'ns': "?",
-                    'stats': {"millis": match.group('query_time')},
+                    'stats': {"millis": millis},
                     'supported': False,
                     'queryMask': None
             }
@@ -0,0 +1,463 @@
+__author__ = 'eric'
+
+import bz2
+import ctypes
+import ctypes.util
+import errno
+import glob
+import mmap
+import os
+import re
+import select
+import threading
+import zlib
+from Queue import Queue, Full
+from time import time, sleep
+from parsers import get_line_time
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+################################################################################
+# Constants
+################################################################################
+
+# Log lines without this token carry no query time, so no handler can use them
+CANDIDATE_LINE_TOKEN = 'ms'
+line_time_prefix_rx = re.compile('^(?:[a-zA-Z]{3} [a-zA-Z]{3} {1,2}\d+ \d{2}:\d{2}:\d{2}|'
+                                 '\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?'
+                                 '(?:Z|[+-]\d{2}:?\d{2})?)', re.MULTILINE)
+
+# Leading bytes of each supported compression format
+COMPRESSION_MAGIC = OrderedDict([('gzip', '\x1f\x8b'),
+                                 ('bz2', 'BZh'),
+                                 ('xz', '\xfd7zXZ\x00')])
+DECOMPRESS_CHUNK_BYTES = 1024 * 1024
+DECOMPRESS_QUEUE_CHUNKS = 16
+DECOMPRESS_QUEUE_TIMEOUT_SECONDS = 0.5
+TAIL_READ_BYTES = 1024 * 1024
+TAIL_MIN_POLL_SECONDS = 0.05
+TAIL_MAX_POLL_SECONDS = 3.0
+# inotify(7) events on a log file's directory that may mean new data to read
+INOTIFY_EVENTS = (0x00000002 |  # IN_MODIFY
+                  0x00000040 |  # IN_MOVED_FROM
+                  0x00000080 |  # IN_MOVED_TO
+                  0x00000100 |  # IN_CREATE
+                  0x00000200)   # IN_DELETE
+
+
+def expand_logfile_paths(logfile_paths):
+    """Expands a path, glob pattern or list of either into a list of paths.
+        Matches of a pattern are ordered by modification time, so rotated
+        logs are read oldest first. A pattern matching nothing is kept as
+        is, so that opening it reports the missing file"""
+    if isinstance(logfile_paths, basestring):
+        logfile_paths = [logfile_paths]
+    paths = []
+    for pattern in logfile_paths:
+        matches = glob.glob(pattern)
+        if not matches:
+            matches = [pattern]
+        for path in sorted(matches, key=_get_path_sort_key):
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def _get_path_sort_key(path):
+    try:
+        return (os.path.getmtime(path), path)
+    except OSError:
+        return (0, path)
+
+
+def get_compression(file_object):
+    """Returns the compression format of a file from its leading bytes, or
+        None for an uncompressed file. The file is left at its start"""
+    file_object.seek(0)
+    header = file_object.read(6)
+    file_object.seek(0)
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def merge_reader_stats(stats, other):
+    """Adds the counters of another reader's stats to stats"""
+    if stats['reader'] != other['reader']:
+        stats['reader'] = 'mixed'
+    for key in ['bytesRead', 'linesRead', 'linesSkipped', 'readSeconds']:
+        stats[key] += other[key]
+    _update_throughput(stats)
+
+
+def _update_throughput(stats):
+    if stats['readSeconds'] > 0:
+        stats['megabytesPerSecond'] = round(
+            stats['bytesRead'] / stats['readSeconds'] / (1024 * 1024), 2)
+
+
+################################################################################
+# LineReader
+#   Iterates the lines of a log file that begin in a byte range, keeping
+#   count of the bytes and lines read and the time spent reading them.
+################################################################################
+class LineReader(object):
+    def __init__(self, file_object, start=0, end=None):
+        self._file_object = file_object
+        self._start = start
+        self._end = end
+        self._skipped_time_range = [None, None]
+        self._bytes_read = 0
+        self._lines_read = 0
+        self._lines_skipped = 0
+        self._read_seconds = 0.0
+
+    def __iter__(self):
+        return self._read_lines()
+
+    def get_stats(self):
+        """Returns the reader's counters and throughput"""
+        stats = OrderedDict([('reader', self.name),
+                             ('bytesRead', self._bytes_read),
+                             ('linesRead', self._lines_read),
+                             ('linesSkipped', self._lines_skipped),
+                             ('readSeconds', self._read_seconds),
+                             ('megabytesPerSecond', 0.0)])
+        _update_throughput(stats)
+        return stats
+
+    def get_skipped_time_range(self):
+        """Returns the (start, end) times of the lines that were skipped
+            rather than yielded"""
+        return tuple(self._skipped_time_range)
+
+    def _read_lines(self):
+        return iter([])
+
+    def _add_skipped_time(self, line_time):
+        if line_time is None:
+            return
+        if self._skipped_time_range[0] is None or self._skipped_time_range[0] > line_time:
+            self._skipped_time_range[0] = line_time
+        if self._skipped_time_range[1] is None or self._skipped_time_range[1] < line_time:
+            self._skipped_time_range[1] = line_time
+
+
+################################################################################
+# FileLineReader
+#   Reads every line with readline()
+################################################################################
+class FileLineReader(LineReader):
+    name = 'file'
+
+    def _read_lines(self):
+        readline = self._file_object.readline
+        self._file_object.seek(self._start)
+        position = self._start
+        started = time()
+        while self._end is None or position < self._end:
+            line = readline()
+            if not line:
+                break
+            position += len(line)
+            self._bytes_read += len(line)
+            self._lines_read += 1
+            self._read_seconds += time() - started
+            yield line
+            started = time()
+        self._read_seconds += time() - started
+
+
+################################################################################
+# MmapLineReader
+#   Memory-maps the file and searches it for candidate lines, so that strings
+#   are only built for lines a handler may use. Skipped lines are counted and
+#   their times tracked, but never yielded.
+################################################################################
+class MmapLineReader(LineReader):
+    name = 'mmap'
+
+    def _read_lines(self):
+        self._file_object.seek(0, 2)
+        size = self._file_object.tell()
+        end = size if self._end is None else min(self._end, size)
+        if self._start >= end:
+            return
+
+        mapped = mmap.mmap(self._file_object.fileno(), 0, access=mmap.ACCESS_READ)
+        find = mapped.find
+        rfind = mapped.rfind
+        try:
+            position = self._start
+            started = time()
+            while position < end:
+                hit = find(CANDIDATE_LINE_TOKEN, position)
+                if hit == -1:
+                    self._skip_lines(mapped, position, end)
+                    break
+                newline = rfind('\n', position, hit)
+                line_start = position if newline == -1 else newline + 1
+                if line_start >= end:
+                    self._skip_lines(mapped, position, end)
+                    break
+                if line_start > position:
+                    self._skip_lines(mapped, position, line_start)
+
+                newline = find('\n', hit)
+                line_end = size if newline == -1 else newline + 1
+                line = mapped[line_start:line_end]
+                position = line_end
+                self._bytes_read += line_end - line_start
+                self._lines_read += 1
+                self._read_seconds += time() - started
+                yield line
+                started = time()
+            self._read_seconds += time() - started
+        finally:
+            mapped.close()
+
+    def _skip_lines(self, mapped, start, end):
+        """Counts the whole lines in [start, end) as read and skipped"""
+        line_count = mapped[start:end].count('\n')
+        if mapped[end - 1] != '\n':
+            line_count += 1
+        self._bytes_read += end - start
+        self._lines_read += line_count
+        self._lines_skipped += line_count
+        for match in line_time_prefix_rx.finditer(mapped, start, end):
+            self._add_skipped_time(get_line_time(match.group(0)))
+
+
+################################################################################
+# CompressedLineReader
+#   Reads the lines of a gzip, bz2 or xz compressed file. A thread reads and
+#   decompresses the file in chunks while lines are parsed, passing chunks
+#   through a bounded queue. zlib, bz2 and lzma release the GIL while
+#   decompressing, so decompression overlaps with parsing.
+################################################################################
+class CompressedLineReader(LineReader):
+    def __init__(self, file_object, compression):
+        LineReader.__init__(self, file_object)
+        if compression not in COMPRESSION_MAGIC:
+            raise ValueError("Unsupported compression: %s" % compression)
+        if compression == 'xz' and lzma is None:
+            raise ValueError("Reading xz compressed logs requires the lzma "
+                             "module (pip install backports.lzma)")
+        self.name = compression
+
+    def _read_lines(self):
+        chunks = Queue(DECOMPRESS_QUEUE_CHUNKS)
+        stopped = threading.Event()
+        worker = threading.Thread(target=self._decompress,
+                                  args=(chunks, stopped))
+        worker.daemon = True
+        worker.start()
+        try:
+            remainder = ''
+            started = time()
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                lines = (remainder + chunk).split('\n')
+                remainder = lines.pop()
+                self._read_seconds += time() - started
+                for line in lines:
+                    self._bytes_read += len(line) + 1
+                    self._lines_read += 1
+                    yield line + '\n'
+                started = time()
+            self._read_seconds += time() - started
+            if remainder:
+                self._bytes_read += len(remainder)
+                self._lines_read += 1
+                yield remainder
+        finally:
+            # Unblocks the thread if iteration stopped early
+            stopped.set()
+            worker.join()
+
+    def _decompress(self, chunks, stopped):
+        """Puts decompressed chunks of the file on the queue, followed by
+            None, or by the exception that ended decompression"""
+        try:
+            for chunk in self._decompress_chunks():
+                if not self._put_chunk(chunks, stopped, chunk):
+                    return
+            self._put_chunk(chunks, stopped, None)
+        except Exception, e:
+            self._put_chunk(chunks, stopped, e)
+
+    def _put_chunk(self, chunks, stopped, chunk):
+        while not stopped.is_set():
+            try:
+                chunks.put(chunk, True, DECOMPRESS_QUEUE_TIMEOUT_SECONDS)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _decompress_chunks(self):
+        """Yields the decompressed contents of the file. Concatenated
+            streams, as written by pigz, pbzip2 or appending, are each
+            decompressed in turn"""
+        read = self._file_object.read
+        decompressor = self._make_decompressor()
+        while True:
+            data = read(DECOMPRESS_CHUNK_BYTES)
+            if not data:
+                break
+            while data:
+                chunk = decompressor.decompress(data)
+                if chunk:
+                    yield chunk
+                data = decompressor.unused_data
+                if data:
+                    decompressor = self._make_decompressor()
+        if hasattr(decompressor, 'flush'):
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+
+    def _make_decompressor(self):
+        if self.name == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.name == 'bz2':
+            return bz2.BZ2Decompressor()
+        else:
+            return lzma.LZMADecompressor()
+
+
+################################################################################
+# LogFileTailer
+#   Yields the lines appended to a log file from the time it is created.
+#   Appended bytes are read in bulk. Between reads it blocks on inotify
+#   events for the file's directory where available, and otherwise polls
+#   with a backoff. It follows the path across rotation, noticed as a new
+#   inode, after reading the rest of the rotated file, and across
+#   truncation, noticed as the file shrinking below the read position.
+################################################################################
+class LogFileTailer(object):
+    def __init__(self, path, max_poll_seconds=TAIL_MAX_POLL_SECONDS):
+        self._path = path
+        self._max_poll_seconds = max_poll_seconds
+        self._file_object = open(path, 'rb')
+        self._file_object.seek(0, 2)
+        self._inode = os.fstat(self._file_object.fileno()).st_ino
+        self._inotify_fd = _make_inotify_watch(os.path.dirname(os.path.abspath(path)))
+        self.rotations = 0
+        self.truncations = 0
+
+    def __iter__(self):
+        return self._tail_lines()
+
+    def close(self):
+        if self._file_object is not None:
+            self._file_object.close()
+            self._file_object = None
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def _tail_lines(self):
+        remainder = ''
+        poll_seconds = TAIL_MIN_POLL_SECONDS
+        while self._file_object is not None:
+            data = self._file_object.read(TAIL_READ_BYTES)
+            if data:
+                lines = (remainder + data).split('\n')
+                remainder = lines.pop()
+                for line in lines:
+                    yield line + '\n'
+                poll_seconds = TAIL_MIN_POLL_SECONDS
+                continue
+
+            if self._reopen_if_rotated():
+                # the rotated file is complete, so its last line is too
+                if remainder:
+                    yield remainder
+                remainder = ''
+                continue
+            if self._rewind_if_truncated():
+                remainder = ''
+                continue
+
+            if self._inotify_fd is not None:
+                self._wait_for_inotify(self._max_poll_seconds)
+            else:
+                sleep(poll_seconds)
+                poll_seconds = min(poll_seconds * 2, self._max_poll_seconds)
+
+    def _reopen_if_rotated(self):
+        """Opens the file now at the path if it is not the one being read.
+            Returns whether it did"""
+        try:
+            inode = os.stat(self._path).st_ino
+        except OSError:
+            # rotated away, and not yet recreated
+            return False
+        if inode == self._inode:
+            return False
+        try:
+            file_object = open(self._path, 'rb')
+        except IOError:
+            return False
+        self._file_object.close()
+        self._file_object = file_object
+        self._inode = os.fstat(file_object.fileno()).st_ino
+        self.rotations += 1
+        return True
+
+    def _rewind_if_truncated(self):
+        """Reads from the start again if the file was truncated. Returns
+            whether it was"""
+        if os.fstat(self._file_object.fileno()).st_size >= self._file_object.tell():
+            return False
+        self._file_object.seek(0)
+        self.truncations += 1
+        return True
+
+    def _wait_for_inotify(self, timeout):
+        """Blocks until an event in the file's directory, or timeout"""
+        try:
+            readable = select.select([self._inotify_fd], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if readable:
+            # the events themselves are not needed, only that there were some
+            os.read(self._inotify_fd, 64 * 1024)
+
+
+def _make_inotify_watch(directory):
+    """Returns an inotify file descriptor watching a directory, or None if
+        inotify is unavailable"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        inotify_init = libc.inotify_init
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    fd = inotify_init()
+    if fd < 0:
+        return None
+    if inotify_add_watch(fd, directory, INOTIFY_EVENTS) < 0:
+        os.close(fd)
+        return None
+    return fd
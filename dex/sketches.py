@@ -0,0 +1,168 @@
+__author__ = 'eric'
+
+import calendar
+import math
+from array import array
+from datetime import datetime
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+################################################################################
+# LatencyHistogram
+#   Counts query times, in integer milliseconds, in log-linear buckets: times
+#   below 64ms each have their own bucket, and above that every power of two
+#   is split into 32 buckets, so a bucket's values are within about 3% of
+#   each other. A day's worth of milliseconds fits in under 900 buckets, so a
+#   histogram's size is bounded however many times it counts. Merging adds
+#   bucket counts, so a histogram merged from parts of a log is the same as
+#   that of the whole log.
+################################################################################
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+EXACT_BUCKET_LIMIT = 2 * SUB_BUCKET_COUNT
+
+
+def _get_bucket(millis):
+    """Returns the index of the bucket that counts millis"""
+    if millis < EXACT_BUCKET_LIMIT:
+        return millis
+    shift = millis.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift << SUB_BUCKET_BITS) + (millis >> shift)
+
+
+def _get_bucket_range(bucket):
+    """Returns the lowest value and the width of a bucket"""
+    if bucket < EXACT_BUCKET_LIMIT:
+        return bucket, 1
+    shift = (bucket >> SUB_BUCKET_BITS) - 1
+    return (bucket - (shift << SUB_BUCKET_BITS)) << shift, 1 << shift
+
+
+class LatencyHistogram(object):
+    def __init__(self):
+        self._buckets = {}
+        self._count = 0
+        self._min = None
+        self._max = None
+
+    def add(self, millis, count=1):
+        millis = max(0, int(millis))
+        bucket = _get_bucket(millis)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + count
+        self._count += count
+        if self._min is None or millis < self._min:
+            self._min = millis
+        if self._max is None or millis > self._max:
+            self._max = millis
+
+    def merge(self, other):
+        """Adds the counts of another histogram to this one"""
+        for bucket, count in other._buckets.items():
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + count
+        self._count += other._count
+        if other._min is not None and (self._min is None or other._min < self._min):
+            self._min = other._min
+        if other._max is not None and (self._max is None or other._max > self._max):
+            self._max = other._max
+
+    def get_count(self):
+        return self._count
+
+    def get_max(self):
+        return self._max
+
+    def get_quantiles(self, quantiles):
+        """Returns the values at each of a sorted list of quantiles, each
+            the middle of the bucket it falls in, within the exact minimum
+            and maximum, or None if the histogram is empty. A quantile q is
+            the smallest value that at least q * count times are at or
+            below"""
+        if self._count == 0:
+            return [None] * len(quantiles)
+        values = []
+        ranks = [max(1, int(math.ceil(quantile * self._count)))
+                 for quantile in quantiles]
+        seen = 0
+        rank_index = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            while rank_index < len(ranks) and ranks[rank_index] <= seen:
+                low, width = _get_bucket_range(bucket)
+                values.append(max(self._min, min(low + (width - 1) / 2, self._max)))
+                rank_index += 1
+            if rank_index == len(ranks):
+                break
+        return values
+
+
+################################################################################
+# TimeSeries
+#   Counts queries and totals their times in fixed intervals of time, aligned
+#   to the epoch so that the buckets of every series line up. Buckets are
+#   kept in arrays from the earliest to the latest bucket seen. With
+#   max_buckets, only that many of the latest buckets are kept, and times
+#   older than those are dropped. Since the buckets kept only ever move
+#   forward, a series merged from parts of a log is the same as that of the
+#   whole log.
+################################################################################
+def get_time_bucket(ts, interval):
+    """Returns the number of the interval-second bucket a datetime falls in"""
+    return calendar.timegm(ts.timetuple()) // interval
+
+
+class TimeSeries(object):
+    def __init__(self, interval, max_buckets=None):
+        self._interval = interval
+        self._max_buckets = max_buckets
+        self._first = None
+        self._counts = array('l')
+        self._millis = array('l')
+
+    def add(self, ts, millis, count=1):
+        self._add(get_time_bucket(ts, self._interval), count, int(millis))
+
+    def merge(self, other):
+        """Adds the buckets of another series with the same interval"""
+        for index, count in enumerate(other._counts):
+            if count > 0:
+                self._add(other._first + index, count, other._millis[index])
+
+    def get_series(self):
+        """Returns the start time of the first bucket, the interval, and the
+            count and total time of each bucket from the first to the last"""
+        start = None
+        if self._first is not None:
+            start = datetime.utcfromtimestamp(self._first * self._interval)
+        return OrderedDict([('start', start),
+                            ('intervalSeconds', self._interval),
+                            ('counts', self._counts.tolist()),
+                            ('totalTimeMillis', self._millis.tolist())])
+
+    def _add(self, bucket, count, millis):
+        if self._first is None:
+            self._first = bucket
+        if self._max_buckets is not None:
+            last = max(bucket, self._first + len(self._counts) - 1)
+            window_first = last - self._max_buckets + 1
+            if bucket < window_first:
+                return
+            if window_first > self._first:
+                drop = window_first - self._first
+                del self._counts[:drop]
+                del self._millis[:drop]
+                self._first = window_first if len(self._counts) > 0 else bucket
+        if bucket < self._first:
+            padding = array('l', [0]) * (self._first - bucket)
+            self._counts[0:0] = padding
+            self._millis[0:0] = padding
+            self._first = bucket
+        elif bucket >= self._first + len(self._counts):
+            padding = array('l', [0]) * (bucket - self._first - len(self._counts) + 1)
+            self._counts.extend(padding)
+            self._millis.extend(padding)
+        index = bucket - self._first
+        self._counts[index] += count
+        self._millis[index] += millis
@@ -0,0 +1,67 @@
+__author__ = 'eric'
+
+import gzip
+import json
+import sys
+from bson import json_util
+from datetime import datetime
+from readers import get_compression
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+################################################################################
+# Index snapshots
+#   A snapshot records the indexes and document counts of a server's
+#   collections, so that logs can be analyzed against them without a
+#   connection. It is compact JSON, gzip compressed if its name ends in .gz:
+#   {"snapshotVersion": 1,
+#    "snapshotTime": <datetime>,
+#    "databases": {<db>: {<collection>: {"count": <int>,
+#                                        "indexes": <index_information()>}}}}
+################################################################################
+SNAPSHOT_VERSION = 1
+
+
+def write_index_snapshot(databases, snapshot_path=None):
+    """Writes a snapshot of databases, as described above, to a file, or to
+        stdout if snapshot_path is None"""
+    snapshot = OrderedDict([('snapshotVersion', SNAPSHOT_VERSION),
+                            ('snapshotTime', datetime.utcnow()),
+                            ('databases', databases)])
+    content = json.dumps(snapshot, separators=(',', ':'),
+                         default=json_util.default)
+    if snapshot_path is None:
+        sys.stdout.write(content + "\n")
+    elif snapshot_path.endswith('.gz'):
+        snapshot_file = gzip.open(snapshot_path, 'wb')
+        try:
+            snapshot_file.write(content)
+        finally:
+            snapshot_file.close()
+    else:
+        with open(snapshot_path, 'wb') as snapshot_file:
+            snapshot_file.write(content)
+
+
+def read_index_snapshot(snapshot_path):
+    """Returns the databases of a snapshot file, with each index's key as
+        the list of (field, direction) tuples index_information() returns"""
+    with open(snapshot_path, 'rb') as snapshot_file:
+        if get_compression(snapshot_file) == 'gzip':
+            content = gzip.GzipFile(fileobj=snapshot_file).read()
+        else:
+            content = snapshot_file.read()
+    snapshot = json.loads(content, object_hook=json_util.object_hook)
+    if snapshot.get('snapshotVersion') != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported index snapshot version in " + snapshot_path)
+
+    databases = snapshot['databases']
+    for collections in databases.values():
+        for collection in collections.values():
+            for index in collection['indexes'].values():
+                index['key'] = [tuple(key) for key in index['key']]
+    return databases
@@ -0,0 +1,386 @@
+################################################################################
+#
+# Copyright (c) 2012 ObjectLabs Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+################################################################################
+
+import argparse
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from dex import dex
+from dex.analyzer import QueryAnalyzer, ReportAggregation
+from dex.parsers import LogParser
+from dex.utils import pretty_json, yamlfy, parse_query_literal
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+AGGREGATION_OCCURRENCE_COUNTS = [10000, 20000, 40000, 80000]
+AGGREGATION_SHAPE_RATIO = 0.25
+SEED = 1
+QUERY_PARSING_ITERATIONS = 2000
+QUERY_PARSING_SAMPLES = [
+    "{ a: 1, b: { $gt: 5 } }",
+    "{ $query: { a: \"x\", b: { $in: [ 1, 2, 3 ] } }, $orderby: { c: -1 } }",
+    "{ _id: ObjectId('51e6a1e3b1b7ea1a3c000001') }",
+    "{ count: \"bar\", query: { created: { $gte: new Date(1374000000000) } } }",
+    "{ $or: [ { a: 1 }, { b: /^abc/i } ], c: \"some string value\" }"]
+DEFAULT_LOG_LINES = 20000
+DEFAULT_LOG_SHAPES = 500
+DEFAULT_LOG_UNPARSABLE_RATIO = 0.1
+DEFAULT_LOG_OP_MIX = OrderedDict([('query', 0.5),
+                                  ('update', 0.2),
+                                  ('count', 0.1),
+                                  ('findAndModify', 0.1),
+                                  ('getmore', 0.1)])
+LOG_START_TIME = datetime(2013, 7, 17, 14, 0, 0)
+LOG_NAMESPACE_COUNT = 10
+THROUGHPUT_STAGES = ['logParser', 'queryAnalyzer', 'reportAggregation', 'endToEnd']
+
+
+################################################################################
+# Benchmarks
+#   Run with: python -m dex.test.benchmark
+################################################################################
+def make_occurrence(shape_id, millis):
+    """Builds a minimal query report as produced by QueryAnalyzer"""
+    mask = '{"$query":{"field%d":"<val>"}}' % shape_id
+    return OrderedDict([('queryMask', mask),
+                        ('indexStatus', 'none'),
+                        ('parsed', {'stats': {'millis': millis}}),
+                        ('namespace', 'bench.coll%d' % (shape_id % 10)),
+                        ('queryAnalysis', {'supported': True}),
+                        ('recommendation', None)])
+
+
+def benchmark_aggregation(occurrence_counts=AGGREGATION_OCCURRENCE_COUNTS,
+                          shape_ratio=AGGREGATION_SHAPE_RATIO):
+    """Times ReportAggregation.add_query_occurrence for growing logs, where the
+        number of distinct shapes grows with the number of occurrences"""
+    results = []
+    for occurrence_count in occurrence_counts:
+        rng = random.Random(SEED)
+        shape_count = max(1, int(occurrence_count * shape_ratio))
+        occurrences = [make_occurrence(rng.randint(0, shape_count - 1),
+                                       rng.randint(0, 1000))
+                       for i in range(occurrence_count)]
+        aggregation = ReportAggregation()
+        start = time.time()
+        for occurrence in occurrences:
+            aggregation.add_query_occurrence(occurrence)
+        aggregation.get_reports()
+        elapsed = time.time() - start
+        results.append(OrderedDict([
+            ('occurrences', occurrence_count),
+            ('shapes', len(aggregation.get_reports())),
+            ('seconds', round(elapsed, 4)),
+            ('microsPerOccurrence', round(elapsed * 1000000 / occurrence_count, 3))]))
+    return results
+
+
+def benchmark_query_parsing(iterations=QUERY_PARSING_ITERATIONS,
+                            samples=QUERY_PARSING_SAMPLES):
+    """Compares the query literal parser against the YAML loader"""
+    results = OrderedDict()
+    for name, parse in [('literal', parse_query_literal), ('yaml', yamlfy)]:
+        start = time.time()
+        for i in range(iterations):
+            for sample in samples:
+                parse(sample)
+        elapsed = time.time() - start
+        results[name] = OrderedDict([
+            ('queries', iterations * len(samples)),
+            ('seconds', round(elapsed, 4)),
+            ('queriesPerSecond', int(iterations * len(samples) / elapsed))])
+    results['speedup'] = round(results['literal']['queriesPerSecond'] /
+                               float(results['yaml']['queriesPerSecond']), 1)
+    return results
+
+
+################################################################################
+# Synthetic logs
+#   Deterministic mongod 2.x log lines. Each analyzable line is one of
+#   shape_count query shapes, with fresh values, and an operation drawn from
+#   op_mix. A unparsable_ratio fraction of lines are connection and other
+#   lines Dex cannot analyze.
+################################################################################
+def _make_shape_query(shape_id, rng):
+    """Returns the query and sort of a shape, with random values"""
+    query = '{ f%d: %d' % (shape_id, rng.randint(0, 100000))
+    if shape_id % 3 == 1:
+        query += ', g: { $gt: %d }' % rng.randint(0, 1000)
+    if shape_id % 5 == 2:
+        query += ', h: { $in: [ %d, %d ] }' % (rng.randint(0, 9), rng.randint(10, 19))
+    query += ' }'
+    sort = None
+    if shape_id % 4 == 0:
+        sort = '{ s%d: -1 }' % (shape_id % 7)
+    return query, sort
+
+
+def _make_op_line(op, shape_id, rng):
+    collection = 'coll%d' % (shape_id % LOG_NAMESPACE_COUNT)
+    query, sort = _make_shape_query(shape_id, rng)
+    millis = rng.randint(0, 2000)
+    if op == 'query':
+        if sort is not None:
+            query = '{ $query: %s, $orderby: %s }' % (query, sort)
+        return ('query bench.%s query: %s ntoreturn:0 nscanned:%d nreturned:%d '
+                'reslen:%d %dms' % (collection, query, rng.randint(1, 10000),
+                                    rng.randint(0, 100), rng.randint(20, 20000),
+                                    millis))
+    elif op == 'getmore':
+        return ('getmore bench.%s query: %s cursorid:%d ntoreturn:0 '
+                'nreturned:%d reslen:%d %dms' % (collection, query,
+                                                 rng.randint(1, 10 ** 9),
+                                                 rng.randint(0, 100),
+                                                 rng.randint(20, 20000), millis))
+    elif op == 'update':
+        return ('update bench.%s query: %s update: { $set: { u: %d } } '
+                'nscanned:%d %dms' % (collection, query, rng.randint(0, 100),
+                                      rng.randint(1, 10000), millis))
+    elif op == 'count':
+        return ('command bench.$cmd command: { count: "%s", query: %s } '
+                'ntoreturn:1 reslen:48 %dms' % (collection, query, millis))
+    elif op == 'findAndModify':
+        return ('command bench.$cmd command: { findAndModify: "%s", query: %s, '
+                'sort: %s, update: { $inc: { n: 1 } } } ntoreturn:1 %dms'
+                % (collection, query, sort or '{ _id: 1 }', millis))
+    raise ValueError("Unknown operation: " + op)
+
+
+def _make_unparsable_line(rng):
+    kind = rng.randint(0, 2)
+    if kind == 0:
+        return ('connection accepted from 127.0.0.1:%d #%d (1 connection now open)'
+                % (rng.randint(1024, 65535), rng.randint(1, 10000)))
+    elif kind == 1:
+        return 'end connection 127.0.0.1:%d (0 connections now open)' % rng.randint(1024, 65535)
+    return ('command admin.$cmd command: { serverStatus: 1 } ntoreturn:1 '
+            'reslen:2000 %dms' % rng.randint(0, 500))
+
+
+def generate_log_lines(line_count=DEFAULT_LOG_LINES,
+                       shape_count=DEFAULT_LOG_SHAPES,
+                       op_mix=DEFAULT_LOG_OP_MIX,
+                       unparsable_ratio=DEFAULT_LOG_UNPARSABLE_RATIO,
+                       seed=SEED):
+    """Yields line_count synthetic log lines, the same for the same
+        arguments"""
+    rng = random.Random(seed)
+    total_weight = float(sum(op_mix.values()))
+    cumulative = []
+    weight = 0
+    for op, op_weight in op_mix.items():
+        weight += op_weight / total_weight
+        cumulative.append((weight, op))
+    for i in range(line_count):
+        line_time = LOG_START_TIME + timedelta(milliseconds=i * 10)
+        prefix = '%s [conn%d] ' % (line_time.strftime('%a %b %d %H:%M:%S'),
+                                   rng.randint(1, 200))
+        if rng.random() < unparsable_ratio:
+            yield prefix + _make_unparsable_line(rng)
+        else:
+            choice = rng.random()
+            op = cumulative[-1][1]
+            for weight, candidate in cumulative:
+                if choice < weight:
+                    op = candidate
+                    break
+            yield prefix + _make_op_line(op, rng.randint(0, shape_count - 1), rng)
+
+
+def write_log(path, **kwargs):
+    """Writes a synthetic log, as generated by generate_log_lines, to path"""
+    with open(path, 'w') as log_file:
+        for line in generate_log_lines(**kwargs):
+            log_file.write(line + "\n")
+
+
+################################################################################
+# Throughput
+#   Each stage runs in its own process, so that its peak RSS is not that of
+#   the stages before it. The stages are fed the synthetic log, or the
+#   output of the stages before them, which are run untimed.
+################################################################################
+def _get_peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on OS X, kilobytes elsewhere
+        peak /= 1024
+    return peak / 1024.0
+
+
+def _parse_lines(lines):
+    parser = LogParser()
+    parsed_queries = []
+    for line in lines:
+        parsed = parser.parse(line, parser.get_line_time(line))
+        if parsed is not None and parsed['supported']:
+            parsed_queries.append(parsed)
+    return parsed_queries
+
+
+def _analyze_queries(parsed_queries):
+    analyzer = QueryAnalyzer(False)
+    reports = []
+    for parsed in parsed_queries:
+        db_name, collection_name = parsed['ns'].split('.', 1)
+        reports.append(analyzer.generate_query_report(None, parsed, db_name,
+                                                      collection_name))
+    return reports
+
+
+def _aggregate_reports(reports):
+    aggregation = ReportAggregation()
+    for report in reports:
+        aggregation.add_query_occurrence(report)
+    aggregation.get_reports()
+    return aggregation
+
+
+def _run_stage(args):
+    """Times one stage of the pipeline on the synthetic log described by
+        log_options"""
+    stage, log_options = args
+    lines = list(generate_log_lines(**log_options))
+    path = None
+    if stage == 'logParser':
+        work, inputs = _parse_lines, lines
+    elif stage == 'queryAnalyzer':
+        work, inputs = _analyze_queries, _parse_lines(lines)
+    elif stage == 'reportAggregation':
+        work, inputs = _aggregate_reports, _analyze_queries(_parse_lines(lines))
+    else:
+        handle, path = tempfile.mkstemp(suffix='.log')
+        os.close(handle)
+        write_log(path, **log_options)
+        work = lambda lines: (dex.Dex(None, False, [], 0, False, 0)
+                              .analyze_logfile_range(path, 0, None))
+        inputs = lines
+    try:
+        rss_before = _get_peak_rss_mb()
+        start = time.time()
+        work(inputs)
+        elapsed = time.time() - start
+        peak_rss = _get_peak_rss_mb()
+    finally:
+        if path is not None:
+            os.remove(path)
+    return OrderedDict([('lines', len(inputs)),
+                        ('seconds', round(elapsed, 4)),
+                        ('linesPerSecond', int(len(inputs) / max(elapsed, 1e-9))),
+                        ('peakRssMB', round(peak_rss, 1)),
+                        ('peakRssGrowthMB', round(peak_rss - rss_before, 1))])
+
+
+def benchmark_throughput(stages=THROUGHPUT_STAGES, **log_options):
+    """Measures lines per second and peak RSS of LogParser, QueryAnalyzer and
+        ReportAggregation separately, and of Dex reading a log file end to
+        end. 'lines' counts each stage's inputs: log lines for LogParser
+        and end to end, analyzable queries for the others"""
+    results = OrderedDict()
+    for stage in stages:
+        pool = Pool(1)
+        try:
+            results[stage] = pool.apply(_run_stage, [(stage, log_options)])
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+def _parse_op_mix(value):
+    """Parses an op mix such as query=5,update=2,count=1"""
+    op_mix = OrderedDict()
+    for item in value.split(','):
+        op, weight = item.split('=')
+        if op not in DEFAULT_LOG_OP_MIX:
+            raise argparse.ArgumentTypeError("unknown operation: " + op)
+        op_mix[op] = float(weight)
+    return op_mix
+
+
+def main(args=None):
+    arg_parser = argparse.ArgumentParser(
+        prog='python -m dex.test.benchmark',
+        description="Benchmarks Dex on a synthetic log and writes the results "
+                    "as JSON.")
+    arg_parser.add_argument('--lines', type=int, default=DEFAULT_LOG_LINES,
+                            help="synthetic log lines. Default %(default)s")
+    arg_parser.add_argument('--shapes', type=int, default=DEFAULT_LOG_SHAPES,
+                            help="distinct query shapes. Default %(default)s")
+    arg_parser.add_argument('--unparsable', type=float,
+                            default=DEFAULT_LOG_UNPARSABLE_RATIO,
+                            help="fraction of lines Dex cannot analyze. "
+                                 "Default %(default)s")
+    arg_parser.add_argument('--mix', type=_parse_op_mix,
+                            default=DEFAULT_LOG_OP_MIX,
+                            help="relative weights of query, update, count, "
+                                 "findAndModify and getmore lines, e.g. "
+                                 "query=5,update=2,count=1")
+    arg_parser.add_argument('--seed', type=int, default=SEED)
+    arg_parser.add_argument('--generate', metavar='LOG_PATH',
+                            help="only write the synthetic log to LOG_PATH")
+    arg_parser.add_argument('-o', '--output', metavar='RESULTS_PATH',
+                            help="file to write the results to. Default is "
+                                 "standard output")
+    options = arg_parser.parse_args(args)
+    log_options = {'line_count': options.lines,
+                   'shape_count': options.shapes,
+                   'op_mix': options.mix,
+                   'unparsable_ratio': options.unparsable,
+                   'seed': options.seed}
+
+    if options.generate is not None:
+        write_log(options.generate, **log_options)
+        return 0
+
+    output = OrderedDict([
+        ('benchmarkTime', datetime.utcnow()),
+        ('environment', OrderedDict([('python', platform.python_version()),
+                                     ('platform', platform.platform())])),
+        ('log', OrderedDict([('lines', options.lines),
+                             ('shapes', options.shapes),
+                             ('opMix', options.mix),
+                             ('unparsableRatio', options.unparsable),
+                             ('seed', options.seed)])),
+        ('throughput', benchmark_throughput(**log_options)),
+        ('aggregation', benchmark_aggregation()),
+        ('queryParsing', benchmark_query_parsing())])
+    if options.output is None:
+        sys.stdout.write(pretty_json(output) + "\n")
+    else:
+        with open(options.output, 'w') as results_file:
+            results_file.write(pretty_json(output) + "\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
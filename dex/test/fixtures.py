@@ -0,0 +1,201 @@
+################################################################################
+#
+# Copyright (c) 2012 ObjectLabs Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+################################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+import pymongo
+from dex.parsers import Parser, QueryLineHandler, small_json, scrub
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+################################################################################
+# Shared test data and helpers
+################################################################################
+TEST_URI = "mongodb://localhost:27017"
+TEST_DBNAME = "dex_test"
+TEST_COLLECTION = "test_collection"
+TEST_LOG_LINES = [
+    "Wed Jul 17 14:52:37 [initandlisten] connection accepted from 127.0.0.1:50000 #12 (1 connection now open)",
+    "Wed Jul 17 14:52:37 [conn12] query test.foo query: { a: 1, b: { $gt: 5 } } ntoreturn:0 nscanned:1 nreturned:1 reslen:48 120ms",
+    "Wed Jul 17 14:52:38 [conn12] query test.foo query: { $query: { a: \"x\" }, $orderby: { b: -1 } } nscanned:10 nreturned:1 220ms",
+    "Wed Jul 17 14:52:38 [conn12] getmore test.foo query: { a: 5 } cursorid:123456 ntoreturn:0 nreturned:10 reslen:480 15ms",
+    "Wed Jul 17 14:52:39 [conn13] update test.bar query: { _id: ObjectId('51e6a1e3b1b7ea1a3c000001') } update: { $set: { c: 2 } } nscanned:1 140ms",
+    "Wed Jul 17 14:52:39 [conn13] command test.$cmd command: { count: \"bar\", query: { c: { $in: [ 1, 2, 3 ] } } } ntoreturn:1 reslen:48 300ms",
+    "Wed Jul 17 14:52:40 [conn13] command test.$cmd command: { findAndModify: \"bar\", query: { d: 1 }, sort: { e: 1 }, update: { $inc: { f: 1 } } } ntoreturn:1 310ms",
+    "Wed Jul 17 14:52:40 [conn13] command admin.$cmd command: { serverStatus: 1 } ntoreturn:1 reslen:2000 105ms",
+    "Wed Jul 17 14:52:41 [conn14] remove test.baz query: { g: 1 } ndeleted:1 keyUpdates:0 120ms",
+    "Wed Jul 17 14:52:41 [conn14] insert test.baz ninserted:1 keyUpdates:0 112ms",
+    "Wed Jul 17 14:52:43 [conn15] end connection 127.0.0.1:50000 (0 connections now open)"]
+
+
+def make_occurrence(namespace, mask, millis):
+    """Returns a query report as QueryAnalyzer generates them, as far as
+        ReportAggregation reads it"""
+    return OrderedDict([('queryMask', mask),
+                        ('indexStatus', 'none'),
+                        ('parsed', {'stats': {'millis': millis}}),
+                        ('namespace', namespace),
+                        ('queryAnalysis', {'supported': True}),
+                        ('recommendation', None)])
+
+
+class TempDirTestCase(unittest.TestCase):
+    """Gives each test a temporary directory, removed with everything in it
+        after the test"""
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='dex_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_temp_path(self, name):
+        return os.path.join(self.temp_dir, name)
+
+    def write_test_log(self, repeat, name='mongodb.log'):
+        """Writes TEST_LOG_LINES repeat times to a log in the temporary
+            directory, and returns its path"""
+        path = self.get_temp_path(name)
+        with open(path, 'w') as obj:
+            for i in range(repeat):
+                for line in TEST_LOG_LINES:
+                    obj.write(line + "\n")
+        return path
+
+
+################################################################################
+# Fakes of the pymongo objects Dex reads from
+################################################################################
+class FakeIndexConnection(object):
+    """Serves the same indexes for every collection, counting fetches"""
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self.fail = False
+        self.fetches = 0
+
+    def __getitem__(self, name):
+        return self
+
+    def index_information(self):
+        self.fetches += 1
+        if self.fail:
+            raise pymongo.errors.ConnectionFailure('unreachable')
+        return dict(self.indexes)
+
+
+class FakeProfileCursor(object):
+    """A tailable cursor that dies once it has returned every entry"""
+    def __init__(self, entries):
+        self._entries = entries
+        self.alive = True
+
+    def __iter__(self):
+        for entry in self._entries:
+            yield entry
+        self.alive = False
+
+    def count(self):
+        return len(self._entries)
+
+
+class FakeProfileCollection(object):
+    """A system.profile collection supporting the queries Dex tails with.
+        Each tailable find adds the next burst of entries, all of op"""
+    def __init__(self, timestamps, bursts, op='query'):
+        self._entries = []
+        self._bursts = list(bursts)
+        self._op = op
+        self._add_entries(timestamps)
+
+    def _add_entries(self, timestamps):
+        for ts in timestamps:
+            self._entries.append(OrderedDict([('op', self._op),
+                                              ('ts', ts),
+                                              ('seq', len(self._entries))]))
+
+    def _matches_op(self, entry, query):
+        """Whether the entry's op is one of those the query's clauses allow"""
+        for clause in query.get('$or', [{'op': entry['op']}]):
+            op = clause['op']
+            if entry['op'] in (op['$in'] if isinstance(op, dict) else [op]):
+                return True
+        return False
+
+    def find_one(self, sort=None):
+        return self._entries[-1] if self._entries else None
+
+    def find(self, query, fields, tailable=False, await_data=False):
+        if tailable and self._bursts:
+            self._add_entries(self._bursts.pop(0))
+        ts = query.get('ts')
+        if isinstance(ts, dict):
+            entries = [entry for entry in self._entries if entry['ts'] >= ts['$gte']]
+        elif ts is not None:
+            entries = [entry for entry in self._entries if entry['ts'] == ts]
+        else:
+            entries = list(self._entries)
+        return FakeProfileCursor([entry for entry in entries
+                                  if self._matches_op(entry, query)])
+
+
+class FakeProfileDb(object):
+    name = 'db'
+
+    def __init__(self, profile):
+        self._profile = profile
+
+    def __getitem__(self, collection_name):
+        return self._profile
+
+
+################################################################################
+# A parser of bare queries, on the test collection
+################################################################################
+class TestParser(Parser):
+    def __init__(self):
+        """Declares the QueryLineHandlers to use"""
+        super(TestParser, self).__init__([self.TestHandler()])
+
+    ############################################################################
+    # Base QueryLineHandler class
+    #   Knows how to yamlfy a logline query
+    ############################################################################
+    class TestHandler(QueryLineHandler):
+        ########################################################################
+        def handle(self, input):
+            parsed = self.parse_query(input)
+            result = OrderedDict()
+            if parsed is not None:
+                scrubbed = scrub(parsed)
+                result['query'] = scrubbed['$query']
+                if '$orderby' in scrubbed:
+                    result['orderby'] = scrubbed['$orderby']
+                result['ns'] = TEST_DBNAME + "." + TEST_COLLECTION
+                result['stats'] = {}
+                result['stats']['millis'] = 500
+                result['queryMask'] = small_json(scrubbed)
+                return result
@@ -23,9 +23,25 @@
 ################################################################################
 
 import unittest
-from test_dex import test_dex
+from test_dex import test_dex, test_dex_offline
+from test_analyzer import test_query_analyzer, test_report_aggregation
+from test_namespaces import test_namespaces
+from test_parsers import test_parsers
+from test_readers import test_readers
+from test_sketches import test_sketches
+from test_snapshot import test_snapshot
+from test_utils import test_utils
 
-all_suites = [ unittest.TestLoader().loadTestsFromTestCase(test_dex) ]
+all_suites = [ unittest.TestLoader().loadTestsFromTestCase(test_dex),
+               unittest.TestLoader().loadTestsFromTestCase(test_dex_offline),
+               unittest.TestLoader().loadTestsFromTestCase(test_query_analyzer),
+               unittest.TestLoader().loadTestsFromTestCase(test_report_aggregation),
+               unittest.TestLoader().loadTestsFromTestCase(test_namespaces),
+               unittest.TestLoader().loadTestsFromTestCase(test_parsers),
+               unittest.TestLoader().loadTestsFromTestCase(test_readers),
+               unittest.TestLoader().loadTestsFromTestCase(test_sketches),
+               unittest.TestLoader().loadTestsFromTestCase(test_snapshot),
+               unittest.TestLoader().loadTestsFromTestCase(test_utils) ]
 
 if __name__ == '__main__':
     unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(all_suites))
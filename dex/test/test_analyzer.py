@@ -0,0 +1,263 @@
+################################################################################
+#
+# Copyright (c) 2012 ObjectLabs Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+################################################################################
+
+import unittest
+import random
+import time
+from datetime import datetime, timedelta
+from dex.analyzer import QueryAnalyzer, ReportAggregation
+from dex.sketches import LatencyHistogram
+from dex.test.fixtures import TEST_URI, TEST_DBNAME, TEST_COLLECTION
+from dex.test.fixtures import FakeIndexConnection, TestParser, make_occurrence
+
+
+class test_query_analyzer(unittest.TestCase):
+    def setUp(self):
+        self.analyzer = QueryAnalyzer(True)
+        self.parser = TestParser()
+
+    def _generate_report(self, query):
+        return self.analyzer.generate_query_report(TEST_URI,
+                                                   self.parser.parse(query),
+                                                   TEST_DBNAME,
+                                                   TEST_COLLECTION)
+
+    def test_analysis_cache(self):
+        self.analyzer.get_cache()[TEST_DBNAME] = {TEST_COLLECTION: {'indexes': {}}}
+        first = self._generate_report("{ $query: { a: 1 } }")
+        second = self._generate_report("{ $query: { a: 2 } }")
+        self.assertEqual(first['recommendation']['index'], '{"a": 1}')
+        self.assertTrue(second['queryAnalysis'] is first['queryAnalysis'])
+        self.assertTrue(second['parsed'] is not first['parsed'])
+
+        # new index information for the collection invalidates the analysis
+        self.analyzer.get_cache()[TEST_DBNAME][TEST_COLLECTION] = \
+            {'indexes': {'a_1': {'key': [('a', 1)], 'v': 1}}}
+        third = self._generate_report("{ $query: { a: 3 } }")
+        self.assertEqual(third['recommendation'], None)
+        self.assertEqual(third['indexStatus'], 'full')
+
+        stats = self.analyzer.get_analysis_cache_stats()
+        self.assertEqual([stats['hits'], stats['misses'], stats['entries']], [1, 2, 1])
+
+    def test_analysis_cache_eviction(self):
+        analyzer = QueryAnalyzer(True, max_analyses=2)
+        analyzer.get_cache()[TEST_DBNAME] = {TEST_COLLECTION: {'indexes': {}}}
+        queries = ["{ $query: { a: 1 } }", "{ $query: { b: 1 } }",
+                   "{ $query: { a: 2 } }", "{ $query: { c: 1 } }",
+                   "{ $query: { a: 3 } }"]
+        for query in queries:
+            analyzer.generate_query_report(TEST_URI, self.parser.parse(query),
+                                           TEST_DBNAME, TEST_COLLECTION)
+        # the least recently used shape, b, is evicted for c, so a is reused
+        stats = analyzer.get_analysis_cache_stats()
+        self.assertEqual([stats['hits'], stats['misses'], stats['evictions']], [2, 3, 1])
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(len(analyzer._analysis_cache), 2)
+
+    def test_index_cache_expiry(self):
+        analyzer = self.analyzer
+        connection = FakeIndexConnection({'a_1': {'key': [('a', 1)], 'v': 1}})
+        analyzer._index_cache_connection = connection
+        query = self.parser.parse("{ $query: { a: 1 } }")
+
+        # failures are cached, and retried after a doubling backoff
+        connection.fail = True
+        self.assertEqual(analyzer.generate_query_report(TEST_URI, query, TEST_DBNAME,
+                                                        TEST_COLLECTION), None)
+        self.assertEqual(analyzer.generate_query_report(TEST_URI, query, TEST_DBNAME,
+                                                        TEST_COLLECTION), None)
+        self.assertEqual(connection.fetches, 1)
+        entry = analyzer.get_cache()[TEST_DBNAME][TEST_COLLECTION]
+        entry['expireTime'] = 0
+        analyzer.generate_query_report(TEST_URI, query, TEST_DBNAME, TEST_COLLECTION)
+        entry = analyzer.get_cache()[TEST_DBNAME][TEST_COLLECTION]
+        self.assertEqual(connection.fetches, 2)
+        self.assertEqual(entry['failures'], 2)
+        self.assertTrue(entry['expireTime'] - time.time() > 30)
+
+        # fetched indexes are refetched after the TTL, keeping their identity
+        connection.fail = False
+        analyzer.set_index_cache_ttl(60)
+        entry['expireTime'] = 0
+        report = analyzer.generate_query_report(TEST_URI, query, TEST_DBNAME,
+                                                TEST_COLLECTION)
+        self.assertEqual(report['indexStatus'], 'full')
+        indexes = analyzer.get_cache()[TEST_DBNAME][TEST_COLLECTION]['indexes']
+        analyzer.get_cache()[TEST_DBNAME][TEST_COLLECTION]['expireTime'] = 0
+        analyzer.generate_query_report(TEST_URI, query, TEST_DBNAME, TEST_COLLECTION)
+        self.assertEqual(connection.fetches, 4)
+        self.assertTrue(analyzer.get_cache()[TEST_DBNAME][TEST_COLLECTION]['indexes'] is indexes)
+
+        analyzer.prefetch_index_cache(TEST_URI, [(TEST_DBNAME, TEST_COLLECTION),
+                                                 (TEST_DBNAME, 'other1'),
+                                                 (TEST_DBNAME, 'other2')], 2)
+        self.assertEqual(connection.fetches, 6)
+        self.assertEqual(sorted(analyzer.get_cached_indexes()[TEST_DBNAME].keys()),
+                         sorted([TEST_COLLECTION, 'other1', 'other2']))
+
+
+class test_report_aggregation(unittest.TestCase):
+    def test_keyed_merge(self):
+        aggregation = ReportAggregation()
+        aggregation.add_query_occurrence(make_occurrence('db.a', '{"a":1}', 10))
+        aggregation.add_query_occurrence(make_occurrence('db.b', '{"a":1}', 20))
+        aggregation.add_query_occurrence(make_occurrence('db.a', '{"a":1}', 30))
+        aggregation.add_query_occurrence(make_occurrence('db.a', '{"b":1}', 5))
+
+        reports = aggregation.get_reports()
+        self.assertEqual(len(reports), 3)
+        self.assertEqual(reports[0]['namespace'], 'db.a')
+        self.assertEqual(reports[0]['stats']['count'], 2)
+        self.assertEqual(reports[0]['stats']['totalTimeMillis'], 40)
+        self.assertEqual(reports[0]['stats']['avgTimeMillis'], 20)
+        self.assertEqual(reports[1]['namespace'], 'db.b')
+
+        top = aggregation.get_reports(limit=2)
+        self.assertEqual(top, reports[:2])
+
+    def test_changed_reports(self):
+        aggregation = ReportAggregation()
+        aggregation.track_changes()
+        for namespace, millis in [('db.a', 10), ('db.b', 20), ('db.c', 30)]:
+            aggregation.add_query_occurrence(make_occurrence(namespace, '{"a":1}', millis))
+        changed = aggregation.get_changed_reports(2)
+        self.assertEqual([(rank, report['namespace']) for rank, report in changed],
+                         [(1, 'db.c'), (2, 'db.b')])
+        self.assertEqual(aggregation.get_changed_reports(2), [])
+
+        # db.a overtakes db.b, which drops out of the top without changing
+        aggregation.add_query_occurrence(make_occurrence('db.a', '{"a":1}', 15))
+        changed = aggregation.get_changed_reports(2)
+        self.assertEqual([(rank, report['namespace']) for rank, report in changed],
+                         [(2, 'db.a')])
+
+        other = ReportAggregation()
+        other.add_query_occurrence(make_occurrence('db.b', '{"a":1}', 100))
+        aggregation.merge(other)
+        changed = aggregation.get_changed_reports(2)
+        self.assertEqual([(rank, report['namespace']) for rank, report in changed],
+                         [(1, 'db.b')])
+        self.assertEqual([report['namespace'] for report in aggregation.get_reports(2)],
+                         ['db.b', 'db.c'])
+
+    def test_changed_reports_replaced(self):
+        aggregation = ReportAggregation(max_reports=3)
+        aggregation.track_changes()
+        for namespace, millis in [('db.a', 100), ('db.b', 60), ('db.c', 50)]:
+            aggregation.add_query_occurrence(make_occurrence(namespace, '{"a":1}', millis))
+        changed = aggregation.get_changed_reports(2)
+        self.assertEqual([(rank, report['namespace']) for rank, report in changed],
+                         [(1, 'db.a'), (2, 'db.b')])
+        # db.x replaces db.c, taking its time as error, but ranks third
+        aggregation.add_query_occurrence(make_occurrence('db.x', '{"a":1}', 20))
+        self.assertEqual(aggregation.get_changed_reports(2), [])
+
+        # db.y replaces db.b from the top, and the unchanged db.x takes its place
+        aggregation.add_query_occurrence(make_occurrence('db.y', '{"a":1}', 1))
+        changed = aggregation.get_changed_reports(2)
+        self.assertEqual([(rank, report['namespace']) for rank, report in changed],
+                         [(2, 'db.x')])
+        self.assertEqual([report['namespace'] for report in aggregation.get_reports(2)],
+                         ['db.a', 'db.x'])
+        self.assertEqual(aggregation.get_changed_reports(2), [])
+
+    def test_percentiles(self):
+        rng = random.Random(1)
+        times = [int(rng.expovariate(1 / 200.0)) for i in range(5000)]
+        histogram = LatencyHistogram()
+        aggregations = [ReportAggregation(), ReportAggregation(), ReportAggregation()]
+        for i, millis in enumerate(times):
+            histogram.add(millis)
+            occurrence = make_occurrence('db.a', '{"a":1}', millis)
+            aggregations[0].add_query_occurrence(occurrence)
+            aggregations[1 + i % 2].add_query_occurrence(occurrence)
+        aggregations[1].merge(aggregations[2])
+        stats = aggregations[0].get_reports()[0]['stats']
+        self.assertEqual(aggregations[1].get_reports()[0]['stats'], stats)
+        self.assertEqual([stats['p50TimeMillis'], stats['p95TimeMillis'],
+                          stats['p99TimeMillis']],
+                         histogram.get_quantiles([0.5, 0.95, 0.99]))
+        self.assertEqual(stats['maxTimeMillis'], max(times))
+
+    def test_series(self):
+        start = datetime(2013, 7, 17, 14, 0, 0)
+        rng = random.Random(2)
+        entries = [(start + timedelta(seconds=rng.randint(0, 600)), rng.randint(0, 100))
+                   for i in range(500)]
+        aggregation = ReportAggregation(300, None)
+        for ts, millis in entries:
+            occurrence = make_occurrence('db.a', '{"a":1}', millis)
+            occurrence['parsed']['ts'] = ts
+            aggregation.add_query_occurrence(occurrence)
+        report_series = aggregation.get_reports()[0]['series']
+        self.assertEqual(report_series['intervalSeconds'], 300)
+        self.assertEqual(sum(report_series['counts']), len(entries))
+        self.assertEqual(sum(report_series['totalTimeMillis']),
+                         sum(millis for ts, millis in entries))
+
+    def test_limited_reports(self):
+        rng = random.Random(3)
+        occurrences = []
+        for i in range(4000):
+            if i % 4 == 0:
+                occurrences.append(('db.heavy', '{"h":%d}' % (i % 5), 500))
+            else:
+                occurrences.append(('db.light', '{"l%d":1}' % i, rng.randint(1, 50)))
+        totals = {}
+        for namespace, mask, millis in occurrences:
+            totals[(namespace, mask)] = totals.get((namespace, mask), 0) + millis
+
+        whole = ReportAggregation(max_reports=20)
+        parts = [ReportAggregation(max_reports=20), ReportAggregation(max_reports=20)]
+        for i, (namespace, mask, millis) in enumerate(occurrences):
+            occurrence = make_occurrence(namespace, mask, millis)
+            whole.add_query_occurrence(occurrence)
+            parts[i * 2 / len(occurrences)].add_query_occurrence(occurrence)
+        parts[0].merge(parts[1])
+
+        for aggregation in [whole, parts[0]]:
+            reports = aggregation.get_reports()
+            stats = aggregation.get_stats()
+            self.assertEqual(len(reports), 20)
+            self.assertEqual(stats['reports'], 20)
+            self.assertEqual(stats['reportsReplaced'],
+                             sum(replaced['reports'] for replaced in stats['replacedReports']))
+            self.assertEqual(sorted(report['queryMask'] for report in reports[:5]),
+                             ['{"h":%d}' % i for i in range(5)])
+            # counted and replaced time add up to the whole log's
+            self.assertEqual(sum(report['stats']['totalTimeMillis'] for report in reports) +
+                             sum(replaced['totalTimeMillis'] for replaced in stats['replacedReports']),
+                             sum(totals.values()))
+            for report in reports:
+                total = totals[(report['namespace'], report['queryMask'])]
+                self.assertTrue(report['stats']['totalTimeMillis'] <= total)
+                self.assertTrue(total <= report['stats']['totalTimeMillis'] +
+                                report['stats']['maxUncountedTimeMillis'])
+            # any pattern not kept took at most maxUncountedTimeMillis
+            kept = set((report['namespace'], report['queryMask']) for report in reports)
+            self.assertTrue(max(total for key, total in totals.items() if key not in kept) <=
+                            stats['maxUncountedTimeMillis'])
+
+        self.assertEqual(ReportAggregation().get_stats(), None)
@@ -27,17 +27,19 @@ import pymongo
 import yaml
 import sys
 from dex import dex
-from dex.parsers import Parser, QueryLineHandler, small_json, scrub
 from dex.utils import pretty_json
+from dex.test.fixtures import TEST_URI, TEST_DBNAME, TEST_COLLECTION, TEST_LOG_LINES
+from dex.test.fixtures import FakeProfileCollection, FakeProfileDb, TempDirTestCase, TestParser
 import os
+import itertools
+import gzip
+from StringIO import StringIO
+import time
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
 
-TEST_URI = "mongodb://localhost:27017"
-TEST_DBNAME = "dex_test"
-TEST_COLLECTION = "test_collection"
 TEST_LOGFILE = os.path.dirname(__file__) + "/whitebox.log"
 
 
@@ -371,27 +373,270 @@ class test_dex(unittest.TestCase):
         unittest.main()
 
 
-class TestParser(Parser):
-    def __init__(self):
-        """Declares the QueryLineHandlers to use"""
-        super(TestParser, self).__init__([self.TestHandler()])
-
-    ############################################################################
-    # Base QueryLineHandler class
-    #   Knows how to yamlfy a logline query
-    ############################################################################
-    class TestHandler(QueryLineHandler):
-        ########################################################################
-        def handle(self, input):
-            parsed = self.parse_query(input)
-            result = OrderedDict()
-            if parsed is not None:
-                scrubbed = scrub(parsed)
-                result['query'] = scrubbed['$query']
-                if '$orderby' in scrubbed:
-                    result['orderby'] = scrubbed['$orderby']
-                result['ns'] = TEST_DBNAME + "." + TEST_COLLECTION
-                result['stats'] = {}
-                result['stats']['millis'] = 500
-                result['queryMask'] = small_json(scrubbed)
-                return result
\ No newline at end of file
+class test_dex_offline(TempDirTestCase):
+    """Tests of Dex runs that do not require a running database"""
+
+    def test_profile_query(self):
+        test_dex = dex.Dex(None, False, [], 100, False, 0)
+        profile_query = test_dex._get_profile_query('db1')
+        self.assertEqual(profile_query['millis'], {'$gte': 100})
+        self.assertEqual(profile_query['$or'],
+                         [{'op': {'$in': ['query', 'update']}},
+                          {'op': 'command', 'command.count': {'$exists': True}},
+                          {'op': 'command', 'command.findAndModify': {'$exists': True}}])
+
+        test_dex = dex.Dex(None, False, ['db1.coll1', '*.coll2', 'db2.*'], 0, False, 0)
+        profile_query = test_dex._get_profile_query('db1')
+        self.assertFalse('millis' in profile_query)
+        self.assertEqual(profile_query['$or'],
+                         [{'op': {'$in': ['query', 'update']},
+                           'ns': {'$in': ['db1.coll1', 'db1.coll2']}},
+                          {'op': 'command', 'command.count': {'$in': ['coll1', 'coll2']}},
+                          {'op': 'command', 'command.findAndModify': {'$in': ['coll1', 'coll2']}}])
+        self.assertEqual(test_dex._get_requested_collections('db2'), None)
+        self.assertEqual(test_dex._get_requested_collections('db3'), ['coll2'])
+
+    def test_scan_profiles_order(self):
+        test_dex = dex.Dex(None, False, [], 0, False, 0, concurrency=3)
+        delays = [0.05, 0.0, 0.02, 0.0, 0.04, 0.01, 0.0]
+        def read_profile(connection, database):
+            time.sleep(delays[database])
+            return database, [{'op': 'query', 'ns': 'db%d.coll' % database}]
+        test_dex._read_profile = read_profile
+        scanned = [database for database, profile_entries
+                   in test_dex._scan_profiles(None, range(len(delays)))]
+        self.assertEqual(scanned, range(len(delays)))
+
+    def test_tail_profile(self):
+        # entries arrive in bursts, and the cursor dies after each burst
+        profile = FakeProfileCollection([0, 0], [[1, 2, 2], [2, 3], [3, 3, 4]])
+        test_dex = dex.Dex(None, False, [], 0, False, 0)
+        tailed = list(itertools.islice(
+            test_dex._tail_profile(FakeProfileDb(profile), 0), 8))
+        self.assertEqual([doc['ts'] for doc in tailed], [1, 2, 2, 2, 3, 3, 3, 4])
+        self.assertEqual([doc['seq'] for doc in tailed], range(2, 10))
+
+    def _tail_with_waits(self, profile, count):
+        """Tails profile until its tailable cursor has been reopened count
+            times, returning the ts of the entries yielded and the waits
+            between reopens"""
+        waits = []
+        def sleep(seconds):
+            waits.append(seconds)
+            if len(waits) == count:
+                # ends the tailing generator
+                raise StopIteration
+        test_dex = dex.Dex(None, False, [], 0, False, 0)
+        original_sleep = dex.time.sleep
+        dex.time.sleep = sleep
+        try:
+            tailed = list(test_dex._tail_profile(FakeProfileDb(profile), 0.5, 4))
+        finally:
+            dex.time.sleep = original_sleep
+        return [doc['ts'] for doc in tailed], waits
+
+    def test_tail_profile_backoff(self):
+        # an empty collection, and one whose entries do not match
+        for profile in [FakeProfileCollection([], []),
+                        FakeProfileCollection([1, 2], [[3], [4]], op='insert')]:
+            self.assertEqual(self._tail_with_waits(profile, 6),
+                             ([], [0.5, 1, 2, 4, 4, 4]))
+        # new entries restart the backoff
+        self.assertEqual(self._tail_with_waits(FakeProfileCollection([], [[], [], [1]]), 6),
+                         ([1], [0.5, 1, 0.5, 1, 2, 4]))
+
+    def _strip_run_timings(self, run_stats):
+        """Removes the run stats that legitimately differ between runs"""
+        del run_stats['dexTime']
+        del run_stats['parserStats']['queryShapeCache']
+        del run_stats['analysisCache']
+        for reader_stats in ([run_stats['readerStats']] +
+                             [source['readerStats'] for source in run_stats['sources']]):
+            del reader_stats['readSeconds']
+            del reader_stats['megabytesPerSecond']
+
+    def test_parallel_logfile_analysis(self):
+        path = self.write_test_log(50)
+        serial = dex.Dex(None, False, [], 0, False, 0)
+        serial.analyze_logfile_range(path, 0, None)
+        parallel = dex.Dex(None, False, [], 0, False, 0, jobs=3)
+        self.assertEqual(len(parallel._get_logfile_ranges(path, 3)), 3)
+        parallel._analyze_logfile_parallel([(path, 0, None)])
+
+        # timings and per-process cache counters legitimately differ
+        for run_stats in [serial._run_stats, parallel._run_stats]:
+            self._strip_run_timings(run_stats)
+        self.assertEqual(pretty_json(serial._make_aggregated_report()),
+                         pretty_json(parallel._make_aggregated_report()))
+        self.assertEqual(parallel._run_stats['linesRead'], 50 * len(TEST_LOG_LINES))
+
+    def test_filtered_lines(self):
+        path = self.write_test_log(2)
+        whole = dex.Dex(None, False, [], 0, False, 0)
+        whole.analyze_logfile_range(path, 0, None)
+        self.assertEqual(whole._run_stats['filteredLineInfo']['filteredLines'], 0)
+        filtered = dex.Dex(None, False, ['test.bar'], 150, False, 0)
+        filtered.analyze_logfile_range(path, 0, None)
+
+        # lines are filtered before their queries are parsed, and only
+        # the reports of lines passing both filters remain
+        self.assertEqual(filtered._run_stats['linesRead'], whole._run_stats['linesRead'])
+        self.assertEqual(filtered._run_stats['timeRange'], whole._run_stats['timeRange'])
+        self.assertEqual(filtered._run_stats['filteredLineInfo'],
+                         OrderedDict([('filteredLines', 14),
+                                      ('belowSlowms', 12),
+                                      ('otherNamespaces', 2)]))
+        self.assertEqual(filtered._run_stats['sources'][0]['filteredLines'], 14)
+        self.assertEqual(filtered._run_stats['linesAnalyzed'], 4)
+        # filtered lines are not parsed, so they count as neither analyzed
+        # nor unparsable
+        self.assertEqual(filtered._run_stats['linesAnalyzed'] +
+                         filtered._run_stats['unparsableLineInfo']['unparsableLines'] +
+                         filtered._run_stats['filteredLineInfo']['filteredLines'],
+                         filtered._run_stats['linesRead'])
+        self.assertEqual([(report['queryMask'], report['stats']['count'])
+                          for report in filtered._report.get_reports()],
+                         [(report['queryMask'], report['stats']['count'])
+                          for report in whole._report.get_reports()
+                          if report['namespace'] == 'test.bar' and
+                          report['stats']['totalTimeMillis'] >= 150 * 2])
+
+    def test_limited_patterns_analysis_cache(self):
+        path = self.get_temp_path('shapes.log')
+        with open(path, 'w') as obj:
+            for i in range(500):
+                obj.write("Wed Jul 17 14:52:37 [conn12] query test.foo query: "
+                          "{ field%d: 1 } nreturned:1 %dms\n" % (i, 100 + i % 7))
+        test_dex = dex.Dex(None, False, [], 0, False, 0, max_patterns=10)
+        test_dex.analyze_logfile_range(path, 0, None)
+        self.assertEqual(len(test_dex._report.get_reports()), 10)
+        # the analysis cache is bounded by the kept patterns, not the shapes seen
+        cache_stats = test_dex._run_stats['analysisCache']
+        self.assertEqual(cache_stats['misses'], 500)
+        self.assertEqual(cache_stats['maxEntries'], 10)
+        self.assertEqual(cache_stats['entries'], 10)
+        self.assertEqual(len(test_dex._query_analyzer._analysis_cache), 10)
+
+    def _analyze_logfile_quietly(self, test_dex, path):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            test_dex.analyze_logfile(path)
+        finally:
+            sys.stdout = stdout
+
+    def test_state_file(self):
+        path = self.write_test_log(10)
+        state_path = self.get_temp_path('dex.state')
+        # the last line is still being written
+        with open(path, 'a') as obj:
+            obj.write(TEST_LOG_LINES[1][:40])
+        first = dex.Dex(None, False, [], 0, False, 0, state_path=state_path)
+        self._analyze_logfile_quietly(first, path)
+        self.assertEqual(first._run_stats['linesRead'], 10 * len(TEST_LOG_LINES))
+
+        with open(path, 'a') as obj:
+            obj.write(TEST_LOG_LINES[1][40:] + "\n")
+            for line in TEST_LOG_LINES:
+                obj.write(line + "\n")
+        second = dex.Dex(None, False, [], 0, False, 0, state_path=state_path)
+        self._analyze_logfile_quietly(second, path)
+        whole = dex.Dex(None, False, [], 0, False, 0)
+        whole.analyze_logfile_range(path, 0, None)
+        self.assertEqual(second._run_stats['linesRead'], whole._run_stats['linesRead'])
+        self.assertEqual(second._run_stats['timeRange'], whole._run_stats['timeRange'])
+        self.assertEqual([(report['queryMask'], report['stats']['count'])
+                          for report in second._report.get_reports()],
+                         [(report['queryMask'], report['stats']['count'])
+                          for report in whole._report.get_reports()])
+
+        # a rotated log's last lines are read from where it was renamed to,
+        # and the new log from its start
+        with open(path, 'a') as obj:
+            obj.write(TEST_LOG_LINES[2] + "\n")
+        os.rename(path, path + '.1')
+        with open(path, 'w') as obj:
+            obj.write(TEST_LOG_LINES[1] + "\n")
+        third = dex.Dex(None, False, [], 0, False, 0, state_path=state_path)
+        self._analyze_logfile_quietly(third, path)
+        self.assertEqual(third._run_stats['linesRead'],
+                         whole._run_stats['linesRead'] + 2)
+        self.assertTrue(path + '.1' in [source['source'] for source
+                                        in third._run_stats['sources']])
+
+    def test_state_file_glob_rotation(self):
+        path = self.write_test_log(5)
+        state_path = self.get_temp_path('dex.state')
+        first = dex.Dex(None, False, [], 0, False, 0, state_path=state_path)
+        self._analyze_logfile_quietly(first, path + '*')
+
+        # the renamed log is resumed rather than read again whole
+        with open(path, 'a') as obj:
+            obj.write(TEST_LOG_LINES[2] + "\n")
+        os.rename(path, path + '.1')
+        with open(path, 'w') as obj:
+            obj.write(TEST_LOG_LINES[1] + "\n")
+        second = dex.Dex(None, False, [], 0, False, 0, state_path=state_path)
+        self._analyze_logfile_quietly(second, path + '*')
+        whole = dex.Dex(None, False, [], 0, False, 0)
+        for logfile_path in [path + '.1', path]:
+            whole.analyze_logfile_range(logfile_path, 0, None)
+        self.assertEqual(second._run_stats['linesRead'], whole._run_stats['linesRead'])
+        self.assertEqual([(report['queryMask'], report['stats']['count'])
+                          for report in second._report.get_reports()],
+                         [(report['queryMask'], report['stats']['count'])
+                          for report in whole._report.get_reports()])
+
+        # a compressed file already read is not read again
+        with open(path + '.1', 'rb') as obj:
+            contents = obj.read()
+        gzip_file = gzip.open(path + '.2.gz', 'wb')
+        gzip_file.write(contents)
+        gzip_file.close()
+        os.remove(path + '.1')
+        third = dex.Dex(None, False, [], 0, False, 0, state_path=state_path)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self._analyze_logfile_quietly(third, path + '*')
+            warnings = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue('counted twice' in warnings)
+        fourth = dex.Dex(None, False, [], 0, False, 0, state_path=state_path)
+        self._analyze_logfile_quietly(fourth, path + '*')
+        self.assertEqual(fourth._run_stats['linesRead'], third._run_stats['linesRead'])
+
+    def test_run_profile(self):
+        path = self.write_test_log(10)
+        untimed = dex.Dex(None, False, [], 0, False, 0)
+        untimed.analyze_logfile_range(path, 0, None)
+        self.assertFalse('profile' in untimed._run_stats)
+
+        timed = dex.Dex(None, False, [], 0, False, 0, collect_timings=True)
+        timed.analyze_logfile_range(path, 0, None)
+        profile = timed._run_stats['profile']
+        stages = profile['stages']
+        parsed_lines = (timed._run_stats['linesRead'] -
+                        timed._run_stats['readerStats']['linesSkipped'])
+        self.assertEqual(stages['lineTime']['calls'], parsed_lines)
+        self.assertEqual(stages['parse']['calls'], parsed_lines)
+        self.assertEqual(stages['read']['calls'],
+                         timed._run_stats['readerStats']['linesRead'])
+        self.assertEqual(stages['aggregate']['calls'],
+                         sum(report['stats']['count']
+                             for report in timed._report.get_reports()))
+        counters = profile['counters']
+        self.assertEqual(counters['analysisCacheHits'] + counters['analysisCacheMisses'],
+                         stages['analyze']['calls'])
+        self.assertEqual(counters['analysisCacheMisses'], stages['analysis']['calls'])
+        self.assertEqual(sorted(profile['handlers'].keys()),
+                         sorted(timed._run_stats['parserStats']['handlers'].keys()))
+        for name, handler_stats in timed._run_stats['parserStats']['handlers'].items():
+            self.assertEqual(profile['handlers'][name]['calls'], handler_stats['attempts'])
+
+        parallel = dex.Dex(None, False, [], 0, False, 0, jobs=2, collect_timings=True)
+        parallel._analyze_logfile_parallel([(path, 0, None)])
+        for stage in ['lineTime', 'parse', 'analyze', 'aggregate', 'read']:
+            self.assertEqual(parallel._run_stats['profile']['stages'][stage]['calls'],
+                             stages[stage]['calls'])
@@ -0,0 +1,64 @@
+################################################################################
+#
+# Copyright (c) 2012 ObjectLabs Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+################################################################################
+
+import unittest
+from dex import dex
+
+
+class test_namespaces(unittest.TestCase):
+    def test_namespace_filter(self):
+        test_dex = dex.Dex(None, False, ['db1.coll1', '*.coll2', 'db2.*',
+                                         'log*.event?', r'/^shard\d+\.users$/'],
+                           0, False, 0)
+        self.assertEqual(test_dex._requested_regexes, [r'^shard\d+\.users$'])
+        for namespace, requested in [('db1.coll1', True),
+                                     ('db1.coll3', False),
+                                     ('db3.coll2', True),
+                                     ('db2.anything', True),
+                                     ('db2.system.profile', False),
+                                     ('admin.coll2', False),
+                                     ('logs.events', True),
+                                     ('logs.eventlog', False),
+                                     ('shard12.users', True),
+                                     ('shard12.users2', False),
+                                     (None, False)]:
+            # the second check is answered from the decision cache
+            self.assertEqual(test_dex._namespace_requested(namespace), requested)
+            self.assertEqual(test_dex._namespace_requested(namespace), requested)
+        self.assertTrue(test_dex._namespace_may_be_requested('db3.$cmd'))
+        self.assertFalse(test_dex._namespace_may_be_requested('admin.$cmd'))
+        self.assertEqual(test_dex._get_requested_databases(), [])
+        self.assertEqual(test_dex._get_requested_collections('db1'), None)
+        self.assertEqual(test_dex._get_worker_options()['namespaces_list'][-1],
+                         r'/^shard\d+\.users$/')
+
+        test_dex = dex.Dex(None, False, ['db1.coll1', 'log*.event?'], 0, False, 0)
+        self.assertEqual(test_dex._get_requested_collections('db1'), ['coll1'])
+        self.assertEqual(test_dex._get_requested_collections('logs'), None)
+        self.assertTrue(test_dex._namespace_may_be_requested('logs.$cmd'))
+        self.assertFalse(test_dex._namespace_may_be_requested('db2.$cmd'))
+
+        test_dex = dex.Dex(None, False, ['db%d.coll' % i for i in range(1000)], 0, False, 0)
+        self.assertTrue(test_dex._namespace_requested('db999.coll'))
+        self.assertFalse(test_dex._namespace_requested('db1000.coll'))
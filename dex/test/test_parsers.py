@@ -0,0 +1,138 @@
+################################################################################
+#
+# Copyright (c) 2012 ObjectLabs Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+################################################################################
+
+import unittest
+from datetime import datetime
+from dex.parsers import LogParser, QueryShapeCache, get_line_time
+from dex.test.benchmark import generate_log_lines
+
+
+class test_parsers(unittest.TestCase):
+    def test_log_parser_dispatch(self):
+        parser = LogParser()
+        result = parser.parse("Wed Jul 17 14:52:39 [conn13] update test.bar query: { c: 1 } update: { $set: { c: 2 } } nscanned:1 140ms")
+        self.assertEqual(result['ns'], 'test.bar')
+        self.assertEqual(result['stats']['millis'], '140')
+        result = parser.parse("Wed Jul 17 14:52:39 [conn13] command test.$cmd command: { count: \"bar\", query: { c: 1 } } ntoreturn:1 300ms")
+        self.assertEqual(result['ns'], 'test.bar')
+        self.assertEqual(result['command'], 'count')
+        self.assertEqual(parser.parse("Wed Jul 17 14:52:43 [conn15] end connection 127.0.0.1:50000"), None)
+
+        # handlers match from the [connNNN] token, even when the query holds
+        # text that looks like one
+        result = parser.parse("Wed Jul 17 14:52:40 [conn14] query test.foo query: { a: \"[x] query y.z \" } nreturned:1 1250ms\n")
+        self.assertEqual(result['ns'], 'test.foo')
+        self.assertEqual(result['stats']['millis'], '1250')
+        # the time handler reads all the digits of the millis the line ends with
+        result = parser.parse("Wed Jul 17 14:52:41 [conn14] getmore local.oplog.rs cursorid:12 1234ms\n")
+        self.assertEqual(result['supported'], False)
+        self.assertEqual(result['stats']['millis'], '1234')
+        self.assertEqual(parser.parse("Wed Jul 17 14:52:42 [conn14] took 5ms to flush"), None)
+
+        stats = parser.get_stats()
+        self.assertEqual(stats['linesRejected'], 1)
+        self.assertEqual(stats['handlers']['Time Line Handler']['hits'], 1)
+        self.assertEqual(stats['handlers']['Update Log Line Handler']['hits'], 1)
+        self.assertEqual(stats['handlers']['CMD Log Line Handler']['hits'], 1)
+        self.assertEqual(stats['handlers']['Standard Query Log Line Handler']['attempts'], 1)
+
+    def test_query_shape_cache(self):
+        parser = LogParser()
+        line = "Wed Jul 17 14:52:37 [conn12] query test.foo query: { a: %d, b: { $gt: 5 } } nreturned:1 %dms"
+        first = parser.parse(line % (1, 120))
+        second = parser.parse(line % (1, 130))
+        self.assertEqual(first['queryMask'], second['queryMask'])
+        self.assertEqual(second['stats']['millis'], '130')
+        cache_stats = parser.get_stats()['queryShapeCache']
+        self.assertEqual(cache_stats['hits'], 1)
+        self.assertEqual(cache_stats['misses'], 1)
+
+        self.assertFalse('queryShapeCache' in LogParser(query_cache_mb=0).get_stats())
+
+        cache = QueryShapeCache(max_mb=0.002)
+        for i in range(10):
+            cache.put(('handler', '{ a: %d }' % i), {'queryMask': '{"$query":{"a":"<val>"}}'})
+        self.assertTrue(cache.get_stats()['approxBytes'] <= 0.002 * 1024 * 1024)
+        self.assertTrue(cache.get_stats()['evictions'] > 0)
+        self.assertEqual(cache.get(('handler', '{ a: 0 }')), None)
+        self.assertNotEqual(cache.get(('handler', '{ a: 9 }')), None)
+
+        # counters add up across workers, while the size gauges stay per cache
+        merged = QueryShapeCache(max_mb=0.002)
+        merged.merge_stats(cache.get_stats())
+        merged.merge_stats(cache.get_stats())
+        merged_stats = merged.get_stats()
+        self.assertEqual(merged_stats['hits'], 2 * cache.get_stats()['hits'])
+        self.assertEqual(merged_stats['evictions'], 2 * cache.get_stats()['evictions'])
+        self.assertEqual(merged_stats['entries'], cache.get_stats()['entries'])
+        self.assertEqual(merged_stats['approxBytes'], cache.get_stats()['approxBytes'])
+        self.assertTrue(merged_stats['approxBytes'] <= merged_stats['maxBytes'])
+
+    def test_get_line_time(self):
+        year = datetime.utcnow().year
+        self.assertEqual(get_line_time("Wed Jul 17 14:52:37 [conn1] query"),
+                         datetime(year, 7, 17, 14, 52, 37))
+        self.assertEqual(get_line_time("Sun Jul  7 04:52:37.123 [conn1] query"),
+                         datetime(year, 7, 7, 4, 52, 37))
+        self.assertEqual(get_line_time("2014-07-17T14:52:37.123Z [conn1] query"),
+                         datetime(2014, 7, 17, 14, 52, 37))
+        self.assertEqual(get_line_time("2014-07-17T14:52:37.123-0400 [conn1] query"),
+                         datetime(2014, 7, 17, 14, 52, 37))
+        self.assertEqual(get_line_time("2014-07-17T14:52:37+05:30 [conn1] query"),
+                         datetime(2014, 7, 17, 14, 52, 37))
+
+        # a log mixing the formats, e.g. across an upgrade, keeps one clock
+        mixed = ["Thu Jul 17 14:52:36.999 [conn1] query",
+                 "2014-07-17T14:52:37.123-0400 [conn1] query",
+                 "2014-07-17T14:52:38.000Z [conn1] query"]
+        self.assertEqual([get_line_time(line).time() for line in mixed],
+                         [datetime(2014, 7, 17, 14, 52, second).time()
+                          for second in [36, 37, 38]])
+        self.assertTrue(all(get_line_time(line).tzinfo is None for line in mixed))
+        self.assertEqual(get_line_time("[conn1] query"), None)
+
+        parser = LogParser()
+        line_time = datetime(2014, 7, 17, 14, 52, 37)
+        result = parser.parse("Wed Jul 17 14:52:37 [conn12] query test.foo query: { a: 1 } nreturned:1 120ms",
+                              line_time)
+        self.assertTrue(result['ts'] is line_time)
+
+    def test_synthetic_log(self):
+        options = {'line_count': 500, 'shape_count': 20, 'seed': 7}
+        lines = list(generate_log_lines(**options))
+        self.assertEqual(len(lines), 500)
+        self.assertEqual(lines, list(generate_log_lines(**options)))
+        self.assertNotEqual(lines, list(generate_log_lines(line_count=500, seed=8)))
+
+        parser = LogParser()
+        parsed = [parser.parse(line, parser.get_line_time(line)) for line in lines]
+        analyzable = [query for query in parsed if query is not None and query['supported']]
+        self.assertTrue(400 < len(analyzable) < 500)
+
+        # a single operation gives one query mask per shape
+        lines = list(generate_log_lines(line_count=200, shape_count=20,
+                                        op_mix={'count': 1}, unparsable_ratio=0))
+        self.assertTrue(all('command: { count: ' in line for line in lines))
+        parsed = [parser.parse(line, parser.get_line_time(line)) for line in lines]
+        self.assertEqual(len(set(query['queryMask'] for query in parsed)), 20)
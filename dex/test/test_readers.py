@@ -0,0 +1,122 @@
+################################################################################
+#
+# Copyright (c) 2012 ObjectLabs Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+################################################################################
+
+import os
+import gzip
+import bz2
+from dex import dex
+from dex.readers import LogFileTailer, expand_logfile_paths
+from dex.utils import pretty_json
+from dex.test.fixtures import TEST_LOG_LINES, TempDirTestCase
+
+
+class test_readers(TempDirTestCase):
+    def test_log_file_tailer(self):
+        path = self.write_test_log(1)
+        tailer = LogFileTailer(path, 0.1)
+        try:
+            lines = iter(tailer)
+            with open(path, 'a') as obj:
+                obj.write(TEST_LOG_LINES[0] + "\n" + TEST_LOG_LINES[1] + "\n")
+            self.assertEqual(next(lines), TEST_LOG_LINES[0] + "\n")
+            self.assertEqual(next(lines), TEST_LOG_LINES[1] + "\n")
+
+            # lines written just before rotation are still read
+            with open(path, 'a') as obj:
+                obj.write(TEST_LOG_LINES[2] + "\n" + TEST_LOG_LINES[3])
+            os.rename(path, path + '.1')
+            with open(path, 'w') as obj:
+                obj.write(TEST_LOG_LINES[4] + "\n")
+            self.assertEqual([next(lines) for i in range(3)],
+                             [TEST_LOG_LINES[2] + "\n", TEST_LOG_LINES[3],
+                              TEST_LOG_LINES[4] + "\n"])
+            self.assertEqual(tailer.rotations, 1)
+
+            # truncated to a shorter file, as by logrotate's copytruncate
+            with open(path, 'w') as obj:
+                obj.write(TEST_LOG_LINES[10] + "\n")
+            self.assertEqual(next(lines), TEST_LOG_LINES[10] + "\n")
+            self.assertEqual(tailer.truncations, 1)
+        finally:
+            tailer.close()
+
+    def test_mmap_line_reader(self):
+        path = self.write_test_log(20)
+        reports = []
+        for use_mmap in [False, True]:
+            test_dex = dex.Dex(None, False, [], 0, False, 0, use_mmap=use_mmap)
+            test_dex.analyze_logfile_range(path, 0, None)
+            reader_stats = test_dex._run_stats.pop('readerStats')
+            del test_dex._run_stats['sources']
+            self.assertEqual(reader_stats['bytesRead'], os.path.getsize(path))
+            self.assertEqual(reader_stats['linesRead'], 20 * len(TEST_LOG_LINES))
+            del test_dex._run_stats['dexTime']
+            del test_dex._run_stats['parserStats']
+            reports.append(pretty_json(test_dex._make_aggregated_report()))
+        # the mmap reader skips the connection lines, which carry no millis
+        self.assertEqual(reader_stats['linesSkipped'], 40)
+        self.assertEqual(reports[0], reports[1])
+
+    def test_compressed_logfile_analysis(self):
+        path = self.write_test_log(20)
+        paths = [path + '.gz', path + '.bz2']
+        with open(path, 'rb') as obj:
+            contents = obj.read()
+        # two concatenated gzip members, as written by appending
+        gzip_file = gzip.open(paths[0], 'wb')
+        gzip_file.write(contents[:1000])
+        gzip_file.close()
+        with open(paths[0], 'ab') as obj:
+            gzip_file = gzip.GzipFile(fileobj=obj, mode='wb')
+            gzip_file.write(contents[1000:])
+            gzip_file.close()
+        bz2_file = bz2.BZ2File(paths[1], 'wb')
+        bz2_file.write(contents)
+        bz2_file.close()
+        # the glob reads matches oldest first
+        os.utime(paths[0], (1000000000, 1000000000))
+
+        plain = dex.Dex(None, False, [], 0, False, 0)
+        plain.analyze_logfile_range(path, 0, None)
+        compressed = dex.Dex(None, False, [], 0, False, 0)
+        for compressed_path in expand_logfile_paths(path + '.*'):
+            compressed.analyze_logfile_range(compressed_path, 0, None)
+
+        sources = compressed._run_stats['sources']
+        self.assertEqual([source['source'] for source in sources], paths)
+        self.assertEqual([source['readerStats']['reader'] for source in sources],
+                         ['gzip', 'bz2'])
+        for source in sources:
+            self.assertEqual(source['readerStats']['bytesRead'], len(contents))
+            self.assertEqual(source['linesRead'], 20 * len(TEST_LOG_LINES))
+        self.assertEqual(compressed._run_stats['linesRead'],
+                         2 * plain._run_stats['linesRead'])
+
+        plain_reports = plain._report.get_reports()
+        compressed_reports = compressed._report.get_reports()
+        self.assertEqual([report['queryMask'] for report in plain_reports],
+                         [report['queryMask'] for report in compressed_reports])
+        for plain_report, compressed_report in zip(plain_reports, compressed_reports):
+            self.assertEqual(2 * plain_report['stats']['count'],
+                             compressed_report['stats']['count'])
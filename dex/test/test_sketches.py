@@ -0,0 +1,93 @@
+################################################################################
+#
+# Copyright (c) 2012 ObjectLabs Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+################################################################################
+
+import unittest
+import math
+import random
+from datetime import datetime, timedelta
+from dex.sketches import LatencyHistogram, TimeSeries
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+class test_sketches(unittest.TestCase):
+    def test_latency_histogram(self):
+        rng = random.Random(1)
+        times = [int(rng.expovariate(1 / 200.0)) for i in range(5000)]
+        whole = LatencyHistogram()
+        parts = [LatencyHistogram(), LatencyHistogram()]
+        for i, millis in enumerate(times):
+            whole.add(millis)
+            parts[i % 2].add(millis)
+        parts[0].merge(parts[1])
+        quantiles = [0.5, 0.95, 0.99, 1.0]
+        self.assertEqual(parts[0].get_quantiles(quantiles), whole.get_quantiles(quantiles))
+        self.assertEqual(whole.get_max(), max(times))
+
+        ordered = sorted(times)
+        for quantile, value in zip(quantiles, whole.get_quantiles(quantiles)):
+            exact = ordered[int(math.ceil(quantile * len(ordered))) - 1]
+            self.assertTrue(abs(value - exact) <= max(1, exact / 32.0))
+
+        # a bucket per millisecond below 64ms, and bounded above that
+        small = LatencyHistogram()
+        for millis in range(64):
+            small.add(millis)
+        self.assertEqual(small.get_quantiles([0.5, 1.0]), [31, 63])
+        for millis in range(0, 24 * 60 * 60 * 1000, 997):
+            small.add(millis)
+        self.assertTrue(len(small._buckets) < 900)
+        self.assertEqual(LatencyHistogram().get_quantiles([0.5]), [None])
+
+    def test_time_series(self):
+        start = datetime(2013, 7, 17, 14, 0, 0)
+        rng = random.Random(2)
+        entries = [(start + timedelta(seconds=rng.randint(0, 600)), rng.randint(0, 100))
+                   for i in range(500)]
+        for max_buckets in [None, 3]:
+            whole = TimeSeries(60, max_buckets)
+            parts = [TimeSeries(60, max_buckets), TimeSeries(60, max_buckets)]
+            for i, (ts, millis) in enumerate(entries):
+                whole.add(ts, millis)
+                parts[i * 2 / len(entries)].add(ts, millis)
+            parts[0].merge(parts[1])
+            self.assertEqual(parts[0].get_series(), whole.get_series())
+
+        series = TimeSeries(60, 3)
+        series.add(start + timedelta(seconds=70), 10)
+        series.add(start + timedelta(seconds=10), 5)
+        self.assertEqual(series.get_series(),
+                         OrderedDict([('start', start),
+                                      ('intervalSeconds', 60),
+                                      ('counts', [1, 1]),
+                                      ('totalTimeMillis', [5, 10])]))
+        # only the latest 3 buckets are kept
+        series.add(start + timedelta(seconds=200), 20)
+        series.add(start + timedelta(seconds=20), 1)
+        self.assertEqual(series.get_series()['start'], start + timedelta(seconds=60))
+        self.assertEqual(series.get_series()['counts'], [1, 0, 1])
+        series.add(start + timedelta(hours=1), 30)
+        self.assertEqual(series.get_series()['counts'], [1])
@@ -0,0 +1,57 @@
+################################################################################
+#
+# Copyright (c) 2012 ObjectLabs Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+################################################################################
+
+from dex import dex
+from dex.snapshot import read_index_snapshot, write_index_snapshot
+from dex.test.fixtures import TEST_DBNAME, TEST_COLLECTION
+from dex.test.fixtures import TempDirTestCase, TestParser
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+class test_snapshot(TempDirTestCase):
+    def test_index_snapshot(self):
+        path = self.get_temp_path('snapshot.json.gz')
+        write_index_snapshot(OrderedDict([
+            (TEST_DBNAME, OrderedDict([
+                (TEST_COLLECTION, OrderedDict([
+                    ('count', 10),
+                    ('indexes', {'_id_': {'key': [('_id', 1)], 'v': 1},
+                                 'a_1': {'key': [('a', 1)], 'v': 1}})]))]))]),
+            path)
+        databases = read_index_snapshot(path)
+        self.assertEqual(databases[TEST_DBNAME][TEST_COLLECTION]['count'], 10)
+        self.assertEqual(databases[TEST_DBNAME][TEST_COLLECTION]['indexes']['a_1']['key'],
+                         [('a', 1)])
+
+        # indexes are checked against the snapshot, with no URI
+        test_dex = dex.Dex(None, False, [], 0, True, 0, index_snapshot=path)
+        report = test_dex.generate_query_report(None,
+                                                TestParser().parse("{ $query: { a: 1 } }"),
+                                                TEST_DBNAME,
+                                                TEST_COLLECTION)
+        self.assertEqual(report['indexStatus'], 'full')
+        self.assertEqual(report['recommendation'], None)
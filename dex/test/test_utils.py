@@ -0,0 +1,91 @@
+################################################################################
+#
+# Copyright (c) 2012 ObjectLabs Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+################################################################################
+
+import unittest
+import json
+from StringIO import StringIO
+from dex import dex
+from dex.utils import pretty_json, yamlfy, parse_query_literal, parse_interval
+from dex.utils import ReportWriter
+from dex.test.fixtures import TempDirTestCase
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+class test_utils(TempDirTestCase):
+    def test_parse_query_literal(self):
+        test_query = "{ $query: { a: \"x\", b: { $in: [ 1, 2 ] } }, $orderby: { c: -1, d } }"
+        self.assertEqual(parse_query_literal(test_query), yamlfy(test_query))
+        self.assertEqual(parse_query_literal(test_query).keys(), ['$query', '$orderby'])
+
+        parsed = parse_query_literal("{ _id: ObjectId('51e6a1e3b1b7ea1a3c000001'), "
+                                     "d: new Date(1374000000000), "
+                                     "t: Timestamp 1374000000000|1, "
+                                     "name: /a,b}/i, sub: { ... } }")
+        self.assertEqual(parsed['_id'], "ObjectId('51e6a1e3b1b7ea1a3c000001')")
+        self.assertEqual(parsed['d'], 'new Date(1374000000000)')
+        self.assertEqual(parsed['t'], 'Timestamp 1374000000000|1')
+        self.assertEqual(parsed['name'], '/a,b}/i')
+        self.assertEqual(parsed['sub'], OrderedDict())
+
+        # escapes and non-ASCII text decode as yamlfy decodes them
+        escaped_query = (r'{ a: "caf\u00e9", b: "\x41\tb", c: "\"q\"", d: "' +
+                         u'\xe9'.encode('utf-8') + '" }')
+        self.assertEqual(parse_query_literal(escaped_query), yamlfy(escaped_query))
+        self.assertEqual(parse_query_literal(escaped_query).values(),
+                         [u'caf\xe9', 'A\tb', '"q"', u'\xe9'])
+
+        self.assertRaises(ValueError, parse_query_literal, "{ a: 1 } trailing")
+        self.assertRaises(ValueError, parse_query_literal, "{ a: { b: 1 }")
+
+    def test_parse_interval(self):
+        self.assertEqual([parse_interval(interval) for interval in ['90', '30s', '5m', '1h']],
+                         [90, 30, 300, 3600])
+        self.assertRaises(ValueError, parse_interval, '5x')
+
+    def test_report_writer(self):
+        test_dex = dex.Dex(None, False, [], 0, False, 0)
+        test_dex.analyze_logfile_range(self.write_test_log(2), 0, None)
+        expected = json.loads(pretty_json(test_dex._make_aggregated_report()))
+        self.assertTrue(len(expected['results']) > 0)
+        for compact in [False, True]:
+            out = StringIO()
+            ReportWriter(out, 'json', compact).write(test_dex._run_stats,
+                                                     test_dex._report.get_reports())
+            self.assertEqual(json.loads(out.getvalue()), expected)
+            self.assertEqual(compact, "\n" not in out.getvalue().rstrip())
+
+        out = StringIO()
+        ReportWriter(out, 'ndjson').write(test_dex._run_stats,
+                                          test_dex._report.get_reports())
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(lines[0], {'runStats': expected['runStats']})
+        self.assertEqual(lines[1:], expected['results'])
+
+        out = StringIO()
+        ReportWriter(out).write(test_dex._run_stats, [])
+        self.assertEqual(json.loads(out.getvalue())['results'], [])
+        self.assertRaises(ValueError, ReportWriter, out, 'xml')
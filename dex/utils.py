@@ -1,6 +1,7 @@
 __author__ = 'eric'
 
 import json
+import re
 from bson import json_util
 import yaml
 import yaml.constructor
@@ -26,6 +27,104 @@ def _custom_json_hook(obj):
         return json_util.default(obj)
 
 
+################################################################################
+# ReportWriter
+#   Streams a run's stats and query reports to a file as valid JSON, one
+#   report at a time, so that output needs no more memory than the largest
+#   report. 'json' writes a single {"runStats": ..., "results": [...]}
+#   document. 'ndjson' writes {"runStats": ...} on the first line and then
+#   one query report per line.
+################################################################################
+OUTPUT_FORMATS = ['json', 'ndjson']
+
+
+class ReportWriter(object):
+    def __init__(self, out, output_format='json', compact=False):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("Unsupported output format: %s" % output_format)
+        self._out = out
+        self._output_format = output_format
+        if compact or output_format == 'ndjson':
+            self._indent = None
+            self._encoder = json.JSONEncoder(separators=(',', ':'),
+                                             default=_custom_json_hook)
+        else:
+            self._indent = ' ' * 4
+            self._encoder = json.JSONEncoder(indent=4,
+                                             separators=(',', ': '),
+                                             default=_custom_json_hook)
+
+    def write(self, run_stats, reports):
+        """Writes the run stats and an iterable of query reports"""
+        if self._output_format == 'ndjson':
+            self._out.write('{"runStats":' + self._encoder.encode(run_stats) + "}\n")
+            for report in reports:
+                self._out.write(self._encoder.encode(report) + "\n")
+        elif self._indent is None:
+            self._out.write('{"runStats":' + self._encoder.encode(run_stats) +
+                            ',"results":[')
+            separator = ''
+            for report in reports:
+                self._out.write(separator + self._encoder.encode(report))
+                separator = ','
+            self._out.write("]}\n")
+        else:
+            self._out.write('{\n' + self._indent + '"runStats": ' +
+                            self._encode_indented(run_stats, 1) + ',\n' +
+                            self._indent + '"results": [')
+            separator = '\n'
+            for report in reports:
+                self._out.write(separator + self._indent * 2 +
+                                self._encode_indented(report, 2))
+                separator = ',\n'
+            if separator == '\n':
+                self._out.write("]\n}\n")
+            else:
+                self._out.write('\n' + self._indent + "]\n}\n")
+
+    def _encode_indented(self, obj, level):
+        return self._encoder.encode(obj).replace('\n', '\n' + self._indent * level)
+
+
+################################################################################
+# RunProfile
+#   Cumulative wall time and call counts for the stages of a run, and for
+#   each parser handler, along with event counters. Reported as
+#   runStats.profile. Components hold None rather than a RunProfile when
+#   profiling is off, so that it costs them one test per stage.
+################################################################################
+class RunProfile(object):
+    def __init__(self):
+        self._stats = OrderedDict([('stages', OrderedDict()),
+                                   ('handlers', OrderedDict()),
+                                   ('counters', OrderedDict())])
+
+    def add_time(self, name, seconds, calls=1, section='stages'):
+        """Adds the time taken by calls calls of a stage or handler"""
+        timing = self._stats[section].get(name)
+        if timing is None:
+            timing = OrderedDict([('calls', 0), ('timeMillis', 0.0)])
+            self._stats[section][name] = timing
+        timing['calls'] += calls
+        timing['timeMillis'] += seconds * 1000
+
+    def count(self, name, amount=1):
+        counters = self._stats['counters']
+        counters[name] = counters.get(name, 0) + amount
+
+    def get_stats(self):
+        return self._stats
+
+    def merge_stats(self, stats):
+        """Adds the timings and counters of another profile's stats"""
+        for section in ['stages', 'handlers']:
+            for name, timing in stats[section].items():
+                self.add_time(name, timing['timeMillis'] / 1000.0,
+                              timing['calls'], section)
+        for name, amount in stats['counters'].items():
+            self.count(name, amount)
+
+
 def validate_yaml(string):
     try:
         yamlfy(string)
@@ -43,6 +142,167 @@ def yamlfy(string):
     return yaml.load(string, OrderedDictYAMLLoader)
 
 
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+INTERVAL_RX = re.compile(r'^(\d+)([smhd]?)$')
+
+
+def parse_interval(string):
+    """Returns the seconds in an interval such as 90, 30s, 5m, 1h or 1d"""
+    match = INTERVAL_RX.match(string.strip())
+    if match is None or int(match.group(1)) == 0:
+        raise ValueError("Invalid interval: " + string)
+    return int(match.group(1)) * INTERVAL_UNITS[match.group(2) or 's']
+
+
+################################################################################
+# Query literal parser
+#   Parses the mongo shell-style documents written to 2.x logs, e.g.
+#   { _id: ObjectId('51e6a1e3b1b7ea1a3c000001'), name: /^a/i, n: { $gt: 5 } },
+#   into the same ordered structures yamlfy produces. Constructor values
+#   (ObjectId(...), new Date(...), Timestamp ...) and regex literals are kept
+#   as their literal text. Truncation markers ("...") are skipped, so the
+#   elided document { ... } parses to an empty document.
+################################################################################
+_LITERAL_TOKEN_RX = re.compile(r"""\s*(?:
+    (?P<punct>[{}\[\],:])|
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|
+    (?P<regex>/(?:[^/\\\n]|\\.)+/[a-z]*)|
+    (?P<timestamp>Timestamp\s+\d+\|\d+)|
+    (?P<call>(?:new\s+)?[A-Za-z_]\w*\s*\((?:[^()"']|"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')*\))|
+    (?P<word>[^\s{}\[\],:"']+(?:[ \t]+[^\s{}\[\],:"']+)*)
+    )""", re.VERBOSE)
+_LITERAL_INT_RX = re.compile(r'^-?\d+$')
+_LITERAL_FLOAT_RX = re.compile(r'^-?(?:\d+\.\d*|\.\d+|\d+(?=[eE]))(?:[eE][-+]?\d+)?$')
+_LITERAL_ESCAPE_RX = re.compile(r'\\(x[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+_LITERAL_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f'}
+_LITERAL_WORDS = {'true': True, 'false': False, 'null': None}
+_LITERAL_TRUNCATION = '...'
+
+
+def parse_query_literal(string):
+    """Parses a logged query document. Raises ValueError if the string is not
+        a single well-formed document or array"""
+    tokens = _tokenize_literal(string)
+    try:
+        value, pos = _parse_literal_value(tokens, 0)
+    except IndexError:
+        raise ValueError('Unexpected end of query literal: ' + string)
+    if pos != len(tokens):
+        raise ValueError('Unexpected content after query literal: ' + string)
+    return value
+
+
+def _tokenize_literal(string):
+    tokens = []
+    pos = 0
+    length = len(string)
+    while pos < length:
+        match = _LITERAL_TOKEN_RX.match(string, pos)
+        if match is None:
+            if string[pos:].strip() == '':
+                break
+            raise ValueError('Unable to tokenize query literal at: ' + string[pos:])
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        pos = match.end()
+    return tokens
+
+
+def _parse_literal_value(tokens, pos):
+    kind, text = tokens[pos]
+    if kind == 'punct':
+        if text == '{':
+            return _parse_literal_document(tokens, pos + 1)
+        elif text == '[':
+            return _parse_literal_array(tokens, pos + 1)
+        raise ValueError('Unexpected "' + text + '" in query literal')
+    elif kind == 'string':
+        return _unquote_literal(text), pos + 1
+    elif kind == 'word':
+        return _convert_literal_word(text), pos + 1
+    else:
+        return text, pos + 1
+
+
+def _parse_literal_document(tokens, pos):
+    document = OrderedDict()
+    while True:
+        kind, text = tokens[pos]
+        if kind == 'punct':
+            if text == '}':
+                return document, pos + 1
+            raise ValueError('Unexpected "' + text + '" in query literal')
+        if kind == 'word' and text == _LITERAL_TRUNCATION:
+            pos += 1
+        else:
+            key = _unquote_literal(text) if kind == 'string' else text
+            pos += 1
+            if tokens[pos] == ('punct', ':'):
+                document[key], pos = _parse_literal_value(tokens, pos + 1)
+            else:
+                document[key] = None
+        pos = _skip_literal_separator(tokens, pos, '}')
+
+
+def _parse_literal_array(tokens, pos):
+    array = []
+    while True:
+        kind, text = tokens[pos]
+        if kind == 'punct' and text == ']':
+            return array, pos + 1
+        if kind == 'word' and text == _LITERAL_TRUNCATION:
+            pos += 1
+        else:
+            value, pos = _parse_literal_value(tokens, pos)
+            array.append(value)
+        pos = _skip_literal_separator(tokens, pos, ']')
+
+
+def _skip_literal_separator(tokens, pos, closing):
+    token = tokens[pos]
+    if token == ('punct', ','):
+        return pos + 1
+    elif token == ('punct', closing):
+        return pos
+    raise ValueError('Expected "," or "' + closing + '" in query literal')
+
+
+def _unquote_literal(text):
+    """Returns the content of a quoted string with its escapes decoded, as
+        unicode if it has any non-ASCII characters, as yamlfy does"""
+    text = text[1:-1]
+    if isinstance(text, str):
+        try:
+            text.decode('ascii')
+        except UnicodeDecodeError:
+            text = text.decode('utf-8', 'replace')
+    if '\\' in text:
+        text = _LITERAL_ESCAPE_RX.sub(_unescape_literal, text)
+        if isinstance(text, unicode):
+            try:
+                text = text.encode('ascii')
+            except UnicodeEncodeError:
+                pass
+    return text
+
+
+def _unescape_literal(match):
+    escape = match.group(1)
+    if len(escape) > 1:
+        # \xXX, \uXXXX and \UXXXXXXXX
+        return ('\\' + escape).decode('unicode-escape')
+    return _LITERAL_ESCAPES.get(escape, escape)
+
+
+def _convert_literal_word(text):
+    if text in _LITERAL_WORDS:
+        return _LITERAL_WORDS[text]
+    if _LITERAL_INT_RX.match(text):
+        return int(text)
+    if _LITERAL_FLOAT_RX.match(text):
+        return float(text)
+    return text
+
+
 # From https://gist.github.com/844388
 class OrderedDictYAMLLoader(yaml.Loader):
     """